@@ -0,0 +1,417 @@
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import asyncio
+import hashlib
+import tempfile
+import argparse
+import statistics
+import tracemalloc
+import importlib.util
+from datetime import datetime
+# resource (maximum resident set size of the process) is only available on Unix
+try:
+    import resource
+except ImportError:
+    resource = None
+# Import custom modules
+import cost_api_mock
+import cost_client
+import cost_client_async
+import cost_logging
+import cost_metrics
+import cost_output
+import cost_sql
+import rate_limiter
+import finops_cost
+
+# Offline benchmark of the extraction and of the load: the Cost Management API is served by cost_api_mock and the tables
+# of sql_tables/ by a SQLite database (or by a local SQL Server over ODBC with --odbc), so that the throughput and the
+# memory of get_cost_data_with_pagination_retries, process_monthly_costs and push_azure_resource_cost_json_to_sql can be
+# compared between versions without Azure. Run e.g.
+#   python benchmark.py --rows 20000 --page-size 5000 --throttle-every 7 --token-uses 10 --output bench.json
+#   python benchmark.py --baseline bench.json
+BENCHMARKS = ('extract', 'monthly', 'load')
+
+# export-to-sql.py can't be imported by name
+_spec = importlib.util.spec_from_file_location('export_to_sql', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'export-to-sql.py'))
+export_to_sql = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(export_to_sql)
+
+# Tables of sql_tables/SQLQuery.sql and SQLQuery_v2_AzureResourceCost.sql used by the extraction and the load, in SQLite
+SQLITE_SCHEMA = """
+    CREATE TABLE AzureResourceCost (
+        SubscriptionName TEXT, SubscriptionId TEXT, ResourceGroup TEXT, ResourceName TEXT, ResourceID TEXT, ConsumedService TEXT,
+        MeterCategory TEXT, MeterSubcategory TEXT, Location TEXT, BillingMonth TEXT, CostCenter TEXT, Cost NUMERIC, ResourceKey BLOB
+    );
+    CREATE UNIQUE INDEX PK_AzureResourceCost ON AzureResourceCost (BillingMonth, ResourceKey);
+    CREATE TABLE AzureResourceCostStage (
+        LoadKey TEXT NOT NULL, SubscriptionName TEXT, SubscriptionId TEXT, ResourceGroup TEXT, ResourceName TEXT, ResourceID TEXT,
+        ConsumedService TEXT, MeterCategory TEXT, MeterSubcategory TEXT, Location TEXT, BillingMonth TEXT, CostCenter TEXT, Cost TEXT
+    );
+    CREATE INDEX IX_AzureResourceCostStage_LoadKey ON AzureResourceCostStage (LoadKey);
+    CREATE TABLE FileLoadCheckpoint (
+        FilePath TEXT PRIMARY KEY, ContentHash TEXT, FileSize INTEGER, FileModifiedTime INTEGER, TotalRows INTEGER, LastProcessedRow INTEGER NOT NULL DEFAULT 0,
+        IsComplete INTEGER NOT NULL DEFAULT 0, LastProcessedTimestamp TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE BillingAccountCost (SubscriptionName TEXT, SubscriptionId TEXT, TotalCost TEXT, Month TEXT, Year TEXT, Date TEXT);
+    CREATE TABLE SubscriptionCost (SubscriptionName TEXT, SubscriptionId TEXT, AzureCost TEXT, ResourceCount TEXT, Month TEXT, Year TEXT, Date TEXT);
+"""
+
+# SQLite versions of the T-SQL statements of cost_sql.merge_staged_rows and export-to-sql.save_checkpoint (same parameters)
+SQLITE_DELETE_STAGED_MONTHS = """
+    DELETE FROM AzureResourceCost
+    WHERE EXISTS (
+        SELECT 1 FROM AzureResourceCostStage AS source
+        WHERE source.LoadKey = ? AND source.SubscriptionId = AzureResourceCost.SubscriptionId
+            AND substr(source.BillingMonth, 1, 10) = AzureResourceCost.BillingMonth
+    )
+"""
+SQLITE_MERGE_STAGED_ROWS = """
+    INSERT INTO AzureResourceCost (
+        SubscriptionName, SubscriptionId, ResourceGroup, ResourceName, ResourceID, ConsumedService, MeterCategory,
+        MeterSubcategory, Location, BillingMonth, CostCenter, Cost, ResourceKey
+    )
+    SELECT
+        MAX(SubscriptionName), SubscriptionId, ResourceGroup, MAX(ResourceName), ResourceID, ConsumedService, MeterCategory,
+        MeterSubcategory, Location, substr(BillingMonth, 1, 10), CostCenter, ROUND(SUM(CAST(Cost AS REAL)), 6),
+        resource_key(SubscriptionId, ResourceGroup, ResourceID, ConsumedService, MeterCategory, MeterSubcategory, Location, CostCenter)
+    FROM AzureResourceCostStage
+    WHERE LoadKey = ?
+    GROUP BY SubscriptionId, ResourceGroup, ResourceID, ConsumedService, MeterCategory, MeterSubcategory, Location,
+        substr(BillingMonth, 1, 10), CostCenter
+    ON CONFLICT (BillingMonth, ResourceKey) DO UPDATE SET
+        SubscriptionName = excluded.SubscriptionName, ResourceName = excluded.ResourceName, Cost = excluded.Cost
+"""
+SQLITE_SAVE_CHECKPOINT = """
+    INSERT INTO FileLoadCheckpoint (FilePath, ContentHash, FileSize, FileModifiedTime, TotalRows, LastProcessedRow, IsComplete)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT (FilePath) DO UPDATE SET
+        ContentHash = excluded.ContentHash, FileSize = excluded.FileSize, FileModifiedTime = excluded.FileModifiedTime, TotalRows = excluded.TotalRows, LastProcessedRow = excluded.LastProcessedRow,
+        IsComplete = excluded.IsComplete, LastProcessedTimestamp = CURRENT_TIMESTAMP
+"""
+
+# Function to translate the T-SQL statements without a SQLite equivalent, recognized by their first words
+def translate_sql(query):
+    statement = ' '.join(query.split())
+    if statement.startswith('DELETE FROM AzureResourceCost WHERE EXISTS '):
+        return SQLITE_DELETE_STAGED_MONTHS
+    if statement.startswith('MERGE AzureResourceCost '):
+        return SQLITE_MERGE_STAGED_ROWS
+    if statement.startswith('MERGE FileLoadCheckpoint '):
+        return SQLITE_SAVE_CHECKPOINT
+    return query
+
+# Key of the merge, computed like the HASHBYTES('SHA2_256', CONCAT_WS(N'|', ...)) of the v2 schema
+def resource_key(*values):
+    return hashlib.sha256('|'.join(value for value in values if value is not None).encode('utf-16-le')).digest()
+
+# Cursor with the pyodbc interface used by cost_sql and export-to-sql.py (fast_executemany is accepted and ignored)
+class SqliteCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self.fast_executemany = False
+
+    def execute(self, query, params=()):
+        self._cursor.execute(translate_sql(query), params)
+        return self
+
+    def executemany(self, query, params):
+        self._cursor.executemany(translate_sql(query), params)
+        return self
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+# SQLite stand-in for a pyodbc connection to Azure SQL. Connections of a pool share the database file and may be used by
+# the background insert thread of cost_sql.SqlCostDataWriter
+class SqliteConnection:
+    def __init__(self, database):
+        self._conn = sqlite3.connect(database, timeout=60, check_same_thread=False)
+        self._conn.create_function('resource_key', 8, resource_key, deterministic=True)
+
+    def cursor(self):
+        return SqliteCursor(self._conn.cursor())
+
+    def commit(self):
+        self._conn.commit()
+
+    def rollback(self):
+        self._conn.rollback()
+
+    def close(self):
+        self._conn.close()
+
+# Function to create the SQLite database of a run
+def create_sqlite_database(database):
+    conn = sqlite3.connect(database)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.executescript(SQLITE_SCHEMA)
+    conn.commit()
+    conn.close()
+
+# Function to make cost_sql open its connections to the database of the benchmark instead of Azure SQL.
+# With an ODBC connection string (e.g. a local SQL Server with the tables of sql_tables/), the real T-SQL statements are run
+def use_benchmark_database(database, odbc_connection_string=None):
+    if odbc_connection_string:
+        cost_sql.require_pyodbc()
+        cost_sql.connect_to_sql = lambda: cost_sql.pyodbc.connect(odbc_connection_string)
+    else:
+        create_sqlite_database(database)
+        cost_sql.connect_to_sql = lambda: SqliteConnection(database)
+
+# Function to point the scripts at the mock server and turn off what would skew the measures
+def configure_scripts(server, args):
+    cost_client.token_url_template = server.url + '/{tenant_id}/oauth2/token'
+    finops_cost.management_endpoint = server.url
+    finops_cost.billing_account = 'benchmark'
+    finops_cost.client_secret = 'benchmark'
+    finops_cost.output_format = args.format
+    # Every run queries the mock, the response cache would serve the repeated runs from the disk
+    finops_cost.response_cache = None
+    # Pipeline loads use the load mode of the benchmark
+    finops_cost.pipeline_load_mode = args.load_mode
+
+# Function to create the client of a run, with its own token and a scheduler paced for the mock instead of the API quota
+def create_client(args):
+    token_manager = cost_client.TokenManager('benchmark-tenant', 'benchmark-client', 'benchmark-secret')
+    scheduler = rate_limiter.RequestScheduler(rate=args.requests_per_second, capacity=max(1, int(args.requests_per_second)))
+    if args.backend == 'async':
+        return cost_client_async.AsyncCostManagementClient(token_manager, scheduler, pool_size=args.workers)
+    return cost_client.CostManagementClient(token_manager, scheduler, pool_size=args.workers)
+
+# Function to run a coroutine of the async backend on a new event loop, closing the client's connections at the end
+def run_async(client, coroutine_function):
+    async def run():
+        async with client:
+            return await coroutine_function()
+    return asyncio.run(run())
+
+# Function to run a benchmark once. Returns the elapsed seconds, the peak of the Python allocations (None unless traced),
+# the result of the benchmark and the metrics of the run
+def measure(function, trace_memory=False):
+    cost_metrics.metrics.reset()
+    if trace_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = function()
+        elapsed = time.perf_counter() - start
+        peak_bytes = tracemalloc.get_traced_memory()[1] if trace_memory else None
+    finally:
+        if trace_memory:
+            tracemalloc.stop()
+    return elapsed, peak_bytes, result, cost_metrics.metrics.summary()
+
+# Function to sum a counter of the metrics summary over its label sets, optionally filtered on one label
+def counter_total(summary, name, **labels):
+    return sum(counter['value'] for counter in summary['counters']
+               if counter['name'] == name and all(counter.get(key) == value for key, value in labels.items()))
+
+# Benchmark of get_cost_data_with_pagination_retries: the nextLink chain of the first subscription written to a cost data file
+def run_extract(api, args, run_dir, year, month):
+    subscription_id, subscription_name, _ = api.subscription(0)
+    month_name = datetime(year, month, 1).strftime('%b')
+    json_file = cost_output.cost_data_file_name(run_dir, subscription_name, month_name, year, args.format)
+    log_file = os.path.join(run_dir, f'process_log_{subscription_name}.txt')
+    next_link_file = os.path.join(run_dir, f'next_link_{subscription_name}.txt')
+    client = create_client(args)
+    if args.backend == 'async':
+        return lambda: run_async(client, lambda: finops_cost.get_cost_data_with_pagination_retries_async(year, month, subscription_id, client, log_file, json_file, next_link_file, output_format=args.format))
+    return lambda: finops_cost.get_cost_data_with_pagination_retries(year, month, subscription_id, client, log_file, json_file, next_link_file, output_format=args.format)
+
+# Benchmark of process_monthly_costs: the billing account query and every subscription of the month (in the run folder).
+# The async backend runs the month as a one month backfill_costs_async
+def run_monthly(api, args, run_dir, year, month):
+    client = create_client(args)
+    def run():
+        working_dir = os.getcwd()
+        # process_monthly_costs writes to the output folder of the working directory
+        os.chdir(run_dir)
+        try:
+            if args.backend == 'async':
+                month_label = f'{year}-{month:02d}'
+                run_async(client, lambda: finops_cost.backfill_costs_async(month_label, month_label, concurrency=args.workers, client=client))
+            else:
+                finops_cost.process_monthly_costs(year, month, max_workers=args.workers, client=client, resume=False, incremental=False, pipeline=args.pipeline)
+        finally:
+            os.chdir(working_dir)
+    return run
+
+# Benchmark of push_azure_resource_cost_json_to_sql: the cost data file of the first subscription, extracted beforehand
+def run_load(api, args, run_dir, year, month):
+    subscription_id, subscription_name, _ = api.subscription(0)
+    month_name = datetime(year, month, 1).strftime('%b')
+    output_dir = os.path.join(run_dir, export_to_sql.base_folder, str(year), month_name)
+    os.makedirs(output_dir, exist_ok=True)
+    json_file = cost_output.cost_data_file_name(output_dir, subscription_name, month_name, year, args.format)
+    # The file is extracted with the backend of the run, like run_extract
+    client = create_client(args)
+    extract_args = (year, month, subscription_id, client, os.path.join(output_dir, 'process_log.txt'), json_file, os.path.join(output_dir, 'next_link.txt'))
+    if args.backend == 'async':
+        run_async(client, lambda: finops_cost.get_cost_data_with_pagination_retries_async(*extract_args, output_format=args.format))
+    else:
+        finops_cost.get_cost_data_with_pagination_retries(*extract_args, output_format=args.format)
+    conn = cost_sql.connect_to_sql()
+    def run():
+        working_dir = os.getcwd()
+        # The FileLoadCheckpoint keys are relative to the output folder of the working directory
+        os.chdir(run_dir)
+        try:
+            return export_to_sql.push_azure_resource_cost_json_to_sql(os.path.relpath(json_file, run_dir), conn, 0, load_mode=args.load_mode)
+        finally:
+            os.chdir(working_dir)
+            conn.close()
+    return run
+
+BENCHMARK_RUNS = {'extract': run_extract, 'monthly': run_monthly, 'load': run_load}
+
+# Function to run a benchmark `repeat` times, plus once with tracemalloc to measure the peak memory (tracing slows the code
+# down, so that run isn't timed). Each run gets a new folder and database
+def run_benchmark(name, api, args, work_dir, year, month):
+    expected_rows = api.subscription(0)[2] if name in ('extract', 'load') else sum(api.subscription(index)[2] for index in range(api.subscriptions))
+    timings = []
+    peak_bytes = None
+    summary = None
+    for run in range(args.repeat + 1):
+        trace_memory = run == args.repeat
+        run_dir = os.path.join(work_dir, f'{name}-{run}')
+        os.makedirs(run_dir)
+        use_benchmark_database(os.path.join(run_dir, 'benchmark.db'), args.odbc)
+        function = BENCHMARK_RUNS[name](api, args, run_dir, year, month)
+        elapsed, peak, result, run_summary = measure(function, trace_memory)
+        if trace_memory:
+            peak_bytes = peak
+        else:
+            timings.append(elapsed)
+            summary = summary or run_summary
+
+        # Check that every row went through, so that a faster run isn't a run which lost rows
+        rows = counter_total(run_summary, 'sql_rows_total') if name == 'load' or (name == 'monthly' and args.pipeline) else counter_total(run_summary, 'extract_rows_total')
+        if rows != expected_rows:
+            raise Exception(f"Benchmark {name} processed {rows} rows instead of {expected_rows}")
+        if not args.keep:
+            shutil.rmtree(run_dir, ignore_errors=True)
+
+    seconds = statistics.median(timings)
+    return {
+        'benchmark': name,
+        'rows': expected_rows,
+        'runs': args.repeat,
+        'seconds': round(seconds, 3),
+        'best_seconds': round(min(timings), 3),
+        'rows_per_second': round(expected_rows / seconds, 1),
+        'peak_memory_mb': round(peak_bytes / 1024 ** 2, 2),
+        'requests': sum(histogram['count'] for histogram in summary['histograms'] if histogram['name'] == 'api_request_seconds'),
+        'throttled_retries': counter_total(summary, 'api_retries_total', reason='throttled'),
+        'token_retries': counter_total(summary, 'api_retries_total', reason='token_expired'),
+        'response_mb': round(counter_total(summary, 'api_response_bytes_total') / 1024 ** 2, 2),
+        'stages': summary['throughput']
+    }
+
+# Function to compare the results with a previous report. A benchmark regresses when its throughput drops, or its peak
+# memory grows, by more than `tolerance` (relative)
+def find_regressions(results, baseline, tolerance):
+    baseline_results = {result['benchmark']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        previous = baseline_results.get(result['benchmark'])
+        if previous is None or previous['rows'] != result['rows']:
+            continue
+        if result['rows_per_second'] < previous['rows_per_second'] * (1 - tolerance):
+            regressions.append(f"{result['benchmark']}: {result['rows_per_second']:.0f} rows/sec, was {previous['rows_per_second']:.0f}")
+        if result['peak_memory_mb'] > previous['peak_memory_mb'] * (1 + tolerance):
+            regressions.append(f"{result['benchmark']}: peak memory {result['peak_memory_mb']} MB, was {previous['peak_memory_mb']} MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the extraction and the load against a local mock of the Cost Management API and a SQLite database')
+    parser.add_argument('--benchmark', nargs='*', choices=BENCHMARKS, default=list(BENCHMARKS), help='Benchmarks to run')
+    parser.add_argument('--subscriptions', type=int, default=4, help='Number of subscriptions of the billing account')
+    parser.add_argument('--rows', default='20000', help='Rows of each subscription, a comma separated list is cycled over the subscriptions')
+    parser.add_argument('--page-size', type=int, default=5000, help='Rows of each page of the nextLink chain')
+    parser.add_argument('--throttle-every', type=int, default=0, help='Answer every n-th query with a 429 (0 to never throttle)')
+    parser.add_argument('--retry-after', type=float, default=0.2, help='Retry-after seconds of the 429 responses')
+    parser.add_argument('--token-uses', type=int, default=0, help='Queries after which a token is rejected with 401 ExpiredAuthenticationToken (0 for never)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds spent by the mock API on each page')
+    parser.add_argument('--month', default='2025-01', help='Month extracted (YYYY-MM)')
+    parser.add_argument('--format', choices=cost_output.OUTPUT_FORMATS, default=finops_cost.output_format, help='Output format of the cost data files')
+    parser.add_argument('--workers', type=int, default=finops_cost.max_workers, help='Subscriptions retrieved in parallel by process_monthly_costs (concurrently with --backend async)')
+    parser.add_argument('--backend', choices=('threads', 'async'), default='threads', help='Extraction backend of the extract and monthly benchmarks')
+    parser.add_argument('--pipeline', action='store_true', help='Run process_monthly_costs in pipeline mode (load into the database)')
+    parser.add_argument('--load-mode', choices=('insert', 'merge'), default='merge', help='Load mode of the load benchmark and of the pipeline mode')
+    parser.add_argument('--requests-per-second', type=float, default=1000, help='Pacing of the request scheduler')
+    parser.add_argument('--repeat', type=int, default=3, help='Timed runs of each benchmark (the median is reported)')
+    parser.add_argument('--odbc', help='ODBC connection string of a local SQL Server with the tables of sql_tables/, instead of SQLite')
+    parser.add_argument('--work-dir', help='Folder of the runs, a temporary folder by default')
+    parser.add_argument('--keep', action='store_true', help='Keep the files and databases of the runs')
+    parser.add_argument('--output', help='Write the results to this JSON file')
+    parser.add_argument('--baseline', help='Results of a previous run (--output) to compare with, exits with status 1 on a regression')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Relative drop of throughput (or growth of memory) reported as a regression')
+    args = parser.parse_args()
+
+    year, month = (int(part) for part in args.month.split('-'))
+    if not 1 <= month <= 12 or args.repeat < 1:
+        parser.error('--month must be YYYY-MM and --repeat at least 1')
+    if args.backend == 'async' and args.pipeline:
+        parser.error('--pipeline is only supported by the threads backend')
+    api = cost_api_mock.MockCostApi(
+        subscriptions=args.subscriptions, rows=[int(rows) for rows in args.rows.split(',')], page_size=args.page_size,
+        throttle_every=args.throttle_every, retry_after=args.retry_after, token_uses=args.token_uses, latency=args.latency
+    )
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='finops-benchmark-')
+    os.makedirs(work_dir, exist_ok=True)
+
+    # The server process is started before the logging thread
+    with cost_api_mock.MockCostApiServer(api) as server:
+        configure_scripts(server, args)
+        # Logs of the runs go to a file only, as in a production run the per-page messages are included in the measures
+        cost_logging.setup_logging(os.path.join(work_dir, 'benchmark.log'), console=False)
+        print(f"Mock Cost Management API at {server.url}, runs in {work_dir}")
+
+        results = []
+        for name in args.benchmark:
+            result = run_benchmark(name, api, args, work_dir, year, month)
+            results.append(result)
+            print(f"{name:<8} {result['rows']:>9} rows {result['seconds']:>8.3f} s {result['rows_per_second']:>11.0f} rows/sec "
+                  f"{result['peak_memory_mb']:>8.2f} MB peak {result['requests']:>5} requests "
+                  f"({result['throttled_retries']} throttled, {result['token_retries']} expired token)")
+        server_stats = server.stats()
+    cost_logging.shutdown_logging()
+
+    report = {
+        'date': datetime.now().isoformat(timespec='seconds'),
+        'config': {key: value for key, value in vars(args).items() if key not in ('odbc', 'output', 'baseline')},
+        'database': 'odbc' if args.odbc else 'sqlite',
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1) if resource else None,
+        'mock_server': server_stats,
+        'results': results
+    }
+    print(f"Mock server: {server_stats}, maximum resident memory: {report['max_rss_mb']} MB")
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=4)
+        print(f"Results written to {args.output}")
+    if not args.work_dir and not args.keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.baseline:
+        with open(args.baseline, 'r') as file:
+            baseline = json.load(file)
+        # Results are only comparable for the same workload
+        differences = [key for key in ('subscriptions', 'rows', 'page_size', 'throttle_every', 'retry_after', 'token_uses', 'latency', 'format', 'workers', 'pipeline', 'load_mode')
+                       if baseline['config'].get(key) != report['config'][key]]
+        if differences:
+            print(f"Warning: the baseline was run with different settings: {', '.join(differences)}")
+        regressions = find_regressions(results, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regression against {args.baseline}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,226 @@
+import gzip
+import json
+import time
+import threading
+import multiprocessing
+import requests
+from functools import lru_cache
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+# Import custom modules
+import cost_output
+
+# Local mock of the Microsoft.CostManagement/query endpoint (and of the Azure AD token endpoint) used by benchmark.py.
+# Subscription queries return `rows` deterministic rows per subscription in pages of `page_size` rows chained with
+# nextLink, the billing account query returns the total cost of each subscription. Every `throttle_every`-th query is
+# rejected with a 429 carrying retry-after headers, and a token is rejected with 401 ExpiredAuthenticationToken once
+# it has been used for `token_uses` queries, so that the retry paths of the client are exercised as well
+class MockCostApi:
+    def __init__(self, subscriptions=4, rows=10000, page_size=5000, throttle_every=0, retry_after=0.2, token_uses=0, latency=0.0):
+        self.subscriptions = subscriptions
+        # Rows of each subscription, a list is cycled over the subscriptions (e.g. a few large ones among small ones)
+        self.rows = rows if isinstance(rows, (list, tuple)) else [rows]
+        self.page_size = page_size
+        self.throttle_every = throttle_every
+        self.retry_after = retry_after
+        self.token_uses = token_uses
+        # Seconds spent by the API on each query page
+        self.latency = latency
+
+        self._lock = threading.Lock()
+        self._token_uses = {}
+        self.requests = 0
+        self.throttled = 0
+        self.expired = 0
+        self.tokens = 0
+
+    # Configuration of the mock, to start the same one in the server process
+    def config(self):
+        return {
+            'subscriptions': self.subscriptions, 'rows': list(self.rows), 'page_size': self.page_size, 'throttle_every': self.throttle_every,
+            'retry_after': self.retry_after, 'token_uses': self.token_uses, 'latency': self.latency
+        }
+
+    # Function to return the (SubscriptionId, SubscriptionName, rows) of a subscription
+    def subscription(self, index):
+        return f'00000000-0000-0000-0000-{index:012d}', f'benchmark-sub-{index:03d}', self.rows[index % len(self.rows)]
+
+    def subscription_index(self, subscription_id):
+        for index in range(self.subscriptions):
+            if self.subscription(index)[0] == subscription_id:
+                return index
+        return None
+
+    # Cost of a row, spread between 0 and 100
+    @staticmethod
+    def cost(index, row):
+        return ((index + 1) * 7919 + row * 104729) % 100000 / 1000
+
+    # Function to return the total cost of a subscription, i.e. the sum of the costs of its rows
+    def subscription_total(self, index):
+        return sum(self.cost(index, row) for row in range(self.subscription(index)[2]))
+
+    def row(self, index, row, month):
+        subscription_id, subscription_name, _ = self.subscription(index)
+        resource_group = f'rg-{row % 40:02d}'
+        return [
+            self.cost(index, row), subscription_name, resource_group,
+            f'/subscriptions/{subscription_id}/resourcegroups/{resource_group}/providers/microsoft.compute/virtualmachines/vm-{row:07d}',
+            'microsoft.compute', 'D2s v3', 'Virtual Machines', ('eastus', 'westeurope', 'canadacentral', 'centralindia')[row % 4],
+            f'{month}-01T00:00:00', 'costcenter', f'cc-{row % 25:03d}', 'USD'
+        ]
+
+    # Function to build the JSON response of a page of a subscription query
+    def page(self, index, page, month, next_link):
+        _, _, rows = self.subscription(index)
+        start = page * self.page_size
+        return json.dumps({
+            'id': f'benchmark-{index}-{page}',
+            'type': 'Microsoft.CostManagement/query',
+            'properties': {
+                'nextLink': next_link if start + self.page_size < rows else None,
+                'columns': [{'name': name, 'type': 'Number' if name == 'PreTaxCost' else 'String'} for name in cost_output.COST_DATA_COLUMNS],
+                'rows': [self.row(index, row, month) for row in range(start, min(start + self.page_size, rows))]
+            }
+        }).encode('utf-8')
+
+    def billing_account_summary(self):
+        rows = []
+        for index in range(self.subscriptions):
+            subscription_id, subscription_name, _ = self.subscription(index)
+            rows.append([round(self.subscription_total(index), 6), subscription_id, subscription_name, 'USD'])
+        rows.sort(key=lambda row: row[0], reverse=True)
+        columns = [{'name': 'Cost', 'type': 'Number'}, {'name': 'SubscriptionId', 'type': 'String'}, {'name': 'SubscriptionName', 'type': 'String'}, {'name': 'Currency', 'type': 'String'}]
+        return json.dumps({'properties': {'nextLink': None, 'columns': columns, 'rows': rows}}).encode('utf-8')
+
+    # Function to issue a new token (the grant isn't checked)
+    def issue_token(self):
+        with self._lock:
+            self.tokens += 1
+            token = f'benchmark-token-{self.tokens}'
+            self._token_uses[token] = 0
+        return json.dumps({'token_type': 'Bearer', 'access_token': token, 'expires_in': 3600}).encode('utf-8')
+
+    # Function to check the token and the throttling of a query. Returns the error response (status, headers, body) or None
+    def admit(self, authorization):
+        token = (authorization or '').replace('Bearer ', '', 1)
+        with self._lock:
+            self.requests += 1
+            if token not in self._token_uses:
+                return 401, {}, json.dumps({'error': {'code': 'InvalidAuthenticationToken', 'message': 'The access token is invalid.'}}).encode('utf-8')
+            if self.token_uses and self._token_uses[token] >= self.token_uses:
+                self.expired += 1
+                return 401, {}, json.dumps({'error': {'code': 'ExpiredAuthenticationToken', 'message': 'The access token expiry UTC time is earlier than current UTC time.'}}).encode('utf-8')
+            if self.throttle_every and self.requests % self.throttle_every == 0:
+                self.throttled += 1
+                headers = {'x-ms-ratelimit-microsoft.costmanagement-qpu-retry-after': str(self.retry_after), 'Retry-After': str(self.retry_after)}
+                return 429, headers, json.dumps({'error': {'code': '429', 'message': 'Too many requests. Please retry.'}}).encode('utf-8')
+            self._token_uses[token] += 1
+        return None
+
+    def stats(self):
+        with self._lock:
+            return {'requests': self.requests, 'throttled': self.throttled, 'expired': self.expired, 'tokens': self.tokens}
+
+# Request handler of the mock server, answering from the MockCostApi of the server
+class MockCostApiHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send(self, status, body, headers=None):
+        # The client asks for gzip responses, like the real API the pages are compressed
+        if 'gzip' in (self.headers.get('Accept-Encoding') or '') and len(body) > 1024:
+            body = gzip.compress(body, compresslevel=1)
+            headers = {**(headers or {}), 'Content-Encoding': 'gzip'}
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == '/stats':
+            self.send(200, json.dumps(self.server.api.stats()).encode('utf-8'))
+        else:
+            self.send(404, b'{}')
+
+    def do_POST(self):
+        api = self.server.api
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        url = urlsplit(self.path)
+        parts = url.path.strip('/').split('/')
+        if url.path.endswith('/oauth2/token'):
+            self.send(200, api.issue_token())
+            return
+        if not url.path.endswith('/providers/Microsoft.CostManagement/query'):
+            self.send(404, json.dumps({'error': {'code': 'NotFound', 'message': url.path}}).encode('utf-8'))
+            return
+
+        error = api.admit(self.headers.get('Authorization'))
+        if error is not None:
+            self.send(error[0], error[2], error[1])
+            return
+        if api.latency:
+            time.sleep(api.latency)
+
+        if parts[0] == 'providers':
+            # Billing account query
+            self.send(200, api.billing_account_summary())
+            return
+        index = api.subscription_index(parts[1])
+        if index is None:
+            self.send(404, json.dumps({'error': {'code': 'SubscriptionNotFound', 'message': parts[1]}}).encode('utf-8'))
+            return
+        month = json.loads(body or b'{}').get('timePeriod', {}).get('from', '1970-01')[:7]
+        page = int(parse_qs(url.query).get('$skiptoken', ['0'])[0])
+        next_link = f"http://{self.headers['Host']}{url.path}?api-version=2021-10-01&$skiptoken={page + 1}"
+        self.send(200, self.server.page(index, page, month, next_link))
+
+# Function run in the server process: serve the mock until the process is terminated
+def serve(config, port_queue, host='127.0.0.1', port=0):
+    api = MockCostApi(**config)
+    server = ThreadingHTTPServer((host, port), MockCostApiHandler)
+    server.daemon_threads = True
+    server.api = api
+    # Pages are built once, the same pages being queried by every run of a benchmark
+    server.page = lru_cache(maxsize=256)(api.page)
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+# Mock server run in its own process, so that building the responses doesn't compete with the measured code for the GIL
+class MockCostApiServer:
+    def __init__(self, api, host='127.0.0.1', port=0):
+        self.api = api
+        self.host = host
+        self.port = port
+        self.url = None
+        self._process = None
+
+    def start(self):
+        context = multiprocessing.get_context('spawn')
+        port_queue = context.Queue()
+        self._process = context.Process(target=serve, args=(self.api.config(), port_queue, self.host, self.port), daemon=True)
+        self._process.start()
+        self.url = f'http://{self.host}:{port_queue.get(timeout=30)}'
+        return self
+
+    # Function to read the counters of the server (requests, throttled, expired tokens, tokens issued)
+    def stats(self):
+        return requests.get(self.url + '/stats').json()
+
+    def stop(self):
+        if self._process is not None:
+            self._process.terminate()
+            self._process.join()
+            self._process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+        return False
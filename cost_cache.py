@@ -0,0 +1,215 @@
+import os
+import time
+import json
+import hashlib
+import threading
+from datetime import date, timedelta
+from urllib.parse import urlsplit
+
+# Days after the end of a period during which Azure may still update its cost
+SETTLE_DAYS = 3
+
+# Function to check whether the cost of a period ending on `end_date` (a date or an ISO date string) is final: the
+# period ended more than `settle_days` ago. Used for the cache TTL and to reuse the billing account summary of a month
+def period_closed(end_date, settle_days=SETTLE_DAYS):
+    if isinstance(end_date, str):
+        end_date = date.fromisoformat(end_date[:10])
+    return end_date + timedelta(days=settle_days) < date.today()
+
+# On-disk cache of the Cost Management query responses.
+# An entry holds every page of a query (the first page and the pages of its nextLink chain), keyed by the scope of the
+# query, its timePeriod and a hash of the request body, in a folder per scope. nextLink URLs carry a skiptoken only valid for a while, so pages
+# are never cached on their own: an entry is only written once the whole chain has been retrieved.
+# Queries of a closed month are kept for `closed_ttl` seconds, the others (current month) for `open_ttl` seconds.
+# The least recently used entries are evicted once the cache exceeds `max_bytes`.
+class ResponseCache:
+    def __init__(self, cache_dir, closed_ttl=30 * 86400, open_ttl=3600, max_bytes=2 * 1024 ** 3, settle_days=SETTLE_DAYS, bypass=False):
+        self.cache_dir = cache_dir
+        self.closed_ttl = closed_ttl
+        self.open_ttl = open_ttl
+        self.max_bytes = max_bytes
+        # Days after the end of a period during which Azure may still update its cost, so it isn't closed yet
+        self.settle_days = settle_days
+        # Don't read the cache, but still refresh it with the responses of the API
+        self.bypass = bypass
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._total_bytes = None
+
+    # Function to build the key of a query: its scope (the URL path), its timePeriod and the hash of its body
+    def key(self, url, body):
+        time_period = body.get('timePeriod') or {}
+        body_hash = hashlib.sha256(json.dumps(body, sort_keys=True).encode('utf-8')).hexdigest()
+        scope = urlsplit(url).path.lower()
+        return hashlib.sha256(f"{scope}|{time_period.get('from')}|{time_period.get('to')}|{body_hash}".encode('utf-8')).hexdigest()
+
+    # Function to choose the time to live of a query from the end of its period
+    def ttl(self, body):
+        end_date = (body.get('timePeriod') or {}).get('to')
+        if end_date and period_closed(end_date, self.settle_days):
+            return self.closed_ttl
+        return self.open_ttl
+
+    # Function to return the folder of the entries of a scope, e.g. all the queries of a subscription
+    def _scope_dir(self, url):
+        scope = urlsplit(url).path.lower()
+        return os.path.join(self.cache_dir, hashlib.sha256(scope.encode('utf-8')).hexdigest()[:16])
+
+    def _path(self, url, body):
+        return os.path.join(self._scope_dir(url), self.key(url, body) + '.ndjson')
+
+    # Function to read the pages cached for a query. Returns None if the query isn't cached (or has expired),
+    # otherwise a generator of the response pages. The entry is read from the file opened here, so an eviction by
+    # another thread once the entry was found doesn't affect the pages being read
+    def get(self, url, body):
+        if self.bypass:
+            return None
+        path = self._path(url, body)
+        file = None
+        try:
+            file = open(path, 'r')
+            header = json.loads(file.readline())
+            if header['expires'] < time.time():
+                file.close()
+                self._remove(path)
+                file = None
+            else:
+                # Mark the entry as recently used for the eviction
+                os.utime(path)
+        except (OSError, ValueError):
+            # Missing or incomplete entry, or evicted since it was opened
+            if file is not None:
+                file.close()
+                file = None
+        if file is None:
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return self._iter_pages(file)
+
+    def _iter_pages(self, file):
+        with file:
+            for line in file:
+                yield json.loads(line)
+
+    # Function to start a new entry for a query. Pages are added as they are retrieved and the entry is only
+    # visible to `get` once committed
+    def open_entry(self, url, body):
+        return CacheEntry(self, self._path(url, body), url, body)
+
+    # Function to cache the single page response of a query
+    def put(self, url, body, page):
+        with self.open_entry(url, body) as entry:
+            entry.add_page(page)
+
+    # Function to drop the cached pages of a query, e.g. before extracting a subscription again
+    def invalidate(self, url, body):
+        self._remove(self._path(url, body))
+
+    # Function to drop the cached pages of all the queries of a scope whose timePeriod overlaps the period from
+    # `start_date` to `end_date` (ISO dates), whatever their body: e.g. the probe and partition queries of a subscription
+    def invalidate_period(self, url, start_date, end_date):
+        scope_dir = self._scope_dir(url)
+        if not os.path.isdir(scope_dir):
+            return
+        for file_name in os.listdir(scope_dir):
+            if not file_name.endswith('.ndjson'):
+                continue
+            path = os.path.join(scope_dir, file_name)
+            try:
+                with open(path, 'r') as file:
+                    time_period = json.loads(file.readline()).get('timePeriod') or {}
+            except (OSError, ValueError):
+                continue
+            period_from = (time_period.get('from') or '')[:10]
+            period_to = (time_period.get('to') or '')[:10]
+            if period_from <= end_date[:10] and period_to >= start_date[:10]:
+                self._remove(path)
+
+    def _remove(self, path):
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except OSError:
+            return
+        with self._lock:
+            if self._total_bytes is not None:
+                self._total_bytes -= size
+
+    # Function to list the cache entries as (last use, size, path)
+    def _entries(self):
+        entries = []
+        for root, _, files in os.walk(self.cache_dir):
+            for file in files:
+                if file.endswith('.ndjson'):
+                    path = os.path.join(root, file)
+                    try:
+                        stat = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    # Function to account for a committed entry and evict the least recently used entries above max_bytes.
+    # The size of the cache is only measured by listing the folder once, then kept up to date
+    def _added(self, size):
+        with self._lock:
+            if self._total_bytes is None:
+                self._total_bytes = sum(entry_size for _, entry_size, _ in self._entries())
+            else:
+                self._total_bytes += size
+            if self._total_bytes <= self.max_bytes:
+                return
+            for _, entry_size, path in sorted(self._entries()):
+                if self._total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    continue
+                self._total_bytes -= entry_size
+
+    # Function to return the counters of the cache
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'bytes': self._total_bytes}
+
+# Entry being written to the cache, committed with `commit` (or when leaving the `with` block without an error)
+class CacheEntry:
+    def __init__(self, cache, path, url, body):
+        self.cache = cache
+        self.path = path
+        self.temp_path = f'{path}.{threading.get_ident()}.tmp'
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._file = open(self.temp_path, 'w')
+        header = {'url': urlsplit(url).path, 'timePeriod': body.get('timePeriod'), 'expires': time.time() + cache.ttl(body)}
+        self._file.write(json.dumps(header) + '\n')
+
+    def add_page(self, page):
+        self._file.write(json.dumps(page) + '\n')
+
+    def commit(self):
+        self._file.close()
+        size = os.path.getsize(self.temp_path)
+        os.replace(self.temp_path, self.path)
+        self.cache._added(size)
+
+    # Function to drop an incomplete entry, e.g. when a page of the chain failed
+    def abort(self):
+        if not self._file.closed:
+            self._file.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.commit()
+        else:
+            self.abort()
+        return False
@@ -0,0 +1,109 @@
+import os
+import time
+import threading
+import logging
+import requests
+from requests.adapters import HTTPAdapter
+# Import custom modules
+import rate_limiter
+import cost_metrics
+
+log = logging.getLogger('cost_client')
+
+# Azure AD endpoint of the tokens, can be pointed at a local mock (see benchmark.py)
+login_endpoint = os.getenv('AZURE_LOGIN_ENDPOINT', 'https://login.microsoftonline.com')
+token_url_template = login_endpoint + '/{tenant_id}/oauth2/token'
+management_resource = 'https://management.azure.com/'
+
+# Thread-safe holder of the OAuth 2.0 token shared by all the Cost Management requests.
+# The token is refreshed proactively `refresh_margin` seconds before the `expires_on` returned by Azure AD.
+class TokenManager:
+    def __init__(self, tenant_id, client_id, client_secret, session=None, refresh_margin=300):
+        self.tenant_id = tenant_id
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.session = session or requests.Session()
+        self.refresh_margin = refresh_margin
+        self._lock = threading.Lock()
+        self._access_token = None
+        self._expires_on = 0.0
+
+    # Function to obtain a new OAuth 2.0 token
+    def _request_token(self):
+        token_data = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'resource': management_resource
+        }
+        token_r = self.session.post(token_url_template.format(tenant_id=self.tenant_id), data=token_data)
+        token_r.raise_for_status()
+        token = token_r.json()
+        self._access_token = token.get('access_token')
+        if token.get('expires_on'):
+            self._expires_on = float(token['expires_on'])
+        else:
+            self._expires_on = time.time() + float(token.get('expires_in', 3600))
+
+    # Return a valid access token, refreshing it if it is about to expire.
+    # `expired_token` forces a refresh when a request was rejected with that token, unless another thread already replaced it
+    def get_token(self, expired_token=None):
+        with self._lock:
+            if (self._access_token is None
+                    or time.time() >= self._expires_on - self.refresh_margin
+                    or (expired_token is not None and expired_token == self._access_token)):
+                self._request_token()
+            return self._access_token
+
+    # Return the access token if it doesn't need to be refreshed, without blocking on Azure AD (None otherwise)
+    def current_token(self):
+        with self._lock:
+            if self._access_token is not None and time.time() < self._expires_on - self.refresh_margin:
+                return self._access_token
+            return None
+
+# Client used for all the Cost Management calls. It keeps a pool of keep-alive connections to
+# management.azure.com, requests gzip responses, injects the shared token and retries throttled
+# (429) and expired token (401) responses through the shared request scheduler.
+class CostManagementClient:
+    def __init__(self, token_manager, scheduler=None, pool_size=10):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.session.headers.update({
+            'Content-Type': 'application/json',
+            'Accept-Encoding': 'gzip, deflate'
+        })
+        self.token_manager = token_manager
+        self.scheduler = scheduler or rate_limiter.RequestScheduler()
+
+    # Function to post a query with retries. Progress messages also go to the subscription `log_file` when given
+    def post(self, url, body, headers=None, max_retries=10, log_file=None):
+        for attempt in range(max_retries):
+            # Wait for the shared scheduler (pacing and any active rate limit cooldown)
+            with cost_metrics.metrics.timer('api_scheduler_wait_seconds'):
+                self.scheduler.acquire()
+            access_token = self.token_manager.get_token()
+            request_headers = {'Authorization': f'Bearer {access_token}'}
+            if headers:
+                request_headers.update(headers)
+            request_start = time.perf_counter()
+            response = self.session.post(url, headers=request_headers, json=body)
+            cost_metrics.metrics.observe('api_request_seconds', time.perf_counter() - request_start, status=response.status_code)
+            cost_metrics.metrics.increment('api_response_bytes_total', len(response.content or b''))
+            if response.status_code == 429:
+                # Too many requests, pause all the workers for as long as the API asks. The wait happens before the next attempt
+                wait_time = self.scheduler.on_throttled(response.headers)
+                retry_after = rate_limiter.parse_retry_after(response.headers)
+                log.warning(f"Rate limit exceeded. Retrying in {wait_time} seconds... {retry_after}", extra={'status': 429, 'attempt': attempt + 1, 'wait': wait_time, 'log_file': log_file})
+                cost_metrics.metrics.increment('api_retries_total', reason='throttled')
+            elif response.status_code == 401 and "ExpiredAuthenticationToken" in response.text:
+                # Refresh the access token if expired
+                self.token_manager.get_token(expired_token=access_token)
+                log.info("Access token expired. Obtained new token", extra={'status': 401, 'attempt': attempt + 1, 'log_file': log_file})
+                cost_metrics.metrics.increment('api_retries_total', reason='token_expired')
+            else:
+                self.scheduler.on_success()
+                return response
+        raise Exception("Max retries exceeded")
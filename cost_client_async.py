@@ -0,0 +1,111 @@
+import json
+import time
+import asyncio
+import logging
+# aiohttp is only needed by the asyncio backend (FINOPS_BACKEND=async)
+try:
+    import aiohttp
+    from multidict import CIMultiDict
+except ImportError:
+    aiohttp = None
+    CIMultiDict = dict
+# Import custom modules
+import rate_limiter
+import cost_metrics
+
+log = logging.getLogger('cost_client')
+
+# Function to check that aiohttp is available for the asyncio backend
+def require_aiohttp():
+    if aiohttp is None:
+        raise ImportError("The async backend requires aiohttp (pip install aiohttp)")
+
+# Response of the asyncio client, read in full before the connection goes back to the pool. It has the attributes of
+# requests.Response used by the extractor, so that both clients' responses go through the same code
+class CostResponse:
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+# asyncio counterpart of cost_client.CostManagementClient: the queries of hundreds of subscriptions are multiplexed
+# on one event loop over a pool of `pool_size` keep-alive connections instead of one thread per subscription.
+# The token manager and the request scheduler are the ones of the threaded client, so both can be used in the same run
+class AsyncCostManagementClient:
+    def __init__(self, token_manager, scheduler=None, pool_size=100, read_timeout=300):
+        require_aiohttp()
+        self.token_manager = token_manager
+        self.scheduler = scheduler or rate_limiter.RequestScheduler()
+        self.pool_size = pool_size
+        self.read_timeout = read_timeout
+        # The session is bound to the event loop, it's created by the first request
+        self.session = None
+
+    def _open_session(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        self.session = aiohttp.ClientSession(
+            connector=connector,
+            headers={'Content-Type': 'application/json', 'Accept-Encoding': 'gzip, deflate'},
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=self.read_timeout)
+        )
+
+    # Function to return a valid access token. The token manager only blocks when the token must be refreshed,
+    # that request is then made in a thread
+    async def _get_token(self, expired_token=None):
+        if expired_token is None:
+            access_token = self.token_manager.current_token()
+            if access_token is not None:
+                return access_token
+        return await asyncio.to_thread(self.token_manager.get_token, expired_token)
+
+    # Function to post a query with retries. Progress messages also go to the subscription `log_file` when given
+    async def post(self, url, body, headers=None, max_retries=10, log_file=None):
+        if self.session is None:
+            self._open_session()
+        for attempt in range(max_retries):
+            # Wait for the shared scheduler (pacing and any active rate limit cooldown)
+            with cost_metrics.metrics.timer('api_scheduler_wait_seconds'):
+                await self.scheduler.acquire_async()
+            access_token = await self._get_token()
+            request_headers = {'Authorization': f'Bearer {access_token}'}
+            if headers:
+                request_headers.update(headers)
+            request_start = time.perf_counter()
+            async with self.session.post(url, headers=request_headers, json=body) as http_response:
+                response = CostResponse(http_response.status, CIMultiDict(http_response.headers), await http_response.read())
+            cost_metrics.metrics.observe('api_request_seconds', time.perf_counter() - request_start, status=response.status_code)
+            cost_metrics.metrics.increment('api_response_bytes_total', len(response.content))
+            if response.status_code == 429:
+                # Too many requests, pause all the requests for as long as the API asks. The wait happens before the next attempt
+                wait_time = self.scheduler.on_throttled(response.headers)
+                retry_after = rate_limiter.parse_retry_after(response.headers)
+                log.warning(f"Rate limit exceeded. Retrying in {wait_time} seconds... {retry_after}", extra={'status': 429, 'attempt': attempt + 1, 'wait': wait_time, 'log_file': log_file})
+                cost_metrics.metrics.increment('api_retries_total', reason='throttled')
+            elif response.status_code == 401 and "ExpiredAuthenticationToken" in response.text:
+                # Refresh the access token if expired
+                await self._get_token(expired_token=access_token)
+                log.info("Access token expired. Obtained new token", extra={'status': 401, 'attempt': attempt + 1, 'log_file': log_file})
+                cost_metrics.metrics.increment('api_retries_total', reason='token_expired')
+            else:
+                self.scheduler.on_success()
+                return response
+        raise Exception("Max retries exceeded")
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.close()
+        return False
@@ -0,0 +1,122 @@
+import os
+import sys
+import json
+import queue
+import atexit
+import logging
+import logging.handlers
+from collections import OrderedDict
+from datetime import datetime
+
+# Structured fields of the log records, given with `extra=` or bound with `bind`
+FIELDS = ('subscription', 'month', 'file', 'page', 'rows', 'total_cost', 'elapsed', 'status', 'attempt', 'wait')
+
+# Formatter writing each record as a JSON line with its structured fields
+class JsonLinesFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage()
+        }
+        for field in FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        return json.dumps(entry, default=str)
+
+# Handler writing the records that carry a `log_file` attribute (e.g. the process_log_<subscription>.txt files) to that file.
+# Files are kept open with a write buffer instead of being opened for every message; only the `max_open` most recently
+# used files stay open. It only runs on the listener thread, so the files are never written concurrently
+class LogFileHandler(logging.Handler):
+    def __init__(self, max_open=64, buffer_size=64 * 1024):
+        super().__init__()
+        self.max_open = max_open
+        self.buffer_size = buffer_size
+        self._files = OrderedDict()
+
+    def emit(self, record):
+        log_file = getattr(record, 'log_file', None)
+        if not log_file:
+            return
+        try:
+            file = self._files.pop(log_file, None)
+            if file is None:
+                if len(self._files) >= self.max_open:
+                    _, oldest = self._files.popitem(last=False)
+                    oldest.close()
+                file = open(log_file, 'a', buffering=self.buffer_size)
+            self._files[log_file] = file
+            file.write(self.format(record) + '\n')
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        for file in self._files.values():
+            file.flush()
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        self._files.clear()
+        super().close()
+
+# Logger adapter adding bound fields (subscription, month, log_file...) to every record, merged with the `extra` of the call
+class ContextLogger(logging.LoggerAdapter):
+    def process(self, msg, kwargs):
+        kwargs['extra'] = {**self.extra, **kwargs.get('extra', {})}
+        return msg, kwargs
+
+# Function to get a logger whose records carry the given fields
+def bind(logger, **fields):
+    if isinstance(logger, str):
+        logger = logging.getLogger(logger)
+    if isinstance(logger, ContextLogger):
+        return ContextLogger(logger.logger, {**logger.extra, **fields})
+    return ContextLogger(logger, fields)
+
+_listener = None
+
+# Function to set up the logging of a script. Records are put on a queue by the calling threads and written by a single
+# listener thread to the console (plain message, replacing print), to `log_file` as JSON lines (buffered up to
+# `buffer_size` records, flushed at once on warnings and errors) and to the per-subscription log files
+def setup_logging(log_file=None, level=logging.INFO, console=True, buffer_size=1000):
+    global _listener
+    if _listener is not None:
+        return
+
+    handlers = []
+    if console:
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(logging.Formatter('%(message)s'))
+        handlers.append(console_handler)
+    if log_file:
+        if os.path.dirname(log_file):
+            os.makedirs(os.path.dirname(log_file), exist_ok=True)
+        file_handler = logging.FileHandler(log_file)
+        file_handler.setFormatter(JsonLinesFormatter())
+        handlers.append(logging.handlers.MemoryHandler(buffer_size, flushLevel=logging.WARNING, target=file_handler))
+    log_file_handler = LogFileHandler()
+    log_file_handler.setFormatter(logging.Formatter('%(message)s'))
+    handlers.append(log_file_handler)
+
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+    _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+
+# Function to write the queued records and close the log files (also called at exit)
+def shutdown_logging():
+    global _listener
+    if _listener is None:
+        return
+    _listener.stop()
+    for handler in _listener.handlers:
+        handler.flush()
+        handler.close()
+    _listener = None
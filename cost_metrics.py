@@ -0,0 +1,173 @@
+import os
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+# Upper bounds (seconds) of the latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, math.inf)
+
+# Latency histogram of one metric and label set
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.min = math.inf
+        self.max = 0.0
+
+    def observe(self, value):
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += value
+        self.min = min(self.min, value)
+        self.max = max(self.max, value)
+
+    # Function to estimate a quantile as the upper bound of the bucket holding it (the maximum for the last bucket)
+    def quantile(self, q):
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'count': self.count,
+            'sum': round(self.sum, 6),
+            'min': round(self.min, 6) if self.count else None,
+            'max': round(self.max, 6),
+            'p50': round(self.quantile(0.5), 6) if self.count else None,
+            'p95': round(self.quantile(0.95), 6) if self.count else None,
+            'p99': round(self.quantile(0.99), 6) if self.count else None
+        }
+
+# Thread-safe registry of the counters and latency histograms of a run, with labels such as subscription and month.
+# Counters named <stage>_rows_total are reported with the rows/sec of the <stage>_*_seconds histograms of the same labels
+class Metrics:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self.started = time.time()
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+    def increment(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(seconds)
+
+    # Context manager observing the time spent in its block
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    # Function to clear the metrics, e.g. between the runs of a benchmark
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+            self.started = time.time()
+
+    # Function to build the run summary: counters, histograms and rows/sec per stage and label set
+    def summary(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: histogram.summary() for key, histogram in self._histograms.items()}
+
+        throughput = []
+        for (name, labels), rows in counters.items():
+            if not name.endswith('_rows_total'):
+                continue
+            stage = name[:-len('_rows_total')]
+            seconds = sum(histogram['sum'] for (histogram_name, histogram_labels), histogram in histograms.items()
+                          if histogram_name.startswith(stage + '_') and histogram_name.endswith('_seconds') and histogram_labels == labels)
+            throughput.append({'stage': stage, **dict(labels), 'rows': rows, 'seconds': round(seconds, 3), 'rows_per_second': round(rows / seconds, 1) if seconds else None})
+        throughput.sort(key=lambda entry: entry['seconds'], reverse=True)
+
+        return {
+            'started': datetime.fromtimestamp(self.started).isoformat(timespec='seconds'),
+            'elapsed': round(time.time() - self.started, 3),
+            'counters': [{'name': name, **dict(labels), 'value': value} for (name, labels), value in sorted(counters.items())],
+            'histograms': [{'name': name, **dict(labels), **histogram} for (name, labels), histogram in sorted(histograms.items())],
+            # Slowest stages first, to spot the hot subscriptions and months
+            'throughput': throughput
+        }
+
+    # Function to write the run summary as JSON
+    def write_summary(self, file_path):
+        if os.path.dirname(file_path):
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, 'w') as file:
+            json.dump(self.summary(), file, indent=4)
+
+    # Function to write the metrics in the Prometheus text format (e.g. for the node_exporter textfile collector)
+    def write_prometheus(self, file_path, prefix='finops_'):
+        # Function to format the labels, escaping the label values as the text format requires
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ''
+            escaped = (value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+            return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(pairs, escaped)) + '}'
+
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted(self._histograms.items(), key=lambda item: item[0])
+            lines = []
+            typed = set()
+            for (name, labels), value in counters:
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} counter')
+                    typed.add(name)
+                lines.append(f'{prefix}{name}{format_labels(labels)} {value}')
+            for (name, labels), histogram in histograms:
+                if name not in typed:
+                    lines.append(f'# TYPE {prefix}{name} histogram')
+                    typed.add(name)
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == math.inf else repr(float(bound))
+                    lines.append(f'{prefix}{name}_bucket{format_labels(labels, [("le", le)])} {cumulative}')
+                lines.append(f'{prefix}{name}_sum{format_labels(labels)} {histogram.sum}')
+                lines.append(f'{prefix}{name}_count{format_labels(labels)} {histogram.count}')
+
+        # Write to a temporary file first so that a collector never reads a partial file
+        with open(file_path + '.tmp', 'w') as file:
+            file.write('\n'.join(lines) + '\n')
+        os.replace(file_path + '.tmp', file_path)
+
+# Registry shared by all the modules of a run
+metrics = Metrics()
+
+# Function to write the run summary and, when a file is given, the Prometheus metrics at the end of a script
+def write_run_report(summary_file, prometheus_file=None):
+    metrics.write_summary(summary_file)
+    if prometheus_file:
+        metrics.write_prometheus(prometheus_file)
@@ -0,0 +1,425 @@
+import os
+import re
+import json
+import codecs
+
+# pyarrow is only required for the parquet output format
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# Output formats supported for the per-subscription cost data files
+# json    - a single JSON array of rows (original format), each page is appended before the closing bracket
+# ndjson  - one JSON row per line, appended and flushed as each page arrives
+# parquet - columnar file with dictionary-encoded string columns, one row group per page (requires pyarrow)
+OUTPUT_FORMAT_JSON = 'json'
+OUTPUT_FORMAT_NDJSON = 'ndjson'
+OUTPUT_FORMAT_PARQUET = 'parquet'
+OUTPUT_FORMATS = (OUTPUT_FORMAT_JSON, OUTPUT_FORMAT_NDJSON, OUTPUT_FORMAT_PARQUET)
+
+# Columns of the rows returned by the cost query of get_cost_data_with_pagination_retries,
+# used when the column names of the API response aren't passed to the writer
+COST_DATA_COLUMNS = [
+    'PreTaxCost', 'SubscriptionName', 'ResourceGroup', 'ResourceId', 'ConsumedService', 'MeterSubcategory',
+    'MeterCategory', 'ResourceLocation', 'BillingMonth', 'TagKey', 'TagValue', 'Currency'
+]
+# Numeric columns of the cost queries, all the other columns are stored as dictionary-encoded strings
+NUMERIC_COLUMNS = {'PreTaxCost': 'float64', 'Cost': 'float64', 'PreTaxCostUSD': 'float64', 'CostUSD': 'float64', 'UsageDate': 'int64'}
+
+# Function to check that pyarrow is available for the parquet format
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("The parquet output format requires pyarrow (pip install pyarrow)")
+
+# Function to sanitize file names by removing invalid characters
+def sanitize_filename(name):
+    return re.sub(r'[\/:*?"<>|]', '_', name)
+
+# Function to build the name of the cost data file of a subscription for the given output format
+def cost_data_file_name(output_dir, subscription_name, month_name, year, output_format=OUTPUT_FORMAT_JSON):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format '{output_format}'. Expected one of {OUTPUT_FORMATS}")
+    return os.path.join(output_dir, f'azure_cost_data_{subscription_name}_{month_name}{year}.{output_format}')
+
+# Function to split the name of a cost data file into (subscription name, month name, year, output format).
+# Returns None for other files
+def parse_cost_data_file_name(file_name):
+    match = re.match(r'^azure_cost_data_(.+)_([A-Z][a-z]{2})(\d{4})\.(' + '|'.join(OUTPUT_FORMATS) + r')$', os.path.basename(file_name))
+    if not match:
+        return None
+    return match.group(1), match.group(2), int(match.group(3)), match.group(4)
+
+# Function to detect the output format of a cost data file from its extension
+def cost_data_file_format(file_path):
+    if file_path.endswith('.' + OUTPUT_FORMAT_NDJSON):
+        return OUTPUT_FORMAT_NDJSON
+    if file_path.endswith('.' + OUTPUT_FORMAT_PARQUET):
+        return OUTPUT_FORMAT_PARQUET
+    return OUTPUT_FORMAT_JSON
+
+# Function to build the arrow schema of the cost data columns: float64 cost, dictionary-encoded strings
+def cost_data_schema(columns):
+    require_pyarrow()
+    fields = []
+    for column in columns:
+        if column in NUMERIC_COLUMNS:
+            fields.append(pa.field(column, pa.type_for_alias(NUMERIC_COLUMNS[column])))
+        else:
+            fields.append(pa.field(column, pa.dictionary(pa.int32(), pa.string())))
+    return pa.schema(fields)
+
+# Function to convert a page of positional rows to an arrow table
+def rows_to_table(rows, schema):
+    arrays = []
+    for position, field in enumerate(schema):
+        values = [row[position] for row in rows]
+        if pa.types.is_dictionary(field.type):
+            values = [None if value is None else str(value) for value in values]
+            arrays.append(pa.array(values, type=pa.string()).dictionary_encode().cast(field.type))
+        else:
+            arrays.append(pa.array(values, type=field.type))
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+# Function to format a row of a json array file as json.dump(rows, f, indent=4) does
+def format_json_row(row):
+    if not row:
+        return '[]'
+    return '[\n        ' + ',\n        '.join(json.dumps(value) for value in row) + '\n    ]'
+
+# Function to check whether a file name is a cost data file (and not e.g. its byte-offset index)
+def is_cost_data_file(file_name):
+    return file_name.startswith('azure_cost_data') and file_name.endswith(tuple('.' + output_format for output_format in OUTPUT_FORMATS))
+
+# Writer for the cost data pages returned by the Cost Management API.
+# Each page is written once and only the running totals are kept in memory: in json format the page is appended in place
+# of the closing bracket of the array, which is written again after it.
+# Parquet files are written to '<file>.partial' and renamed when closed, as they can't be read before their footer is written.
+class CostDataWriter:
+    def __init__(self, file_path, output_format=OUTPUT_FORMAT_JSON):
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported output format '{output_format}'. Expected one of {OUTPUT_FORMATS}")
+        if output_format == OUTPUT_FORMAT_PARQUET:
+            require_pyarrow()
+        self.file_path = file_path
+        self.output_format = output_format
+        self.row_count = 0
+        self.total_cost = 0.0
+        self._file = None
+        # Byte offset of the closing bracket of the json array, where the next page is written
+        self._json_end = None
+        self._parquet_writer = None
+
+    # Function to open the parquet writer with the schema of the first page
+    def _open_parquet_writer(self, schema):
+        self._parquet_writer = pq.ParquetWriter(self.file_path + '.partial', schema, use_dictionary=True, compression='snappy')
+
+    # `columns` are the column names of the API response, only used by the parquet format
+    def write_page(self, rows, columns=None):
+        if self.output_format == OUTPUT_FORMAT_NDJSON:
+            # Open lazily so that a failed first request doesn't leave an empty file behind
+            if self._file is None:
+                self._file = open(self.file_path, 'w')
+            self._file.write(''.join(json.dumps(row) + '\n' for row in rows))
+            self._file.flush()
+        elif self.output_format == OUTPUT_FORMAT_PARQUET:
+            if self._parquet_writer is None:
+                if columns is None:
+                    columns = COST_DATA_COLUMNS[:len(rows[0])] if rows else COST_DATA_COLUMNS
+                self._open_parquet_writer(cost_data_schema(columns))
+            if rows:
+                self._parquet_writer.write_table(rows_to_table(rows, self._parquet_writer.schema))
+        else:
+            self._write_json_rows(rows)
+
+        self.row_count += len(rows)
+        self.total_cost += sum(float(row[0]) for row in rows)
+
+    # Function to add rows to the json array, with the same layout as json.dump(rows, f, indent=4). The rows overwrite the
+    # closing bracket, which is written again after them, so the file is a valid array after every page
+    def _write_json_rows(self, rows):
+        if self._file is None:
+            self._file = open(self.file_path, 'wb')
+        text = ',\n    '.join(format_json_row(row) for row in rows)
+        if self._json_end is None:
+            # First page: start the array, or write an empty array until rows arrive
+            self._file.seek(0)
+            self._file.truncate()
+            self._file.write(('[\n    ' + text + '\n]' if rows else '[]').encode('utf-8'))
+            self._json_end = self._file.tell() - 2 if rows else None
+        elif rows:
+            self._file.seek(self._json_end)
+            self._file.write((',\n    ' + text + '\n]').encode('utf-8'))
+            self._json_end = self._file.tell() - 2
+        self._file.flush()
+
+    # Continue an existing file after its first `row_count` rows (whose cost adds up to `total_cost`).
+    # Rows written after the last checkpoint are dropped so that they aren't duplicated when the page is fetched again
+    def resume(self, row_count, total_cost):
+        if self.output_format == OUTPUT_FORMAT_NDJSON:
+            with open(self.file_path, 'rb') as f:
+                offset = 0
+                for _ in range(row_count):
+                    line = f.readline()
+                    if not line:
+                        raise ValueError(f"{self.file_path} has fewer than {row_count} rows")
+                    offset += len(line)
+            self._file = open(self.file_path, 'r+')
+            self._file.truncate(offset)
+            self._file.seek(offset)
+        elif self.output_format == OUTPUT_FORMAT_PARQUET:
+            # Parquet files can't be appended to: copy the first row_count rows into a new file, one batch at a time
+            parquet_file = pq.ParquetFile(self.file_path)
+            self._open_parquet_writer(parquet_file.schema_arrow)
+            copied_rows = 0
+            for batch in parquet_file.iter_batches():
+                batch = batch.slice(0, row_count - copied_rows)
+                self._parquet_writer.write_table(pa.Table.from_batches([batch]))
+                copied_rows += batch.num_rows
+                if copied_rows == row_count:
+                    break
+            if copied_rows < row_count:
+                raise ValueError(f"{self.file_path} has fewer than {row_count} rows")
+        else:
+            # Cut the array after its first row_count rows and close it again, the next page is appended from there
+            end = json_array_rows_end(self.file_path, row_count)
+            self._file = open(self.file_path, 'r+b')
+            if row_count:
+                self._file.truncate(end)
+                self._file.seek(end)
+                self._file.write(b'\n]')
+                self._file.flush()
+                self._json_end = end
+            else:
+                self._file.truncate(0)
+                self._file.write(b'[]')
+                self._file.flush()
+                self._json_end = None
+
+        self.row_count = row_count
+        self.total_cost = total_cost
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+            os.replace(self.file_path + '.partial', self.file_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+# Rows between two entries of the byte-offset index of a cost data file (aligned with the 5000-row SQL commits)
+INDEX_INTERVAL = 5000
+# Size of the chunks read when parsing json array files
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Function to build the name of the byte-offset index file of a cost data file
+def cost_data_index_file_name(file_path):
+    return file_path + '.idx'
+
+# Function to load the byte-offset index of a cost data file. The index is ignored if the file changed since it was built
+def load_cost_data_index(file_path):
+    index_file = cost_data_index_file_name(file_path)
+    if not os.path.exists(index_file):
+        return None
+    try:
+        with open(index_file, 'r') as f:
+            index = json.load(f)
+    except ValueError:
+        return None
+    stat = os.stat(file_path)
+    if index.get('size') != stat.st_size or index.get('mtime') != stat.st_mtime or index.get('interval') != INDEX_INTERVAL:
+        return None
+    return index
+
+# Function to save the byte-offset index of a cost data file: offsets[i] is the position of row i * INDEX_INTERVAL
+def save_cost_data_index(file_path, offsets):
+    stat = os.stat(file_path)
+    index = {'size': stat.st_size, 'mtime': stat.st_mtime, 'interval': INDEX_INTERVAL, 'offsets': offsets}
+    index_file = cost_data_index_file_name(file_path)
+    with open(index_file + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(index_file + '.tmp', index_file)
+
+# Generator of (byte offset, line) for the rows of an ndjson file, starting at `offset`
+def _iter_ndjson_rows(f, offset):
+    f.seek(offset)
+    while True:
+        line = f.readline()
+        if not line:
+            return
+        if line.strip():
+            yield offset, line
+        offset += len(line)
+
+# Generator of (byte offset, record) for the rows of a json array file, starting at `offset`
+# The array is parsed incrementally, a chunk at a time, so only the current chunk is kept in memory
+def _iter_json_array_rows(f, offset):
+    decoder = json.JSONDecoder()
+    text_decoder = codecs.getincrementaldecoder('utf-8')()
+    f.seek(offset)
+    buffer = ''
+    position = 0
+    eof = False
+    # Byte offset in the file of buffer[measured_position], advanced incrementally so each character is measured once
+    measured_position = 0
+    measured_offset = offset
+
+    # Function to convert a position in the buffer to a byte offset in the file
+    def byte_offset(pos):
+        nonlocal measured_position, measured_offset
+        segment = buffer[measured_position:pos]
+        measured_offset += len(segment) if segment.isascii() else len(segment.encode('utf-8'))
+        measured_position = pos
+        return measured_offset
+
+    def read_chunk():
+        nonlocal buffer, position, measured_position, eof
+        # Drop the part of the buffer which has already been parsed
+        byte_offset(position)
+        buffer = buffer[position:]
+        position = 0
+        measured_position = 0
+        chunk = f.read(READ_CHUNK_SIZE)
+        if not chunk:
+            eof = True
+        buffer += text_decoder.decode(chunk, final=eof)
+
+    started = offset > 0
+    while True:
+        # Skip the separators between the rows
+        while position < len(buffer) and (buffer[position].isspace() or buffer[position] == ','):
+            position += 1
+        if position >= len(buffer):
+            if eof:
+                if started:
+                    raise ValueError(f"Unexpected end of file in {f.name}, the json array isn't closed")
+                return
+            read_chunk()
+            continue
+        if not started:
+            if buffer[position] != '[':
+                raise ValueError(f"{f.name} isn't a json array")
+            started = True
+            position += 1
+            continue
+        if buffer[position] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            # The row is split across two chunks
+            if eof:
+                raise
+            read_chunk()
+            continue
+        yield byte_offset(position), record
+        position = end
+
+# Function to return the byte offset of the end of the first `row_count` rows of a json array file (just after the
+# '[' when row_count is 0), seeking to the closest indexed row
+def json_array_rows_end(file_path, row_count):
+    index = load_cost_data_index(file_path)
+    offsets = index['offsets'] if index else [0]
+    index_position = min(row_count // INDEX_INTERVAL, len(offsets) - 1)
+    row = index_position * INDEX_INTERVAL
+    with open(file_path, 'rb') as f:
+        end = None
+        for offset, _ in _iter_json_array_rows(f, offsets[index_position]):
+            if row == row_count:
+                end = offset
+                break
+            row += 1
+        if row < row_count:
+            raise ValueError(f"{file_path} has fewer than {row_count} rows")
+        at_end = end is None
+        if at_end:
+            end = os.fstat(f.fileno()).st_size
+        # Walk back over the separator before the next row, or over the closing bracket
+        start = max(0, end - 64)
+        f.seek(start)
+        tail = f.read(end - start).rstrip()
+        if at_end and tail.endswith(b']'):
+            tail = tail[:-1]
+        return start + len(tail.rstrip(b' \t\r\n,'))
+
+# Generator of the records of a parquet file from row `start_row`. Whole row groups before start_row are skipped
+def _iter_parquet_records(file_path, start_row):
+    require_pyarrow()
+    parquet_file = pq.ParquetFile(file_path)
+    row = 0
+    for row_group in range(parquet_file.num_row_groups):
+        num_rows = parquet_file.metadata.row_group(row_group).num_rows
+        if row + num_rows <= start_row:
+            row += num_rows
+            continue
+        table = parquet_file.read_row_group(row_group)
+        if start_row > row:
+            table = table.slice(start_row - row)
+        columns = [column.to_pylist() for column in table.columns]
+        yield from (list(record) for record in zip(*columns))
+        row += num_rows
+
+# Function to read the columns of a cost data file as an arrow table, e.g. for local analysis.
+# Parquet files are memory-mapped and only the requested columns are read; json and ndjson files are converted
+def read_cost_table(file_path, columns=None):
+    require_pyarrow()
+    if cost_data_file_format(file_path) == OUTPUT_FORMAT_PARQUET:
+        return pq.read_table(file_path, columns=columns, memory_map=True)
+    schema = None
+    batches = []
+    page = []
+    for record in iter_cost_records(file_path):
+        page.append(record)
+        if len(page) == INDEX_INTERVAL:
+            schema = schema or cost_data_schema(COST_DATA_COLUMNS[:len(page[0])])
+            batches.append(rows_to_table(page, schema))
+            page = []
+    if page or schema is None:
+        schema = schema or cost_data_schema(COST_DATA_COLUMNS[:len(page[0])] if page else COST_DATA_COLUMNS)
+        batches.append(rows_to_table(page, schema))
+    table = pa.concat_tables(batches).unify_dictionaries()
+    return table.select(columns) if columns else table
+
+# Function to read the cost data records of a file written by CostDataWriter, starting at row `start_row`.
+# Both formats are parsed incrementally and the records are yielded lazily. A byte-offset index with the position
+# of every INDEX_INTERVAL-th row is saved next to the file, so resuming at a checkpointed row seeks straight to it.
+def iter_cost_records(file_path, start_row=0):
+    if cost_data_file_format(file_path) == OUTPUT_FORMAT_PARQUET:
+        # Parquet files are indexed by their row group metadata
+        yield from _iter_parquet_records(file_path, start_row)
+        return
+
+    ndjson = cost_data_file_format(file_path) == OUTPUT_FORMAT_NDJSON
+    index = load_cost_data_index(file_path)
+    offsets = index['offsets'] if index else [0]
+
+    # Seek to the closest indexed row before start_row
+    index_position = min(start_row // INDEX_INTERVAL, len(offsets) - 1)
+    row = index_position * INDEX_INTERVAL
+    index_changed = False
+
+    with open(file_path, 'rb') as f:
+        rows = _iter_ndjson_rows(f, offsets[index_position]) if ndjson else _iter_json_array_rows(f, offsets[index_position])
+        for offset, record in rows:
+            # Extend the index with the rows seen for the first time
+            if row % INDEX_INTERVAL == 0 and row // INDEX_INTERVAL == len(offsets):
+                offsets.append(offset)
+                index_changed = True
+            if row >= start_row:
+                if index_changed:
+                    save_cost_data_index(file_path, offsets)
+                    index_changed = False
+                yield json.loads(record) if ndjson else record
+            row += 1
+
+    if index_changed:
+        save_cost_data_index(file_path, offsets)
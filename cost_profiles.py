@@ -0,0 +1,124 @@
+import json
+import math
+
+# Extraction profiles: the grouping (dimensions and tag keys), the granularity and the aggregated cost column (metric) of
+# the subscription cost queries. The finer the grouping, the more rows and pages per subscription: the 'resource' profile
+# (one row per resource, meter and cost center tag, the rows loaded into AzureResourceCost) can return hundreds of pages
+# where 'resource_group' returns a few rows. Granularity 'Daily' adds a UsageDate column and one row per day
+DEFAULT_PROFILE = 'resource'
+GRANULARITIES = ('None', 'Daily')
+DEFAULT_METRIC = 'PreTaxCost'
+
+PROFILES = {
+    'subscription': {'dimensions': ['SubscriptionName'], 'tag_keys': []},
+    'resource_group': {'dimensions': ['SubscriptionName', 'ResourceGroup'], 'tag_keys': []},
+    'resource_group_daily': {'dimensions': ['SubscriptionName', 'ResourceGroup'], 'tag_keys': [], 'granularity': 'Daily'},
+    'cost_center': {'dimensions': ['SubscriptionName', 'ResourceGroup'], 'tag_keys': ['costcenter']},
+    'service': {'dimensions': ['SubscriptionName', 'ResourceGroup', 'ConsumedService', 'MeterSubcategory', 'MeterCategory', 'ResourceLocation'], 'tag_keys': []},
+    'resource': {
+        'dimensions': ['SubscriptionName', 'ResourceGroup', 'ResourceId', 'ConsumedService', 'MeterSubcategory', 'MeterCategory', 'ResourceLocation', 'BillingMonth'],
+        'tag_keys': ['costcenter']
+    },
+}
+
+# Rows of a page of the Query API, used to estimate the pages of a query whose probe fit in a single page
+DEFAULT_PAGE_ROWS = 5000
+
+# Function to complete a profile with the default granularity and metric, and check it
+def normalize_profile(name, profile):
+    profile = {
+        'dimensions': list(profile.get('dimensions') or []),
+        'tag_keys': list(profile.get('tag_keys') or []),
+        'granularity': profile.get('granularity', 'None'),
+        'metric': profile.get('metric', DEFAULT_METRIC)
+    }
+    if profile['granularity'] not in GRANULARITIES:
+        raise ValueError(f"Unsupported granularity '{profile['granularity']}' in extraction profile '{name}'. Expected one of {GRANULARITIES}")
+    if not all(isinstance(value, str) for value in profile['dimensions'] + profile['tag_keys']):
+        raise ValueError(f"The dimensions and tag keys of extraction profile '{name}' must be names")
+    return profile
+
+# Function to load the built-in profiles and the ones of a JSON file ({"name": {"dimensions": [...], "tag_keys": [...],
+# "granularity": "None", "metric": "PreTaxCost"}}), which can also redefine the built-in profiles except 'resource'
+def load_profiles(profiles_file=None):
+    profiles = {name: normalize_profile(name, profile) for name, profile in PROFILES.items()}
+    if profiles_file:
+        with open(profiles_file, 'r') as file:
+            custom_profiles = json.load(file)
+        for name, profile in custom_profiles.items():
+            if name == DEFAULT_PROFILE:
+                raise ValueError(f"The '{DEFAULT_PROFILE}' profile can't be redefined, its rows are loaded into AzureResourceCost")
+            profiles[name] = normalize_profile(name, profile)
+    return profiles
+
+# Function to parse the columns needed by a report, e.g. 'ResourceGroup,MeterCategory,tag:costcenter', into
+# (dimensions, tag keys)
+def parse_report(spec):
+    dimensions, tag_keys = [], []
+    for item in (spec or '').split(','):
+        item = item.strip()
+        if item.lower().startswith('tag:'):
+            tag_keys.append(item[4:].strip())
+        elif item:
+            dimensions.append(item)
+    return dimensions, tag_keys
+
+# Function to check that the rows of a profile can produce a report: they're grouped by all the dimensions and tag keys
+# of the report, with the same metric. Daily rows can be summed up to a report over the whole period, not the other way
+def satisfies(profile, dimensions=(), tag_keys=(), granularity='None', metric=DEFAULT_METRIC):
+    profile_dimensions = {dimension.lower() for dimension in profile['dimensions']}
+    profile_tag_keys = {tag_key.lower() for tag_key in profile['tag_keys']}
+    return (all(dimension.lower() in profile_dimensions for dimension in dimensions)
+            and all(tag_key.lower() in profile_tag_keys for tag_key in tag_keys)
+            and (granularity == 'None' or profile['granularity'] == granularity)
+            and profile['metric'] == metric)
+
+# Weight of a profile to compare how coarse profiles are: daily rows first, then the number of grouping columns
+def profile_weight(profile):
+    return profile['granularity'] == 'Daily', len(profile['dimensions']) + len(profile['tag_keys'])
+
+# Function to choose the coarsest profile producing a report (see satisfies). Returns its name
+def choose_profile(profiles, dimensions=(), tag_keys=(), granularity='None', metric=DEFAULT_METRIC):
+    candidates = [name for name, profile in profiles.items() if satisfies(profile, dimensions, tag_keys, granularity, metric)]
+    if not candidates:
+        raise ValueError(f"No extraction profile groups by {list(dimensions) + ['tag:' + tag_key for tag_key in tag_keys]} with granularity {granularity} and metric {metric}")
+    return min(candidates, key=lambda name: (profile_weight(profiles[name]), name))
+
+# Function to build the request body of a subscription cost query with a profile. `granularity` overrides the one of
+# the profile (e.g. 'Daily' for the incremental extraction)
+def query_body(profile, start_date, end_date, granularity=None):
+    grouping = [{"type": "Dimension", "name": dimension} for dimension in profile['dimensions']]
+    grouping.extend({"type": "TagKey", "name": tag_key} for tag_key in profile['tag_keys'])
+    return {
+        "type": "Usage",
+        "timeframe": "Custom",
+        "timePeriod": {
+            "from": start_date,
+            "to": end_date
+        },
+        "dataset": {
+            "granularity": granularity or profile['granularity'],
+            "aggregation": {
+                "totalCost": {
+                    "name": profile['metric'],
+                    "function": "Sum"
+                }
+            },
+            "grouping": grouping
+        }
+    }
+
+# Function to estimate the rows and pages of a month query from a probe query of the same profile over `probe_days` of
+# the `days` of the month. `probe_rows` rows came in `probe_pages` pages; `complete` is False when the probe had more
+# pages, the estimate is then a lower bound. Daily rows scale with the days, the other rows are assumed to be the same
+# resources all month long
+def estimate_pages(profile, probe_rows, probe_pages, complete, probe_days, days, page_rows=None):
+    if not page_rows:
+        page_rows = math.ceil(probe_rows / probe_pages) if not complete and probe_rows else DEFAULT_PAGE_ROWS
+    rows = probe_rows * days / probe_days if profile['granularity'] == 'Daily' else probe_rows
+    rows = math.ceil(rows)
+    pages = max(1, math.ceil(rows / page_rows))
+    if not complete:
+        # The probe stopped with a nextLink left, so there's at least one more page
+        pages = max(pages, probe_pages + 1)
+    return {'rows': rows, 'pages': pages, 'lower_bound': not complete}
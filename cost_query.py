@@ -0,0 +1,141 @@
+import os
+import argparse
+import calendar
+import pandas as pd
+# Import custom modules
+import cost_output
+import finops_cost
+
+# pyarrow reads the cost data files of every format and runs the aggregations
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+except ImportError:
+    pa = None
+    pc = None
+
+# Folder containing the extracted cost data: output/<year>/<month>/
+base_folder = 'output'
+
+# Dimensions of the cost query that can be used to group or filter (the columns of the cost data files)
+DIMENSIONS = [
+    'SubscriptionName', 'ResourceGroup', 'ResourceId', 'ConsumedService', 'MeterSubcategory',
+    'MeterCategory', 'ResourceLocation', 'BillingMonth', 'TagKey', 'TagValue', 'Currency'
+]
+# Friendlier names of some columns, e.g. the value of the costcenter tag is stored in TagValue
+DIMENSION_ALIASES = {'costcenter': 'TagValue', 'CostCenter': 'TagValue', 'Location': 'ResourceLocation'}
+# Preferred format when a subscription month was extracted in several formats, so it's only counted once
+FORMAT_PREFERENCE = [cost_output.OUTPUT_FORMAT_PARQUET, cost_output.OUTPUT_FORMAT_NDJSON, cost_output.OUTPUT_FORMAT_JSON]
+
+# Function to resolve the alias of a dimension
+def resolve_dimension(name):
+    name = DIMENSION_ALIASES.get(name, name)
+    if name not in DIMENSIONS:
+        raise ValueError(f"Unknown dimension '{name}'. Expected one of {DIMENSIONS} or {list(DIMENSION_ALIASES)}")
+    return name
+
+# Function to check that pyarrow is available to query the cost data files
+def require_pyarrow():
+    if pa is None:
+        raise ImportError("Querying the cost data files requires pyarrow (pip install pyarrow)")
+
+# Function to select the cost data files of a period and of some subscriptions.
+# Only the month folders of the period are listed and only the files of the requested subscriptions are kept,
+# so the other files are never opened
+def find_cost_data_files(start, end, subscriptions=None):
+    wanted = {cost_output.sanitize_filename(subscription).lower() for subscription in subscriptions} if subscriptions else None
+    files = []
+    for year, month in finops_cost.month_range(start, end):
+        month_path = os.path.join(base_folder, str(year), calendar.month_abbr[month])
+        if not os.path.isdir(month_path):
+            continue
+        # Keep the preferred format of each subscription
+        candidates = {}
+        for file in sorted(os.listdir(month_path)):
+            parsed = cost_output.parse_cost_data_file_name(file)
+            if parsed is None:
+                continue
+            subscription_name, _, _, output_format = parsed
+            if wanted is not None and subscription_name.lower() not in wanted:
+                continue
+            current = candidates.get(subscription_name)
+            if current is None or FORMAT_PREFERENCE.index(output_format) < FORMAT_PREFERENCE.index(current[1]):
+                candidates[subscription_name] = (os.path.join(month_path, file), output_format)
+        files.extend(file_path for file_path, _ in candidates.values())
+    return files
+
+# Function to parse the filters given as 'Dimension=value1,value2' into {dimension: [values]}
+def parse_filters(filters):
+    parsed = {}
+    for item in filters or []:
+        if '=' not in item:
+            raise ValueError(f"Invalid filter '{item}'. Expected Dimension=value[,value...]")
+        name, values = item.split('=', 1)
+        parsed.setdefault(resolve_dimension(name.strip()), []).extend(value.strip() for value in values.split(','))
+    return parsed
+
+# Function to filter and group the rows of a cost data file. Only the needed columns are read
+def aggregate_file(file_path, group_by, filters, metric):
+    columns = list(dict.fromkeys([metric] + group_by + list(filters)))
+    table = cost_output.read_cost_table(file_path, columns)
+
+    # Decode the dictionary-encoded columns so that files with different dictionaries can be combined
+    for position, field in enumerate(table.schema):
+        if pa.types.is_dictionary(field.type):
+            table = table.set_column(position, field.name, pc.cast(table.column(position), pa.string()))
+
+    if filters:
+        mask = None
+        for name, values in filters.items():
+            condition = pc.is_in(table.column(name), value_set=pa.array(values, type=pa.string()))
+            mask = condition if mask is None else pc.and_(mask, condition)
+        table = table.filter(mask)
+
+    if not group_by:
+        return pa.table({f'{metric}_sum': [pc.sum(table.column(metric)).as_py() or 0.0], 'count': [table.num_rows]})
+    return table.group_by(group_by).aggregate([(metric, 'sum'), (metric, 'count')]).rename_columns(group_by + [f'{metric}_sum', 'count'])
+
+# Function to run a query over cost data files (see find_cost_data_files): filter, group by the dimensions, and keep the top N groups
+def query_costs(files, group_by, top=50, filters=None, metric='PreTaxCost'):
+    require_pyarrow()
+    group_by = [resolve_dimension(name) for name in group_by]
+    filters = parse_filters(filters)
+
+    # Aggregate each file on its own, then combine the partial sums
+    partials = [aggregate_file(file_path, group_by, filters, metric) for file_path in files]
+    if not partials:
+        return pd.DataFrame(columns=group_by + [metric, 'count'])
+    combined = pa.concat_tables(partials)
+    if group_by:
+        combined = combined.group_by(group_by).aggregate([(f'{metric}_sum', 'sum'), ('count', 'sum')]).rename_columns(group_by + [metric, 'count'])
+    else:
+        combined = pa.table({metric: [pc.sum(combined.column(f'{metric}_sum')).as_py()], 'count': [pc.sum(combined.column('count')).as_py()]})
+
+    indices = pc.select_k_unstable(combined, k=min(top, combined.num_rows), sort_keys=[(metric, 'descending')])
+    return combined.take(indices).to_pandas()
+
+def main():
+    parser = argparse.ArgumentParser(description='Query the cost data extracted to output/<year>/<month>/ without loading it into Azure SQL')
+    parser.add_argument('--from', dest='start', required=True, help='First month of the period (YYYY-MM)')
+    parser.add_argument('--to', dest='end', help='Last month of the period (YYYY-MM), defaults to --from')
+    parser.add_argument('--group-by', nargs='*', default=['SubscriptionName'], help=f'Dimensions to group by: {", ".join(DIMENSIONS)}, costcenter')
+    parser.add_argument('--top', type=int, default=50, help='Number of groups to return, by descending cost')
+    parser.add_argument('--subscription', nargs='*', help='Only read the files of these subscriptions')
+    parser.add_argument('--filter', nargs='*', help='Filters as Dimension=value[,value...], e.g. MeterCategory=Storage')
+    parser.add_argument('--metric', default='PreTaxCost', help='Cost column to sum')
+    parser.add_argument('--csv', help='Write the result to this CSV file instead of printing it')
+    args = parser.parse_args()
+
+    end = args.end or args.start
+    files = find_cost_data_files(args.start, end, args.subscription)
+    print(f"Scanning {len(files)} cost data files for {args.start} to {end}")
+    result = query_costs(files, args.group_by, args.top, args.filter, args.metric)
+    if args.csv:
+        result.to_csv(args.csv, index=False)
+        print(f"Result written to {args.csv}")
+    else:
+        with pd.option_context('display.max_rows', None, 'display.max_columns', None, 'display.width', None):
+            print(result.to_string(index=False))
+
+if __name__ == "__main__":
+    main()
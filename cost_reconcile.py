@@ -0,0 +1,120 @@
+import os
+import argparse
+import calendar
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+# Folder containing the extracted cost data: output/<year>/<month>/
+base_folder = 'output'
+
+# Status of a subscription in the reconciliation report
+# ok       - the extracted total is within the threshold of the billing account total
+# mismatch - the delta is above the threshold, e.g. a truncated pagination: the subscription is extracted again
+# missing  - the subscription of the billing account has no extracted total
+# stable   - the delta is above the threshold but the subscription returned the same total when extracted again, so the
+#            difference comes from charges the subscription query doesn't return (marketplace, reservations...)
+STATUS_OK = 'ok'
+STATUS_MISMATCH = 'mismatch'
+STATUS_MISSING = 'missing'
+STATUS_STABLE = 'stable'
+# Statuses of the subscriptions to extract again
+STATUS_REEXTRACT = (STATUS_MISMATCH, STATUS_MISSING)
+
+REPORT_COLUMNS = ['SubscriptionId', 'SubscriptionName', 'BillingAccountCost', 'ExtractedCost', 'Delta', 'RelativeDelta', 'ResourceCount', 'Status']
+
+# Function to compare the billing account total of each subscription, (SubscriptionId, SubscriptionName, TotalCost) rows,
+# with its extracted total, (SubscriptionId, SubscriptionName, TotalCost, ResourceCount) rows of the subscription cost
+# summary. The deltas of all the subscriptions are computed at once on arrays. A subscription is flagged when its delta
+# is above `tolerance` of its billing account total and above `min_delta`. `previous` is the report of the previous
+# pass, whose extracted totals tell the stable deltas apart
+def reconcile_costs(billing_rows, extract_rows, tolerance=0.01, min_delta=1.0, previous=None):
+    billing = pd.DataFrame(list(billing_rows), columns=['SubscriptionId', 'SubscriptionName', 'BillingAccountCost'])
+    billing['BillingAccountCost'] = pd.to_numeric(billing['BillingAccountCost'])
+    billing = billing.groupby('SubscriptionId', sort=False, as_index=False).agg(SubscriptionName=('SubscriptionName', 'first'), BillingAccountCost=('BillingAccountCost', 'sum'))
+
+    # The summary file of a month rerun without resume has the rows of each run, the last one is kept
+    extract = pd.DataFrame(list(extract_rows), columns=['SubscriptionId', 'ExtractSubscriptionName', 'ExtractedCost', 'ResourceCount'])
+    extract = extract.drop_duplicates('SubscriptionId', keep='last')
+    report = billing.merge(extract[['SubscriptionId', 'ExtractedCost', 'ResourceCount']], on='SubscriptionId', how='left')
+
+    billing_cost = report['BillingAccountCost'].to_numpy(dtype=float)
+    extracted_cost = pd.to_numeric(report['ExtractedCost'], errors='coerce').to_numpy(dtype=float)
+    delta = billing_cost - extracted_cost
+    threshold = np.maximum(min_delta, tolerance * np.abs(billing_cost))
+    missing = np.isnan(extracted_cost)
+    mismatch = ~missing & (np.abs(delta) > threshold)
+    stable = np.zeros(len(report), dtype=bool)
+    if previous is not None and len(previous):
+        previous_cost = report['SubscriptionId'].map(previous.set_index('SubscriptionId')['ExtractedCost']).to_numpy(dtype=float)
+        stable = mismatch & (np.abs(extracted_cost - previous_cost) <= 0.01)
+
+    report['ExtractedCost'] = extracted_cost
+    report['Delta'] = delta
+    report['RelativeDelta'] = np.divide(delta, np.abs(billing_cost), out=np.full(len(report), np.nan), where=billing_cost != 0)
+    report['ResourceCount'] = pd.to_numeric(report['ResourceCount'], errors='coerce').fillna(0).astype(int)
+    report['Status'] = np.select([missing, stable, mismatch], [STATUS_MISSING, STATUS_STABLE, STATUS_MISMATCH], default=STATUS_OK)
+    return report[REPORT_COLUMNS]
+
+# Function to write a reconciliation report to CSV, the largest deltas first
+def write_reconciliation_report(report, csv_file):
+    report = report.assign(Delta=report['Delta'].round(2), RelativeDelta=report['RelativeDelta'].round(6), ExtractedCost=report['ExtractedCost'].round(2), BillingAccountCost=report['BillingAccountCost'].round(2))
+    report.reindex(report['Delta'].abs().sort_values(ascending=False, na_position='first').index).to_csv(csv_file, index=False)
+
+# Function to read a report written by write_reconciliation_report, None if there is none
+def read_reconciliation_report(csv_file):
+    if not os.path.exists(csv_file):
+        return None
+    return pd.read_csv(csv_file, dtype={'SubscriptionId': str, 'SubscriptionName': str, 'Status': str}, keep_default_na=False, na_values={'ExtractedCost': [''], 'RelativeDelta': ['']})
+
+# Function to build the names of the summary CSV files of a month and of its reconciliation report
+# (written by finops_cost.prepare_month and process_monthly_costs). The files of an extraction `profile` other than the
+# default one are in its folder of the month, except the billing account summary
+def month_files(year, month, base_folder=base_folder, profile=None):
+    month_name = calendar.month_abbr[month]
+    month_dir = os.path.join(base_folder, str(year), month_name)
+    output_dir = os.path.join(month_dir, profile) if profile and profile != 'resource' else month_dir
+    return (
+        os.path.join(month_dir, f'billing_account_cost_summary_{month_name}_{year}.csv'),
+        os.path.join(output_dir, f'subscription_cost_summary_{month_name}_{year}.csv'),
+        os.path.join(output_dir, f'reconciliation_{month_name}_{year}.csv')
+    )
+
+# Function to reconcile a month from its summary CSV files. The stable subscriptions of its previous report stay stable
+# as long as their extracted total doesn't change
+def reconcile_month_files(year, month, tolerance=0.01, min_delta=1.0, base_folder=base_folder, profile=None):
+    billing_csv, subscription_csv, report_csv = month_files(year, month, base_folder, profile)
+    previous = read_reconciliation_report(report_csv)
+    if previous is not None:
+        previous = previous[previous['Status'] == STATUS_STABLE]
+    billing = pd.read_csv(billing_csv, dtype={'SubscriptionId': str, 'SubscriptionName': str}, keep_default_na=False)
+    extract = pd.read_csv(subscription_csv, dtype={'SubscriptionId': str, 'SubscriptionName': str}, keep_default_na=False)
+    billing_rows = billing[['SubscriptionId', 'SubscriptionName', 'TotalCost (Including Other Azure Resources)']].itertuples(index=False)
+    extract_rows = extract[['SubscriptionId', 'SubscriptionName', 'TotalCost', 'ResourceCount']].itertuples(index=False)
+    return reconcile_costs(billing_rows, extract_rows, tolerance, min_delta, previous)
+
+def main():
+    parser = argparse.ArgumentParser(description='Reconcile the extracted subscription totals of output/<year>/<month>/ with the billing account totals')
+    parser.add_argument('--from', dest='start', required=True, help='First month of the period (YYYY-MM)')
+    parser.add_argument('--to', dest='end', help='Last month of the period (YYYY-MM), defaults to --from')
+    parser.add_argument('--tolerance', type=float, default=float(os.getenv('FINOPS_RECONCILE_TOLERANCE', '0.01')), help='Relative delta above which a subscription is flagged')
+    parser.add_argument('--min-delta', type=float, default=float(os.getenv('FINOPS_RECONCILE_MIN_DELTA', '1')), help='Absolute delta below which a subscription is never flagged')
+    parser.add_argument('--profile', default=os.getenv('FINOPS_PROFILE'), help='Extraction profile of the subscription totals (see cost_profiles.py)')
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m')
+    end = datetime.strptime(args.end or args.start, '%Y-%m')
+    year, month = start.year, start.month
+    while (year, month) <= (end.year, end.month):
+        report = reconcile_month_files(year, month, args.tolerance, args.min_delta, profile=args.profile)
+        report_csv = month_files(year, month, profile=args.profile)[2]
+        write_reconciliation_report(report, report_csv)
+        flagged = report[report['Status'] != STATUS_OK]
+        print(f"{year}-{month:02d}: {len(report)} subscriptions, {len(flagged)} flagged, report written to {report_csv}")
+        if len(flagged):
+            with pd.option_context('display.max_rows', None, 'display.width', None):
+                print(flagged.to_string(index=False))
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+if __name__ == "__main__":
+    main()
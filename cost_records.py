@@ -0,0 +1,88 @@
+from array import array
+
+# Dictionary-encoded column: each distinct value is stored once and every row only holds the 4-byte code of its value.
+# The dimensions of the cost data (subscription, resource group, meter, location, tag...) repeat over hundreds of
+# thousands of rows, so the column is mostly made of codes
+class DictionaryColumn:
+    def __init__(self):
+        self.values = []
+        self.codes = array('I')
+        self._code_of = {}
+
+    # Function to return the code of a value, adding the value to the dictionary if it's new
+    def encode(self, value):
+        code = self._code_of.get(value)
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._code_of[value] = code
+        return code
+
+    def append(self, value):
+        self.codes.append(self.encode(value))
+
+    def __len__(self):
+        return len(self.codes)
+
+# Compact store of cost data rows, used instead of a list of rows when the rows of a query must be kept in memory.
+# The cost column (`cost_position`) is kept in a float64 array and the other columns are dictionary-encoded, so a row
+# takes 8 bytes plus 4 bytes per column instead of a list of boxed values. The row count and the total cost are
+# maintained as the rows are added. Rows are returned as lists, in the order they were added
+class CostRecordStore:
+    def __init__(self, cost_position=0):
+        self.cost_position = cost_position
+        self.costs = array('d')
+        # One column per position of the rows except the cost, created with the first row
+        self.columns = None
+        self.total_cost = 0.0
+
+    def append(self, row):
+        if self.columns is None:
+            self.columns = [DictionaryColumn() for _ in range(len(row) - 1)]
+        cost = float(row[self.cost_position])
+        self.costs.append(cost)
+        self.total_cost += cost
+        for column, value in zip(self.columns, (value for position, value in enumerate(row) if position != self.cost_position)):
+            column.append(value)
+
+    def extend(self, rows):
+        for row in rows:
+            self.append(row)
+
+    def __len__(self):
+        return len(self.costs)
+
+    def __iter__(self):
+        if self.columns is None:
+            return
+        position = self.cost_position
+        for index, codes in enumerate(zip(*(column.codes for column in self.columns))):
+            row = [column.values[code] for column, code in zip(self.columns, codes)]
+            row.insert(position, self.costs[index])
+            yield row
+
+# Running sum of the cost of rows grouped on all their columns except the cost and the `drop_positions` columns (e.g. the
+# UsageDate of daily rows, to get the month total of each resource). Groups are keyed by the tuple of the dictionary codes
+# of their values. Rows are returned as lists with the cost first, in the order their group first appeared
+class CostAggregator:
+    def __init__(self, drop_positions=(), cost_position=0):
+        self.drop_positions = set(drop_positions) | {cost_position}
+        self.cost_position = cost_position
+        self.columns = None
+        self.totals = {}
+        self.total_cost = 0.0
+
+    def add(self, row):
+        if self.columns is None:
+            self.columns = [DictionaryColumn() for position in range(len(row)) if position not in self.drop_positions]
+        key = tuple(column.encode(value) for column, value in zip(self.columns, (value for position, value in enumerate(row) if position not in self.drop_positions)))
+        cost = float(row[self.cost_position])
+        self.totals[key] = self.totals.get(key, 0.0) + cost
+        self.total_cost += cost
+
+    def __len__(self):
+        return len(self.totals)
+
+    def __iter__(self):
+        for key, cost in self.totals.items():
+            yield [cost] + [column.values[code] for column, code in zip(self.columns, key)]
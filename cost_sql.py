@@ -0,0 +1,289 @@
+import os
+import queue
+import threading
+# Import custom modules
+import cost_metrics
+# pyodbc is only needed to connect to Azure SQL; the field mapping is usable without it
+try:
+    import pyodbc
+except ImportError:
+    pyodbc = None
+
+# Get the Azure SQL Database connection details from environment variables
+server = os.getenv('AZURE_SQL_SERVER')
+database = os.getenv('AZURE_SQL_DATABASE')
+# username = os.getenv('AZURE_SQL_USERNAME')
+# password = os.getenv('AZURE_SQL_PASSWORD')
+username = os.getenv('AZURE_CLIENT_ID')
+password = os.getenv('AZURE_SECRET')
+driver = '{ODBC Driver 18 for SQL Server}'
+
+# How the cost data rows are loaded into AzureResourceCost, by export-to-sql.py and the pipeline mode of finops_cost.py:
+# insert - rows are appended to the table, after deleting the rows of a previous load of their subscription months
+# merge  - rows are staged in AzureResourceCostStage and merged on their key, so reloads are idempotent (schema v2)
+load_mode = os.getenv('SQL_LOAD_MODE', 'insert').lower()
+
+# Insert statements of the cost data rows: straight into AzureResourceCost, or into the staging table to be merged
+AZURE_RESOURCE_COST_INSERT = """
+    INSERT INTO AzureResourceCost (
+        SubscriptionName, SubscriptionId, ResourceGroup, ResourceName, ResourceID, ConsumedService, MeterCategory,
+        MeterSubcategory, Location, BillingMonth, CostCenter, Cost
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+AZURE_RESOURCE_COST_STAGE_INSERT = """
+    INSERT INTO AzureResourceCostStage (
+        SubscriptionName, SubscriptionId, ResourceGroup, ResourceName, ResourceID, ConsumedService, MeterCategory,
+        MeterSubcategory, Location, BillingMonth, CostCenter, Cost, LoadKey
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# Function to check that pyodbc is available before connecting
+def require_pyodbc():
+    if pyodbc is None:
+        raise ImportError("Connecting to Azure SQL requires pyodbc (pip install pyodbc)")
+
+# Function to open a connection to the Azure SQL Database
+def connect_to_sql():
+    require_pyodbc()
+    # return pyodbc.connect(f'DRIVER={driver};SERVER={server};PORT=1433;DATABASE={database};UID={username};PWD={password}')
+    return pyodbc.connect(f"DRIVER={driver};SERVER={server};PORT=1433;DATABASE={database};UID={username};PWD={password};;Authentication=ActiveDirectoryServicePrincipal;Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;")
+
+# Function to read the schema version of AzureResourceCost from the SchemaVersion table (version 1 has no such table)
+def azure_resource_cost_schema_version(conn):
+    cursor = conn.cursor()
+    try:
+        cursor.execute("SELECT Version FROM SchemaVersion WHERE TableName = ?", ('AzureResourceCost',))
+        rows = cursor.fetchall()
+    except Exception:
+        conn.rollback()
+        return 1
+    return rows[0][0] if rows else 1
+
+# Function to check that a load mode can load the AzureResourceCost table: the ResourceKey of schema version 2 is
+# computed by the merge, and its primary key rejects the rows sharing a key that the insert mode would add
+def check_load_mode(conn, load_mode):
+    if load_mode not in ('insert', 'merge'):
+        raise ValueError(f"Unsupported load mode '{load_mode}'. Expected 'insert' or 'merge'")
+    version = azure_resource_cost_schema_version(conn)
+    if load_mode == 'insert' and version >= 2:
+        raise ValueError(f"AzureResourceCost is at schema version {version}, which can only be loaded with SQL_LOAD_MODE=merge")
+
+# Function to open a pool of connections. A connection is used by one worker at a time.
+# When a `load_mode` is given, it's checked against the AzureResourceCost schema before the pool is returned
+def create_connection_pool(size, load_mode=None):
+    pool = queue.Queue()
+    for _ in range(size):
+        pool.put(connect_to_sql())
+    if load_mode is not None:
+        conn = pool.get()
+        pool.put(conn)
+        try:
+            check_load_mode(conn, load_mode)
+        except Exception:
+            close_connection_pool(pool)
+            raise
+    return pool
+
+# Function to close all the connections of a pool
+def close_connection_pool(pool):
+    while not pool.empty():
+        pool.get().close()
+
+def extract_subscription_name(full_name):
+    # Extract the subscription name without the ID in parentheses
+    # Find the index of the last opening parenthesis
+    last_opening_parenthesis = full_name.rfind('(')
+
+    # If an opening parenthesis is found, return the substring before it
+    if last_opening_parenthesis != -1:
+        return full_name[:last_opening_parenthesis].strip()
+
+    # If no opening parenthesis is found, return the full name
+    return full_name
+
+# Function to map a cost data record (a row returned by the Cost Management API) to the AzureResourceCost columns
+def azure_resource_cost_params(record):
+    # Extract fields from the JSON record
+    cost = record[0]
+    subscription_name = extract_subscription_name(record[1])
+    subscription_id = record[1].split('(')[-1].strip(')')
+    resource_group = record[2]
+    resource_name = record[3].split('/')[-1]
+    resource_id = record[3]
+    resource_type = record[4]
+    meter_category = record[6]
+    meter_subcategory = record[5]
+    location = record[7]
+    billing_month = record[8]
+    cost_center = record[10]
+
+    # Prepare the parameters
+    return (
+        subscription_name, subscription_id, resource_group, resource_name, resource_id, resource_type, meter_category,
+        meter_subcategory, location, billing_month, cost_center, str(cost)
+    )
+
+# Function to merge the rows staged for a file into AzureResourceCost and clear them from the staging table.
+# The staged rows are the whole query (or file) of their subscription months: the rows already loaded for those
+# subscription months are deleted first, so that the resources which are gone don't keep their previous cost.
+# Rows are matched on the billing month (the partitioning column) and a hash of the grouping dimensions of the cost query,
+# the staged rows sharing a key are summed. Runs in the caller's transaction, which commits it
+def merge_staged_rows(cursor, load_key):
+    delete_query = """
+        DELETE FROM AzureResourceCost
+        WHERE EXISTS (
+            SELECT 1 FROM AzureResourceCostStage AS source
+            WHERE source.LoadKey = ? AND source.SubscriptionId = AzureResourceCost.SubscriptionId
+                AND CONVERT(date, LEFT(source.BillingMonth, 10)) = AzureResourceCost.BillingMonth
+        )
+    """
+    cursor.execute(delete_query, (load_key,))
+    query = """
+        MERGE AzureResourceCost WITH (HOLDLOCK) AS target
+        USING (
+            SELECT
+                MAX(SubscriptionName) AS SubscriptionName, SubscriptionId, ResourceGroup, MAX(ResourceName) AS ResourceName, ResourceID,
+                ConsumedService, MeterCategory, MeterSubcategory, Location, CONVERT(date, LEFT(BillingMonth, 10)) AS BillingMonth, CostCenter,
+                CONVERT(decimal(19, 6), SUM(CONVERT(float, Cost))) AS Cost,
+                CONVERT(binary(32), HASHBYTES('SHA2_256', CONCAT_WS(N'|', SubscriptionId, ResourceGroup, ResourceID, ConsumedService,
+                    MeterCategory, MeterSubcategory, Location, CostCenter))) AS ResourceKey
+            FROM AzureResourceCostStage
+            WHERE LoadKey = ?
+            GROUP BY SubscriptionId, ResourceGroup, ResourceID, ConsumedService, MeterCategory, MeterSubcategory, Location,
+                CONVERT(date, LEFT(BillingMonth, 10)), CostCenter
+        ) AS source
+        ON target.BillingMonth = source.BillingMonth AND target.ResourceKey = source.ResourceKey
+        WHEN MATCHED THEN
+            UPDATE SET SubscriptionName = source.SubscriptionName, ResourceName = source.ResourceName, Cost = source.Cost
+        WHEN NOT MATCHED THEN
+            INSERT (SubscriptionName, SubscriptionId, ResourceGroup, ResourceName, ResourceID, ConsumedService, MeterCategory,
+                    MeterSubcategory, Location, BillingMonth, CostCenter, Cost, ResourceKey)
+            VALUES (source.SubscriptionName, source.SubscriptionId, source.ResourceGroup, source.ResourceName, source.ResourceID,
+                    source.ConsumedService, source.MeterCategory, source.MeterSubcategory, source.Location, source.BillingMonth,
+                    source.CostCenter, source.Cost, source.ResourceKey);
+    """
+    cursor.execute(query, (load_key,))
+    cursor.execute("DELETE FROM AzureResourceCostStage WHERE LoadKey = ?", (load_key,))
+
+# Writer loading the cost data pages straight into AzureResourceCost, with the write_page/close interface of
+# cost_output.CostDataWriter (pipeline mode of finops_cost.py, no cost data file is written).
+# Pages are put on a bounded queue and inserted by a background thread over `conn`, so the next page is fetched while the
+# previous one is loaded. When the database falls behind, write_page waits for room in the queue (backpressure).
+# In insert mode the rows already loaded for the subscription months of the pages are deleted and the pages inserted in
+# a single transaction, committed by `commit` once the whole query has been retrieved; `abort` rolls it back. In merge
+# mode each page is staged under `load_key` and committed, and the staged rows are only merged into AzureResourceCost
+# by `commit`; `abort` discards them.
+# Pipelined loads can't resume from a nextLink checkpoint (finops_cost rejects FINOPS_RESUME in pipeline mode), so the
+# writer has no `resume`: an interrupted query is retrieved again from its first page.
+# The insert, commit and merge timings are recorded with the given metric `labels`
+class SqlCostDataWriter:
+    def __init__(self, conn, load_key, load_mode='insert', batch_size=5000, bulk_insert=True, queue_size=8, labels=None):
+        if load_mode not in ('insert', 'merge'):
+            raise ValueError(f"Unsupported load mode '{load_mode}'. Expected 'insert' or 'merge'")
+        self.conn = conn
+        self.load_key = load_key
+        self.merge = load_mode == 'merge'
+        self.batch_size = batch_size
+        self.bulk_insert = bulk_insert
+        self.labels = labels or {}
+        self.row_count = 0
+        self.total_cost = 0.0
+        # Rows inserted by the background thread so far
+        self.loaded_rows = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        # (SubscriptionId, BillingMonth) whose previous rows were deleted in insert mode
+        self._replaced = set()
+        self._error = None
+        self._closed = False
+        self._cursor = conn.cursor()
+        self._cursor.fast_executemany = bulk_insert
+        if self.merge:
+            # Discard the rows staged by an interrupted run
+            self._cursor.execute("DELETE FROM AzureResourceCostStage WHERE LoadKey = ?", (load_key,))
+            conn.commit()
+        self._thread = threading.Thread(target=self._consume, name=f'sql-writer-{load_key}', daemon=True)
+        self._thread.start()
+
+    # Background thread inserting the queued pages until the end marker (None)
+    def _consume(self):
+        query = AZURE_RESOURCE_COST_STAGE_INSERT if self.merge else AZURE_RESOURCE_COST_INSERT
+        try:
+            while True:
+                rows = self._queue.get()
+                if rows is None:
+                    break
+                params = [azure_resource_cost_params(row) + (self.load_key,) if self.merge else azure_resource_cost_params(row) for row in rows]
+                if not self.merge:
+                    self._delete_loaded_rows(params)
+                for start in range(0, len(params), self.batch_size):
+                    with cost_metrics.metrics.timer('sql_insert_seconds', **self.labels):
+                        self._cursor.executemany(query, params[start:start + self.batch_size])
+                if self.merge:
+                    with cost_metrics.metrics.timer('sql_commit_seconds', **self.labels):
+                        self.conn.commit()
+                cost_metrics.metrics.increment('sql_rows_total', len(rows), **self.labels)
+                self.loaded_rows += len(rows)
+        except Exception as e:
+            self._error = e
+
+    # Function to delete the rows of a previous load of the subscription months of a page (insert mode), in the
+    # transaction of the pages so that they are only gone once the new rows are committed
+    def _delete_loaded_rows(self, params):
+        for key in {(row[1], row[9]) for row in params} - self._replaced:
+            self._cursor.execute("DELETE FROM AzureResourceCost WHERE SubscriptionId = ? AND BillingMonth = ?", key)
+            self._replaced.add(key)
+
+    # Function to hand an item to the background thread, failing as soon as the thread stopped on an error
+    def _put(self, item):
+        # Time spent waiting for room in the queue, i.e. the fetch waiting for the database
+        with cost_metrics.metrics.timer('pipeline_queue_wait_seconds', **self.labels):
+            while True:
+                if self._error is not None:
+                    raise self._error
+                try:
+                    self._queue.put(item, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+    # `columns` are only used by the file writers
+    def write_page(self, rows, columns=None):
+        if rows:
+            self._put(rows)
+        self.row_count += len(rows)
+        self.total_cost += sum(float(row[0]) for row in rows)
+
+    # Function to wait for the queued pages to be inserted
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._error is None:
+            self._put(None)
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+
+    # Function to make the loaded rows visible once the whole query is retrieved (merges the staged rows in merge mode)
+    def commit(self):
+        self.close()
+        if self.merge:
+            with cost_metrics.metrics.timer('sql_merge_seconds', **self.labels):
+                merge_staged_rows(self._cursor, self.load_key)
+                self.conn.commit()
+        else:
+            with cost_metrics.metrics.timer('sql_commit_seconds', **self.labels):
+                self.conn.commit()
+
+    # Function to discard the rows of a failed query (the pages inserted in insert mode, the staged rows in merge mode)
+    def abort(self):
+        try:
+            self.close()
+        except Exception:
+            pass
+        self.conn.rollback()
+        if self.merge:
+            self._cursor.execute("DELETE FROM AzureResourceCostStage WHERE LoadKey = ?", (self.load_key,))
+            self.conn.commit()
@@ -1,4 +1,3 @@
-import pyodbc
 import logging
 import shutil
 import calendar
@@ -6,368 +5,399 @@ import logging
 import os
 import re
 import pandas as pd
-import pyodbc
 import logging
 import shutil
 import calendar
 import os
 from datetime import datetime, date
 import json
-
-# Set up logging
-logging.basicConfig(filename='import_log.txt', level=logging.INFO, format='%(asctime)s - %(message)s')
-
-# Get the Azure SQL Database connection details from environment variables
-server = os.getenv('AZURE_SQL_SERVER')
-database = os.getenv('AZURE_SQL_DATABASE')
-# username = os.getenv('AZURE_SQL_USERNAME')
-# password = os.getenv('AZURE_SQL_PASSWORD')
-username = os.getenv('AZURE_CLIENT_ID')
-password = os.getenv('AZURE_SECRET')
-driver = '{ODBC Driver 18 for SQL Server}'
-
-# Set up logging with the current date as the log file name
+import time
+import hashlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+# Import custom modules
+import cost_output
+import cost_logging
+import cost_sql
+import cost_metrics
+
+log = logging.getLogger('export_to_sql')
+
+# The Azure SQL Database connection details and the AzureResourceCost field mapping are in cost_sql,
+# shared with the pipeline mode of finops_cost.py
+
+# Folder containing the extracted cost data: output/<year>/<month>/
+base_folder = 'output'
+
+# Rows committed together when loading the cost data files (and checkpointed in insert mode, see push_azure_resource_cost_json_to_sql)
+commit_size = 5000
+# Rows sent to Azure SQL in a single executemany call, must divide commit_size
+batch_size = int(os.getenv('SQL_BATCH_SIZE', '5000'))
+# Use pyodbc fast_executemany (parameter arrays) to send each batch in one round trip
+bulk_insert = os.getenv('SQL_BULK_INSERT', 'true').lower() == 'true'
+# How the cost data files are loaded into AzureResourceCost: 'insert' or 'merge' (SQL_LOAD_MODE, see cost_sql)
+load_mode = cost_sql.load_mode
+# Number of cost data files loaded in parallel, each over its own connection
+load_workers = int(os.getenv('SQL_LOAD_WORKERS', '4'))
+
+# Log file named with the current date (JSON lines, set up by main)
 log_file_name = datetime.now().strftime('%Y-%m-%d') + '.log'
-logging.basicConfig(filename=log_file_name, level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+# Timings and counters of the load, written at the end of main (and in the Prometheus text format when a file is given)
+run_summary_file_name = 'load_summary_' + datetime.now().strftime('%Y%m%d_%H%M%S') + '.json'
+prometheus_file = os.getenv('SQL_PROMETHEUS_FILE')
+
+# Function to read a cost summary CSV file of output/<year>/<month>/ and add the Month, Year and Date columns
+def read_cost_summary_csv(file_path):
+    # Read the CSV file into a DataFrame
+    df = pd.read_csv(file_path)
+    log.info(f"CSV file {file_path} read successfully.")
+
+    # Extract month and year from the file path
+    file_parts = file_path.split(os.sep)
+    year = file_parts[-3]  # Assuming the year is the third last folder
+    month_name = file_parts[-2]  # Assuming the month is the second last folder
+
+    # Replace NaN with an empty string
+    df['SubscriptionName'] = df['SubscriptionName'].fillna('')
+    df['SubscriptionId'] = df['SubscriptionId'].fillna('')
+
+    # Add Month, Year, and Date columns to the DataFrame
+    df['Month'] = month_name
+    df['Year'] = year
+    month_number = list(calendar.month_abbr).index(month_name.capitalize())
+    first_date_of_given_month = date(date.today().year, month_number, 1)
+    df['Date'] = first_date_of_given_month
+    return df
+
+# Function to load a DataFrame into a SQL table. column_mapping maps each table column to its DataFrame column.
+# The frame is converted once to tuples of Python values and sent in batches of 5000 rows, each committed on its own
+def push_dataframe_to_sql(df, table, column_mapping, conn, batch_size=commit_size):
+    columns = list(column_mapping.keys())
+    query = f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})"
+
+    # Convert each mapped column once to a single Python type (numbers or strings) so that fast_executemany
+    # binds it consistently, with missing values sent as NULL
+    column_values = []
+    for column in column_mapping.values():
+        series = df[column]
+        if pd.api.types.is_numeric_dtype(series):
+            values = series.astype(object).where(series.notna(), None)
+        else:
+            values = series.map(lambda value: None if pd.isna(value) else str(value))
+        column_values.append(values.tolist())
+    rows = list(zip(*column_values))
+
+    cursor = conn.cursor()
+    cursor.fast_executemany = bulk_insert
+    for start in range(0, len(rows), batch_size):
+        batch = rows[start:start + batch_size]
+        try:
+            with cost_metrics.metrics.timer('sql_insert_seconds', table=table):
+                cursor.executemany(query, batch)
+        except Exception as sql_error:
+            log.error(f"SQL error while inserting rows {start} to {start + len(batch)}: {sql_error}")
+            raise
+        with cost_metrics.metrics.timer('sql_commit_seconds', table=table):
+            conn.commit()
+        cost_metrics.metrics.increment('sql_rows_total', len(batch), table=table)
+        log.info(f"Committed {start + len(batch)} rows")
+    return len(rows)
 
 def push_billing_account_cost_csv_to_sql(file_path, conn):
     try:
-        logging.info(f"Starting to process file: {file_path}")
-        print(f"Starting to process file: {file_path}")
-        
-        # Start a transaction
-        cursor = conn.cursor()
-        # cursor.execute("BEGIN TRANSACTION")
-        # logging.info("Transaction started.")
-
-        # Read the CSV file into a DataFrame
-        df = pd.read_csv(file_path)
-        logging.info(f"CSV file {file_path} read successfully.")
-        print(f"CSV file {file_path} read successfully.")
-
-        # Extract month and year from the file path
-        file_parts = file_path.split(os.sep)
-        year = file_parts[-3]  # Assuming the year is the third last folder
-        month_name = file_parts[-2]  # Assuming the month is the second last folder
-
-        # Replace NaN with an empty string
-        df['SubscriptionName'] = df['SubscriptionName'].fillna('')
-        df['SubscriptionId'] = df['SubscriptionId'].fillna('')
-        
-        # Add Month, Year, and Date columns to the DataFrame
-        df['Month'] = month_name
-        df['Year'] = year
-        month_number = list(calendar.month_abbr).index(month_name.capitalize())
-        first_date_of_given_month = date(date.today().year, month_number, 1)
-        df['Date'] = first_date_of_given_month      
-
-        # Rename columns to match the database table schema
-        df.rename(columns={
+        log.info(f"Starting to process file: {file_path}")
+
+        df = read_cost_summary_csv(file_path)
+        # Map the table columns to the CSV columns
+        push_dataframe_to_sql(df, 'BillingAccountCost', {
             'SubscriptionName': 'SubscriptionName',
             'SubscriptionId': 'SubscriptionId',
-            'TotalCost (Including Other Azure Resources)': 'TotalCost'
-        }, inplace=True)
-
-        # # Debugging: Print the first few rows of the DataFrame
-        # print(df.head())
-
-        # Insert data into the SQL table in blocks of 5000 rows
-        row_count = 0
-        for index, row in df.iterrows():
-            # # Print the row for logging
-            # print(f"Inserting row {index} : {row}")
-
-            # Prepare the query and parameters
-            query = """
-                INSERT INTO BillingAccountCost (SubscriptionName, SubscriptionId, TotalCost, Month, Year, Date)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """
-            params = (row['SubscriptionName'], row['SubscriptionId'], row['TotalCost'], row['Month'], row['Year'], row['Date'])
-
-            # # Print and log the query and parameters for debugging
-            # print(f"Executing query: {query}")
-            # print(f"With parameters: {params}")
-            # logging.debug(f"Executing query: {query}")
-            # logging.debug(f"With parameters: {params}")
-
-            try:
-                # Execute the query
-                cursor.execute(query, params)
-                row_count += 1
-                if row_count % 5000 == 0:
-                    conn.commit()
-                    logging.info(f"Committed {row_count} rows")
-                    print(f"Committed {row_count} rows")
-            except Exception as sql_error:
-                logging.error(f"SQL error while inserting row {index}: {sql_error}")
-                print(f"SQL error while inserting row {index}: {sql_error}")
-                raise        
-
-        # Commit any remaining rows
-        if row_count % 5000 != 0:
-            conn.commit()
-            logging.info(f"Committed {row_count % 5000} rows")
-            print(f"Committed {row_count % 5000} rows")
-
-        logging.info("Transaction committed successfully.")
-        print("Transaction committed successfully.")
-        logging.info(f"Data from {file_path} successfully inserted into BillingAccountCost table.")
-        print(f"Data from {file_path} successfully inserted into BillingAccountCost table.")
+            'TotalCost': 'TotalCost (Including Other Azure Resources)',
+            'Month': 'Month',
+            'Year': 'Year',
+            'Date': 'Date'
+        }, conn)
+
+        log.info("Transaction committed successfully.")
+        log.info(f"Data from {file_path} successfully inserted into BillingAccountCost table.")
     except Exception as e:
         # Rollback the transaction in case of an error
         conn.rollback()
-        logging.error(f"Error processing file {file_path}: {e}")
-        print(f"Error processing file {file_path}: {e}")
+        log.error(f"Error processing file {file_path}: {e}")
         raise
 
 def push_subscription_cost_csv_to_sql(file_path, conn):
     try:
-        logging.info(f"Starting to process file: {file_path}")
-        print(f"Starting to process file: {file_path}")
-        
-        # Start a transaction
-        cursor = conn.cursor()
+        log.info(f"Starting to process file: {file_path}")
 
-        # Read the CSV file into a DataFrame
-        df = pd.read_csv(file_path)
-        logging.info(f"CSV file {file_path} read successfully.")
-        print(f"CSV file {file_path} read successfully.")
-
-        # Extract month and year from the file path
-        file_parts = file_path.split(os.sep)
-        year = file_parts[-3]  # Assuming the year is the third last folder
-        month_name = file_parts[-2]  # Assuming the month is the second last folder
-
-        # Replace NaN with an empty string
-        df['SubscriptionName'] = df['SubscriptionName'].fillna('')
-        df['SubscriptionId'] = df['SubscriptionId'].fillna('')
-        
-        # Add Month, Year, and Date columns to the DataFrame
-        df['Month'] = month_name
-        df['Year'] = year
-        month_number = list(calendar.month_abbr).index(month_name.capitalize())
-        first_date_of_given_month = date(date.today().year, month_number, 1)
-        df['Date'] = first_date_of_given_month
-
-        # Rename columns to match the database table schema
-        df.rename(columns={
+        df = read_cost_summary_csv(file_path)
+        # Map the table columns to the CSV columns
+        push_dataframe_to_sql(df, 'SubscriptionCost', {
             'SubscriptionName': 'SubscriptionName',
             'SubscriptionId': 'SubscriptionId',
-            'TotalCost': 'AzureCost',
-            'ResourceCount': 'ResourceCount'
-        }, inplace=True)
-
-        # # Debugging: Print the first few rows of the DataFrame
-        # print(df.head())
-
-        # Insert data into the SQL table in blocks of 5000 rows
-        row_count = 0
-        for index, row in df.iterrows():
-            # # Print the row for logging
-            # print(f"Inserting row {index} : {row}")
-
-            # Prepare the query and parameters
-            query = """
-                INSERT INTO SubscriptionCost (SubscriptionName, SubscriptionId, AzureCost, ResourceCount, Month, Year, Date)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            """
-            params = (row['SubscriptionName'], row['SubscriptionId'], row['AzureCost'], row['ResourceCount'], row['Month'], row['Year'], row['Date'])
-
-            # # Print and log the query and parameters for debugging
-            # print(f"Executing query: {query}")
-            # print(f"With parameters: {params}")
-            # logging.debug(f"Executing query: {query}")
-            # logging.debug(f"With parameters: {params}")
-
-            try:
-                # Execute the query
-                cursor.execute(query, params)
-                row_count += 1
-                if row_count % 5000 == 0:
-                    conn.commit()
-                    logging.info(f"Committed {row_count} rows")
-                    print(f"Committed {row_count} rows")
-            except Exception as sql_error:
-                logging.error(f"SQL error while inserting row {index}: {sql_error}")
-                print(f"SQL error while inserting row {index}: {sql_error}")
-                raise        
-
-        # Commit any remaining rows
-        if row_count % 5000 != 0:
-            conn.commit()
-            logging.info(f"Committed {row_count % 5000} rows")
-            print(f"Committed {row_count % 5000} rows")
-
-        logging.info("Transaction committed successfully.")
-        print("Transaction committed successfully.")
-        logging.info(f"Data from {file_path} successfully inserted into SubscriptionCost table.")
-        print(f"Data from {file_path} successfully inserted into SubscriptionCost table.")
+            'AzureCost': 'TotalCost',
+            'ResourceCount': 'ResourceCount',
+            'Month': 'Month',
+            'Year': 'Year',
+            'Date': 'Date'
+        }, conn)
+
+        log.info("Transaction committed successfully.")
+        log.info(f"Data from {file_path} successfully inserted into SubscriptionCost table.")
     except Exception as e:
         # Rollback the transaction in case of an error
         conn.rollback()
-        logging.error(f"Error processing file {file_path}: {e}")
-        print(f"Error processing file {file_path}: {e}")
+        log.error(f"Error processing file {file_path}: {e}")
         raise
 
-# Save the last processed file and row in the ProcessCheckpoint table after each commit
-def save_checkpoint(conn, file_path, last_row):
+# Function to compute the key of a cost data file in the FileLoadCheckpoint table: its path relative to the
+# output folder with '/' separators, so that it doesn't depend on the working directory or the OS
+def checkpoint_file_key(file_path):
+    return os.path.relpath(file_path, base_folder).replace(os.sep, '/')
+
+# Function to build the metric labels of a cost data file: its subscription and month (YYYY-MM)
+def file_metric_labels(file_path):
+    parsed = cost_output.parse_cost_data_file_name(os.path.basename(file_path))
+    if parsed is None:
+        return {'file': checkpoint_file_key(file_path)}
+    subscription_name, month_name, year, _ = parsed
+    return {'subscription': subscription_name, 'month': f'{year}-{list(calendar.month_abbr).index(month_name):02d}'}
+
+# Function to compute the SHA-256 of a cost data file, used to detect files which changed since they were loaded
+def file_content_hash(file_path):
+    sha256 = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+# Function to identify the version of a cost data file: (SHA-256, size, modification time in nanoseconds).
+# The file is only hashed when its size or modification time differ from the ones of its checkpoint
+def file_version(file_path, checkpoint=None):
+    stat = os.stat(file_path)
+    if (checkpoint and checkpoint['content_hash']
+            and checkpoint['file_size'] == stat.st_size and checkpoint['file_mtime'] == stat.st_mtime_ns):
+        return checkpoint['content_hash'], stat.st_size, stat.st_mtime_ns
+    return file_content_hash(file_path), stat.st_size, stat.st_mtime_ns
+
+# Save the progress of a file in the FileLoadCheckpoint table after each commit, and mark it complete at the end.
+# `version` is the (content hash, size, modification time) of the file, see file_version
+def save_checkpoint(conn, file_path, last_row, version, complete=False):
     try:
         cursor = conn.cursor()
         query = """
-            INSERT INTO ProcessCheckpoint (LastProcessedFile, LastProcessedRow)
-            VALUES (?, ?)
+            MERGE FileLoadCheckpoint WITH (HOLDLOCK) AS target
+            USING (SELECT ? AS FilePath, ? AS ContentHash, ? AS FileSize, ? AS FileModifiedTime, ? AS TotalRows, ? AS LastProcessedRow, ? AS IsComplete) AS source
+            ON target.FilePath = source.FilePath
+            WHEN MATCHED THEN
+                UPDATE SET ContentHash = source.ContentHash, FileSize = source.FileSize, FileModifiedTime = source.FileModifiedTime,
+                           TotalRows = source.TotalRows, LastProcessedRow = source.LastProcessedRow,
+                           IsComplete = source.IsComplete, LastProcessedTimestamp = GETDATE()
+            WHEN NOT MATCHED THEN
+                INSERT (FilePath, ContentHash, FileSize, FileModifiedTime, TotalRows, LastProcessedRow, IsComplete)
+                VALUES (source.FilePath, source.ContentHash, source.FileSize, source.FileModifiedTime, source.TotalRows, source.LastProcessedRow, source.IsComplete);
         """
-        cursor.execute(query, (file_path, last_row))
+        file_key = checkpoint_file_key(file_path)
+        content_hash, file_size, file_mtime = version or (None, None, None)
+        cursor.execute(query, (file_key, content_hash, file_size, file_mtime, last_row if complete else None, last_row, 1 if complete else 0))
         conn.commit()
-        logging.info(f"Checkpoint saved: File={file_path}, Row={last_row}")
-        print(f"Checkpoint saved: File={file_path}, Row={last_row}")
+        log.info(f"Checkpoint saved: File={file_key}, Row={last_row}, Complete={complete}")
     except Exception as e:
-        logging.error(f"Error saving checkpoint: {e}")
-        print(f"Error saving checkpoint: {e}")
+        log.error(f"Error saving checkpoint: {e}")
         raise
 
-# Retrieve the last processed file and row from the ProcessCheckpoint table when the script starts
-def get_last_checkpoint(conn):
+# Retrieve the checkpoints of all the files in a single query when the script starts: {file key: checkpoint}
+def load_file_checkpoints(conn):
     try:
         cursor = conn.cursor()
         query = """
-            SELECT TOP 1 LastProcessedFile, LastProcessedRow
-            FROM ProcessCheckpoint
-            ORDER BY Id DESC
+            SELECT FilePath, ContentHash, FileSize, FileModifiedTime, TotalRows, LastProcessedRow, IsComplete
+            FROM FileLoadCheckpoint
         """
         cursor.execute(query)
-        result = cursor.fetchone()
-        if result:
-            return result[0], result[1]  # File path, last processed row
-        return None, 0  # No checkpoint found
+        return {
+            row[0]: {'content_hash': row[1], 'file_size': row[2], 'file_mtime': row[3], 'total_rows': row[4], 'last_row': row[5], 'complete': bool(row[6])}
+            for row in cursor.fetchall()
+        }
     except Exception as e:
-        logging.error(f"Error retrieving checkpoint: {e}")
+        log.error(f"Error retrieving checkpoints: {e}")
         raise        
 
-def extract_subscription_name(full_name):
-    # Extract the subscription name without the ID in parentheses
-    # Find the index of the last opening parenthesis
-    last_opening_parenthesis = full_name.rfind('(')
-
-    # If an opening parenthesis is found, return the substring before it
-    if last_opening_parenthesis != -1:
-        return full_name[:last_opening_parenthesis].strip()
-    
-    # If no opening parenthesis is found, return the full name
-    return full_name
-
-def push_azure_resource_cost_json_to_sql(json_file_path, conn, start_row):
+def push_azure_resource_cost_json_to_sql(json_file_path, conn, start_row, batch_size=batch_size, bulk_insert=bulk_insert, version=None, load_mode=load_mode):
     try:
-        # Read the JSON file
-        with open(json_file_path, 'r') as file:
-            data = json.load(file)
-        logging.info(f"JSON file {json_file_path} read successfully.")
-        print(f"JSON file {json_file_path} read successfully.")
+        # Batches must line up with the commit/checkpoint boundaries
+        if batch_size <= 0 or commit_size % batch_size != 0:
+            raise ValueError(f"The batch size ({batch_size}) must divide the commit size ({commit_size})")
+
+        if load_mode not in ('insert', 'merge'):
+            raise ValueError(f"Unsupported load mode '{load_mode}'. Expected 'insert' or 'merge'")
+        merge = load_mode == 'merge'
+        file_log = cost_logging.bind(log, file=checkpoint_file_key(json_file_path))
+        metric_labels = file_metric_labels(json_file_path)
+        if merge and start_row > 0:
+            # The merge mode only checkpoints complete files, the rows staged by an interrupted run are discarded below
+            file_log.info(f"Staging the file again from its first row instead of row {start_row}", extra={'rows': start_row})
+            start_row = 0
+
+        # Read the cost data file (json array or ndjson, one row per line) incrementally, seeking to start_row through its byte-offset index
+        data = cost_output.iter_cost_records(json_file_path, start_row)
+        file_log.info(f"Reading cost data file {json_file_path}.", extra={'rows': start_row})
+        # Rows of this file in the staging table are identified by the file key
+        load_key = checkpoint_file_key(json_file_path)
 
         # Prepare the SQL query
-        query = """
-            INSERT INTO AzureResourceCost (
-                SubscriptionName, SubscriptionId, ResourceGroup, ResourceName, ResourceID, ConsumedService, MeterCategory, 
-                MeterSubcategory, Location, BillingMonth, CostCenter, Cost
-            )
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
+        query = cost_sql.AZURE_RESOURCE_COST_STAGE_INSERT if merge else cost_sql.AZURE_RESOURCE_COST_INSERT
 
-        # Insert each record into the database
+        # Send each batch of records in a single round trip (parameter arrays) in bulk insert mode
         cursor = conn.cursor()
+        cursor.fast_executemany = bulk_insert
+        if merge:
+            # The whole file is staged, then merged once at the end: the rows of a key can be spread over several commits.
+            # Discard the rows staged by an interrupted run
+            cursor.execute("DELETE FROM AzureResourceCostStage WHERE LoadKey = ?", (load_key,))
+            conn.commit()
         # If start_row is greater than 0, it means we are resuming from a checkpoint
         if start_row > 0:
             #
             row_count = start_row
         else:
             row_count = 0
-        for index, record in enumerate(data):
-            if index < start_row:
-                continue  # Skip already processed rows          
-            try:
-                # Extract fields from the JSON record
-                cost = record[0]
-                subscription_name = extract_subscription_name(record[1])
-                subscription_id = record[1].split('(')[-1].strip(')')
-                resource_group = record[2]
-                resource_name = record[3].split('/')[-1]
-                resource_id = record[3]
-                resource_type = record[4]
-                meter_category = record[6]
-                meter_subcategory = record[5]
-                location = record[7]
-                billing_month = record[8]
-                cost_center = record[10]
-
-                # Prepare the parameters
-                params = (
-                    subscription_name, subscription_id, resource_group, resource_name, resource_id, resource_type, meter_category,
-                    meter_subcategory, location, billing_month, cost_center, str(cost)
-                )
-
-                # Execute the query
-                cursor.execute(query, params)
-                row_count += 1
-
-                # Commit in batches of 5000 rows
-                if row_count % 5000 == 0:
-                    conn.commit()
-                    logging.info(f"Committed {row_count} rows.")
-                    print(f"Committed {row_count} rows.")
+        inserted_rows = 0
+        start_time = time.perf_counter()
+        batch = []
 
-                    # Save the checkpoint
-                    save_checkpoint(conn, json_file_path, row_count)
-                    
+        # Function to insert the pending batch, commit and save the checkpoint on the commit boundaries
+        def flush_batch():
+            nonlocal row_count, inserted_rows, batch
+            try:
+                with cost_metrics.metrics.timer('sql_insert_seconds', **metric_labels):
+                    cursor.executemany(query, batch)
             except Exception as sql_error:
-                logging.error(f"SQL error while inserting record: {sql_error}")
-                print(f"SQL error while inserting record: {sql_error}")
+                file_log.error(f"SQL error while inserting records {row_count} to {row_count + len(batch)}: {sql_error}", extra={'rows': row_count})
                 raise
+            row_count += len(batch)
+            inserted_rows += len(batch)
+            cost_metrics.metrics.increment('sql_rows_total', len(batch), **metric_labels)
+            batch = []
+
+            # Commit in batches of 5000 rows (the staged rows in merge mode, which are only checkpointed once merged)
+            if row_count % commit_size == 0:
+                with cost_metrics.metrics.timer('sql_commit_seconds', **metric_labels):
+                    conn.commit()
+                rows_per_second = inserted_rows / max(time.perf_counter() - start_time, 1e-9)
+                file_log.info(f"Committed {row_count} rows. ({rows_per_second:.0f} rows/sec)", extra={'rows': row_count, 'elapsed': round(time.perf_counter() - start_time, 3)})
 
-        # Commit any remaining rows
-        if row_count % 5000 != 0:
-            conn.commit()
-            logging.info(f"Committed {row_count % 5000} rows.")
-            print(f"Committed {row_count % 5000} rows.")
+                # Save the checkpoint
+                if not merge:
+                    with cost_metrics.metrics.timer('sql_checkpoint_seconds', **metric_labels):
+                        save_checkpoint(conn, json_file_path, row_count, version)
 
-            # Save the checkpoint
-            save_checkpoint(conn, json_file_path, row_count)
-        
-        logging.info(f"Data from {json_file_path} successfully inserted into AzureResourceCost table.")
-        print(f"Data from {json_file_path} successfully inserted into AzureResourceCost table.")
-        logging.info(f"Total rows inserted: {row_count}")
-        print(f"Total rows inserted: {row_count}")
+        for record in data:
+            params = cost_sql.azure_resource_cost_params(record)
+            batch.append(params + (load_key,) if merge else params)
+            if len(batch) == batch_size or (row_count + len(batch)) % commit_size == 0:
+                flush_batch()
+
+        if batch:
+            flush_batch()
+
+        # Commit any remaining rows
+        if row_count % commit_size != 0 and not merge:
+            with cost_metrics.metrics.timer('sql_commit_seconds', **metric_labels):
+                conn.commit()
+            file_log.info(f"Committed {row_count % commit_size} rows.", extra={'rows': row_count})
+
+        if merge:
+            # Replace the rows of the file's subscription months with the staged rows. The checkpoint is saved in the same
+            # transaction, so the file is either merged and complete or staged again by the next run
+            with cost_metrics.metrics.timer('sql_merge_seconds', **metric_labels):
+                cost_sql.merge_staged_rows(cursor, load_key)
+
+        # Save the checkpoint, marking the file complete
+        save_checkpoint(conn, json_file_path, row_count, version, complete=True)
+
+        elapsed = time.perf_counter() - start_time
+        rows_per_second = inserted_rows / max(elapsed, 1e-9)
+        # Whole file, including reading and parsing the records
+        cost_metrics.metrics.observe('load_file_seconds', elapsed, **metric_labels)
+        file_log.info(f"Data from {json_file_path} successfully inserted into AzureResourceCost table.")
+        file_log.info(f"Total rows inserted: {row_count}", extra={'rows': row_count})
+        file_log.info(f"Inserted {inserted_rows} rows in {elapsed:.2f} seconds ({rows_per_second:.0f} rows/sec)", extra={'rows': inserted_rows, 'elapsed': round(elapsed, 3)})
 
         return row_count
     except Exception as e:
-        logging.error(f"Error processing file {json_file_path}: {e}")
-        print(f"Error processing file {json_file_path}: {e}")
+        log.error(f"Error processing file {json_file_path}: {e}", extra={'file': checkpoint_file_key(json_file_path)})
         raise    
 
+# Function to delete the rows loaded in insert mode from a previous version of a cost data file: the rows of its
+# subscriptions and billing months, read from the current version. The checkpoint of the file is reset to its first row
+# in the same transaction, so an interrupted run deletes them again rather than loading the file twice
+def delete_loaded_rows(conn, file_path, version):
+    keys = set()
+    for record in cost_output.iter_cost_records(file_path):
+        params = cost_sql.azure_resource_cost_params(record)
+        keys.add((params[1], params[9]))
+    cursor = conn.cursor()
+    for subscription_id, billing_month in sorted(keys):
+        cursor.execute("DELETE FROM AzureResourceCost WHERE SubscriptionId = ? AND BillingMonth = ?", (subscription_id, billing_month))
+    save_checkpoint(conn, file_path, 0, version)
+    log.info(f"Deleted the rows of {len(keys)} subscription month(s) loaded from the previous version of {file_path}")
+
+# Function to load a cost data file with a connection of the pool, resuming from its own checkpoint.
+# Files already complete with the same content are skipped, files whose content changed are loaded again
+def load_cost_data_file(file_path, pool, checkpoints):
+    checkpoint = checkpoints.get(checkpoint_file_key(file_path))
+    version = file_version(file_path, checkpoint)
+    start_row = 0
+    changed = False
+    if checkpoint and checkpoint['content_hash'] == version[0]:
+        if checkpoint['complete']:
+            log.info(f"Skipping file {file_path}, its {checkpoint['total_rows']} rows are already loaded")
+            if (checkpoint['file_size'], checkpoint['file_mtime']) != version[1:]:
+                # Same content with a new modification time: record it so that the file isn't hashed on the next runs
+                conn = pool.get()
+                try:
+                    save_checkpoint(conn, file_path, checkpoint['total_rows'], version, complete=True)
+                finally:
+                    pool.put(conn)
+            return checkpoint['total_rows']
+        start_row = checkpoint['last_row']
+    elif checkpoint:
+        log.warning(f"File {file_path} changed since it was loaded ({checkpoint['last_row']} rows), loading it again from the first row")
+        changed = checkpoint['last_row'] > 0
+
+    conn = pool.get()
+    try:
+        # Process the file (you can add your processing logic here)
+        log.info(f"Processing file: {file_path} from row {start_row}")
+
+        # The merge mode replaces the rows of the file's subscription months, the insert mode would add them a second time
+        if changed and load_mode == 'insert':
+            delete_loaded_rows(conn, file_path, version)
+
+        # Process the file & save the checkpoint
+        return push_azure_resource_cost_json_to_sql(file_path, conn, start_row, version=version)
+    except Exception as e:
+        log.error(f"Error processing file {file_path}: {e}")
+        raise
+    finally:
+        pool.put(conn)
+
 def main():
+    # Structured (JSON lines) log of the run, next to the console output
+    cost_logging.setup_logging(log_file_name)
     try:
-        # Establish the connection       
-        # conn = pyodbc.connect(f'DRIVER={driver};SERVER={server};PORT=1433;DATABASE={database};UID={username};PWD={password}')
-        conn = pyodbc.connect(f"DRIVER={driver};SERVER={server};PORT=1433;DATABASE={database};UID={username};PWD={password};;Authentication=ActiveDirectoryServicePrincipal;Encrypt=yes;TrustServerCertificate=no;Connection Timeout=30;")
-        # cursor = conn.cursor()
-        logging.info("Connection to Azure SQL Database established successfully.")
-        print("Connection to Azure SQL Database established successfully.")
-    
         # Loop through the folders: output/year/month
-        base_folder = 'output'
         processed_folder = 'processed'
 
         # Ensure the processed folder exists
         if not os.path.exists(processed_folder):
             os.makedirs(processed_folder)
 
-        # Resume from the last checkpoint 
-        last_file, last_row = get_last_checkpoint(conn)
-        logging.info(f"Resuming from checkpoint: File={last_file}, Row={last_row}")
-        print(f"Resuming from checkpoint: File={last_file}, Row={last_row}")
-
         # Create a mapping of month abbreviations to their order
         month_order = {month: index for index, month in enumerate(calendar.month_abbr) if month}
 
+        # Collect the cost data files to load
+        cost_data_files = []
         for year_folder in sorted(os.listdir(base_folder)):  # Sort year folders
             year_path = os.path.join(base_folder, year_folder)
             if os.path.isdir(year_path):  # Check if it's a directory
@@ -377,76 +407,46 @@ def main():
                     if os.path.isdir(month_path):  # Check if it's a directory
                         for file in sorted(os.listdir(month_path)):  # Sort files
                             file_path = os.path.join(month_path, file)
-                            
-                            # # Process only files that start with 'billing_account_cost_summary'
-                            # if os.path.isfile(file_path):
-                            #     try:
-                            #         if file.startswith('billing_account_cost_summary'):
-                            #             # Process the file (you can add your processing logic here)
-                            #             logging.info(f"Processing file: {file_path}")
-                            #             print(f"Processing file: {file_path}")
-
-                            #             push_billing_account_cost_csv_to_sql(file_path, conn)
-                                        
-                            #             # # Move the processed file to the processed folder
-                            #             # processed_file_path = os.path.join(processed_folder, file)
-                            #             # shutil.move(file_path, processed_file_path)
-                            #             logging.info(f"Moved file {file} to {processed_folder}")
-                            #             print(f"Moved file {file} to {processed_folder}")
-                            #     except Exception as e:
-                            #         logging.error(f"Error processing file {file_path}: {e}")
-                            #         raise
-
-                            # # Process only files that start with 'subscription_cost_summary'
-                            # if file.startswith('subscription_cost_summary'):
-                            #     try:                                    
-                            #         # Process the file (you can add your processing logic here)
-                            #         logging.info(f"Processing file: {file_path}")
-                            #         print(f"Processing file: {file_path}")
-
-                            #         push_subscription_cost_csv_to_sql(file_path, conn)
-                                    
-                            #         # # Move the processed file to the processed folder
-                            #         # processed_file_path = os.path.join(processed_folder, file)
-                            #         # shutil.move(file_path, processed_file_path)
-                            #         logging.info(f"Moved file {file} to {processed_folder}")
-                            #         print(f"Moved file {file} to {processed_folder}")
-                            #     except Exception as e:
-                            #         logging.error(f"Error processing file {file_path}: {e}")
-                            #         raise     
-
-                            # Process only files that start with 'azure_cost_data'
-                            if file.startswith('azure_cost_data'):
-                                # Skip files that have already been processed
-                                if last_file and os.path.abspath(file_path) < os.path.abspath(last_file):
-                                    continue
-
-                                try:                                    
-                                    # Process the file (you can add your processing logic here)
-                                    logging.info(f"Processing file: {file_path}")
-                                    print(f"Processing file: {file_path}")
-
-                                    # push_azure_resource_cost_json_to_sql(file_path, conn)
-
-                                    # Process the file & save the checkpoint
-                                    row_count = push_azure_resource_cost_json_to_sql(file_path, conn, last_row if file_path == last_file else 0)
-
-                                    last_row = 0  # Reset last_row for the next file
-                                    
-                                    # # Move the processed file to the processed folder
-                                    # processed_file_path = os.path.join(processed_folder, file)
-                                    # shutil.move(file_path, processed_file_path)
-                                    logging.info(f"Moved file {file} to {processed_folder}")
-                                    print(f"Moved file {file} to {processed_folder}")
-                                except Exception as e:
-                                    logging.error(f"Error processing file {file_path}: {e}")
-                                    raise                                                         
-        
-        # Close the database connection
-        conn.close()        
+
+                            # Process only files that start with 'azure_cost_data' (skipping their .idx byte-offset index)
+                            if cost_output.is_cost_data_file(file):
+                                cost_data_files.append(file_path)
+
+        # Establish a pool of connections, one per worker, after checking that the load mode fits the table schema
+        workers = max(1, min(load_workers, len(cost_data_files)))
+        pool = cost_sql.create_connection_pool(workers, load_mode)
+        log.info(f"{workers} connection(s) to Azure SQL Database established successfully.")
+
+        # Load the checkpoints of all the files once, each worker then looks up its file in the dictionary
+        conn = pool.get()
+        try:
+            checkpoints = load_file_checkpoints(conn)
+        finally:
+            pool.put(conn)
+        log.info(f"Loaded the checkpoints of {len(checkpoints)} files")
+
+        # Load the files in parallel, each one resuming from its own checkpoint
+        log.info(f"Loading {len(cost_data_files)} cost data files with {workers} worker(s)")
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(load_cost_data_file, file_path, pool, checkpoints) for file_path in cost_data_files]
+                try:
+                    for future in as_completed(futures):
+                        future.result()
+                except Exception:
+                    # Stop the files which haven't started yet, the others resume from their checkpoint on the next run
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            # Close the database connections
+            cost_sql.close_connection_pool(pool)
     except Exception as e:
-        logging.error(f"An error occurred: {e}")
-        print(f"An error occurred: {e}")
+        log.error(f"An error occurred: {e}")
+    finally:
+        # Timings and counters of the load, also written when it fails
+        cost_metrics.write_run_report(run_summary_file_name, prometheus_file)
+        log.info(f"Load summary written to {run_summary_file_name}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,19 +1,39 @@
 import os
 import requests
 import csv
-from datetime import datetime, timedelta
+from datetime import datetime, date, timedelta
 import calendar
 import json
 import time
 import re
+import math
+import threading
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import argparse
+import logging
 # Import custom modules
-import logger
+import cost_logging
+import cost_output
+import cost_client
+import cost_client_async
+import rate_limiter
+import cost_cache
+import cost_sql
+import cost_metrics
+import cost_records
+import cost_reconcile
+import cost_profiles
+
+log = logging.getLogger('finops_cost')
 
 # Define the necessary variables
 tenant_id = os.getenv('TENANT_ID')
 client_id = os.getenv('FINOPS_AZURE_CLIENT_ID')
 client_secret = os.getenv('FINOPS_AZURE_CLIENT_SECRET')
 billing_account = os.getenv('BILLING_ACCOUNT')
+# Azure Resource Manager endpoint of the Cost Management queries, can be pointed at a local mock (see benchmark.py)
+management_endpoint = os.getenv('AZURE_MANAGEMENT_ENDPOINT', 'https://management.azure.com')
 
 # Specify the month for which you want to get the total cost
 output_dir = 'output'
@@ -24,30 +44,121 @@ subscription_cost_summary_csv_file = "subscription_cost_summary"
 
 next_link_file = 'next_link.txt'
 
-# Function to obtain a new OAuth 2.0 token
-def get_access_token(tenant_id, client_id, client_secret):
-    token_url = f'https://login.microsoftonline.com/{tenant_id}/oauth2/token'
-    token_data = {
-        'grant_type': 'client_credentials',
-        'client_id': client_id,
-        'client_secret': client_secret,
-        'resource': 'https://management.azure.com/'
-    }
-    token_r = requests.post(token_url, data=token_data)
-    return token_r.json().get('access_token')
+# Format of the per-subscription cost data files: 'json' (single array), 'ndjson' (one row per line, streamed page by page)
+# or 'parquet' (columnar, requires pyarrow)
+output_format = os.getenv('FINOPS_OUTPUT_FORMAT', cost_output.OUTPUT_FORMAT_JSON)
+
+# Resume the extraction from the nextLink checkpoints of a previous run and skip the subscriptions already complete
+resume_extraction = os.getenv('FINOPS_RESUME', 'false').lower() == 'true'
+
+# Refresh the months incrementally: query only the days since the last run with daily granularity and merge them
+incremental_extraction = os.getenv('FINOPS_INCREMENTAL', 'false').lower() == 'true'
+# Days already retrieved which are queried again by each incremental run, as the cost of recent days is still updated
+incremental_lookback_days = int(os.getenv('FINOPS_INCREMENTAL_LOOKBACK_DAYS', '3'))
+
+# Pipeline mode: load the pages straight into AzureResourceCost as they arrive, instead of writing the cost data files
+# loaded later by export-to-sql.py. Each subscription has a background insert thread fed by a queue of at most
+# FINOPS_PIPELINE_QUEUE_PAGES pages, so fetching and loading overlap. Incremental and partitioned extraction need
+# the files and are not pipelined, and a pipelined query can't resume (FINOPS_RESUME). The load mode is the SQL_LOAD_MODE
+# of export-to-sql.py (see cost_sql): the merge mode makes reruns idempotent
+pipeline_mode = os.getenv('FINOPS_PIPELINE', 'false').lower() == 'true'
+pipeline_queue_pages = int(os.getenv('FINOPS_PIPELINE_QUEUE_PAGES', '8'))
+pipeline_load_mode = cost_sql.load_mode
+pipeline_batch_size = int(os.getenv('SQL_BATCH_SIZE', '5000'))
+pipeline_bulk_insert = os.getenv('SQL_BULK_INSERT', 'true').lower() == 'true'
+
+# Prometheus text file written with the metrics of the run (e.g. for the node_exporter textfile collector), in addition
+# to the run_summary_<timestamp>.json file of the output folder
+prometheus_file = os.getenv('FINOPS_PROMETHEUS_FILE')
+
+# Extraction profile of the subscription cost queries: their grouping, granularity and metric (see cost_profiles.py).
+# FINOPS_PROFILE names the profile (additional profiles can be defined in FINOPS_PROFILES_FILE); main can instead choose
+# the coarsest profile with the columns of a report. Profiles other than 'resource' are written to a <profile> folder
+# of the month, which export-to-sql.py doesn't load
+profiles = cost_profiles.load_profiles(os.getenv('FINOPS_PROFILES_FILE'))
+extraction_profile_name = os.getenv('FINOPS_PROFILE', cost_profiles.DEFAULT_PROFILE)
+
+# With FINOPS_PROBE=true, the pages of a subscription which was never extracted with the profile are estimated from a
+# probe query over the first FINOPS_PROBE_DAYS days of the month (up to FINOPS_PROBE_MAX_PAGES pages), so that the large
+# subscriptions are split from their first extraction
+probe_estimates = os.getenv('FINOPS_PROBE', 'false').lower() == 'true'
+probe_days = int(os.getenv('FINOPS_PROBE_DAYS', '1'))
+probe_max_pages = int(os.getenv('FINOPS_PROBE_MAX_PAGES', '2'))
+
+# Number of subscriptions retrieved in parallel by process_monthly_costs
+max_workers = int(os.getenv('FINOPS_MAX_WORKERS', '4'))
+
+# Extraction backend of main: 'threads' (one worker thread per subscription in flight) or 'async' (the queries of all the
+# subscriptions multiplexed on one asyncio event loop, see cost_client_async.py). The async backend retrieves up to
+# FINOPS_ASYNC_CONCURRENCY subscription months at once over FINOPS_ASYNC_POOL_SIZE keep-alive connections
+extraction_backend = os.getenv('FINOPS_BACKEND', 'threads').lower()
+async_concurrency = int(os.getenv('FINOPS_ASYNC_CONCURRENCY', '200'))
+async_pool_size = int(os.getenv('FINOPS_ASYNC_POOL_SIZE', '100'))
+
+# Subscriptions whose last extraction returned more rows than the threshold are split into partitions (sub-queries on
+# disjoint ResourceGroup / ResourceLocation values, or on date ranges with 'UsageDate') which are paginated concurrently
+split_row_threshold = int(os.getenv('FINOPS_SPLIT_ROW_THRESHOLD', '50000'))
+split_rows_per_partition = int(os.getenv('FINOPS_SPLIT_ROWS_PER_PARTITION', '25000'))
+split_max_partitions = int(os.getenv('FINOPS_SPLIT_MAX_PARTITIONS', '8'))
+split_dimension = os.getenv('FINOPS_SPLIT_DIMENSION', 'ResourceGroup')
+# Number of partitions of a subscription paginated in parallel
+split_workers = int(os.getenv('FINOPS_SPLIT_WORKERS', '4'))
+# Relative difference tolerated between the total of a split subscription and its billing account total
+reconcile_tolerance = float(os.getenv('FINOPS_RECONCILE_TOLERANCE', '0.01'))
+
+# Once all the subscriptions of a month are retrieved, their totals are reconciled with the billing account totals
+# (reconciliation_<month>_<year>.csv). Subscriptions whose delta is above FINOPS_RECONCILE_TOLERANCE and
+# FINOPS_RECONCILE_MIN_DELTA are extracted again, up to FINOPS_RECONCILE_RETRIES times. The default 0 only writes the
+# report: the billing account totals include the marketplace and reservation charges that the subscription queries
+# don't return, so these subscriptions always show a delta and would be extracted twice on every run
+reconcile_min_delta = float(os.getenv('FINOPS_RECONCILE_MIN_DELTA', '1'))
+reconcile_retries = int(os.getenv('FINOPS_RECONCILE_RETRIES', '0'))
+
+# File keeping the number of rows of the last extraction of each subscription, used to decide which ones to split
+row_count_stats_file = os.path.join(output_dir, 'subscription_row_counts.json')
+row_count_stats_lock = threading.Lock()
+
+# Days after the end of a month during which its cost may still change. The month is closed afterwards: its cached
+# responses are kept for FINOPS_CACHE_CLOSED_TTL_HOURS and its billing account summary is reused by the backfill
+settle_days = int(os.getenv('FINOPS_SETTLE_DAYS', str(cost_cache.SETTLE_DAYS)))
+
+# On-disk cache of the Cost Management responses, so that repeated runs over closed months make no API calls.
+# Off by default: FINOPS_CACHE=true turns it on, it keeps a copy of the responses of up to FINOPS_CACHE_MAX_MB on disk.
+# FINOPS_CACHE_BYPASS=true ignores the cached responses (they are still refreshed with the new ones)
+cache_enabled = os.getenv('FINOPS_CACHE', 'false').lower() == 'true'
+response_cache = cost_cache.ResponseCache(
+    os.getenv('FINOPS_CACHE_DIR', 'cache'),
+    closed_ttl=float(os.getenv('FINOPS_CACHE_CLOSED_TTL_HOURS', '720')) * 3600,
+    open_ttl=float(os.getenv('FINOPS_CACHE_OPEN_TTL_HOURS', '1')) * 3600,
+    max_bytes=int(os.getenv('FINOPS_CACHE_MAX_MB', '2048')) * 1024 * 1024,
+    settle_days=settle_days,
+    bypass=os.getenv('FINOPS_CACHE_BYPASS', 'false').lower() == 'true'
+) if cache_enabled else None
+
+# Scheduler shared by all the concurrent Cost Management requests. It paces the requests (default 12 requests
+# per 10 seconds, the QPU limit of the API) and pauses every worker for the retry-after time returned on a 429
+request_scheduler = rate_limiter.RequestScheduler(
+    rate=float(os.getenv('FINOPS_REQUESTS_PER_SECOND', '1.2')),
+    capacity=int(os.getenv('FINOPS_REQUEST_BURST', '12'))
+)
+
+# Function to create the client shared by all the Cost Management calls of a run
+def create_cost_management_client(pool_size=None):
+    token_manager = cost_client.TokenManager(tenant_id, client_id, client_secret)
+    return cost_client.CostManagementClient(token_manager, request_scheduler, pool_size=pool_size or max_workers)
+
+# Function to create the client of the asyncio backend, with the request scheduler of the threaded client
+def create_async_cost_management_client(pool_size=None):
+    token_manager = cost_client.TokenManager(tenant_id, client_id, client_secret)
+    return cost_client_async.AsyncCostManagementClient(token_manager, request_scheduler, pool_size=pool_size or async_pool_size)
 
 # Function to sanitize file names by removing invalid characters
 def sanitize_filename(name):
-    return re.sub(r'[\/:*?"<>|]', '_', name)
+    return cost_output.sanitize_filename(name)
 
-# Function to query cost data for each subscription in a billing account
-def query_cost_by_subscription_in_billing_account(billing_account, access_token, start_date, end_date):
-    cost_management_url = f'https://management.azure.com/providers/Microsoft.Billing/billingAccounts/{billing_account}/providers/Microsoft.CostManagement/query?api-version=2021-10-01'
-
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json'
-    }
+# Function to build the url and the request body of the query of the cost of each subscription in a billing account
+def billing_account_query(billing_account, start_date, end_date):
+    cost_management_url = f'{management_endpoint}/providers/Microsoft.Billing/billingAccounts/{billing_account}/providers/Microsoft.CostManagement/query?api-version=2021-10-01'
 
     # Define the request body to group by SubscriptionId
     grouping = [
@@ -80,149 +191,581 @@ def query_cost_by_subscription_in_billing_account(billing_account, access_token,
         }
     }
 
-    response = requests.post(cost_management_url, headers=headers, json=body)
+    return cost_management_url, body
+
+# Function to query cost data for each subscription in a billing account
+def query_cost_by_subscription_in_billing_account(billing_account, client, start_date, end_date):
+    cost_management_url, body = billing_account_query(billing_account, start_date, end_date)
+
+    # Serve the response from the cache when the same query was already made
+    cached_pages = response_cache.get(cost_management_url, body) if response_cache else None
+    if cached_pages is not None:
+        return next(cached_pages)
+
+    response = client.post(cost_management_url, body)
     # response.raise_for_status()
-    return response.json()
+    data = response.json()
+    if response_cache and response.status_code == 200:
+        response_cache.put(cost_management_url, body, data)
+    return data
 
-# Function to make the request with pagination and retry logic
-def get_cost_data_with_pagination_retries(year, month, subscription_id, access_token, log_file, json_file, next_link_file, max_retries=10, backoff_factor=1):
-    cost_data = []
+# asyncio version of query_cost_by_subscription_in_billing_account, with a cost_client_async.AsyncCostManagementClient
+async def query_cost_by_subscription_in_billing_account_async(billing_account, client, start_date, end_date):
+    cost_management_url, body = billing_account_query(billing_account, start_date, end_date)
+
+    cached_pages = response_cache.get(cost_management_url, body) if response_cache else None
+    if cached_pages is not None:
+        return next(cached_pages)
+
+    response = await client.post(cost_management_url, body)
+    data = response.json()
+    if response_cache and response.status_code == 200:
+        response_cache.put(cost_management_url, body, data)
+    return data
+
+# Headers of the subscription cost queries (Authorization and Content-Type are added by the client)
+cost_data_query_headers = {
+    'ClientType': 'CPS-Dashboard',
+    'X-Ms-Command-Name': 'CostAnalysis' # Added header due to error 429 https://learn.microsoft.com/en-us/answers/questions/1340993/exception-429-too-many-requests-for-azure-cost-man
+}
+
+# Function to build the Cost Management query endpoint with subscription scope
+def subscription_query_url(subscription_id):
+    return f'{management_endpoint}/subscriptions/{subscription_id}/providers/Microsoft.CostManagement/query?api-version=2021-10-01'
+
+# Function to return the extraction profile of the run
+def extraction_profile():
+    if extraction_profile_name not in profiles:
+        raise ValueError(f"Unknown extraction profile '{extraction_profile_name}'. Expected one of {sorted(profiles)}")
+    return profiles[extraction_profile_name]
+
+# Function to build the request body of the subscription cost query, grouped as defined by the extraction profile
+# (by resource, meter and tags by default). granularity overrides the one of the profile: 'None' for one row per group
+# for the whole period, or 'Daily' to add a UsageDate column
+def build_cost_data_query_body(start_date, end_date, granularity=None, profile=None):
+    return cost_profiles.query_body(profile or extraction_profile(), start_date, end_date, granularity)
+
+# Function to save the pagination state of a subscription after each page written to the output file
+# The checkpoint is complete once the last page has been written (no nextLink left). Queries which can't be resumed
+# (pipeline mode) have no checkpoint file (None)
+def save_next_link_checkpoint(next_link_file, next_link, row_count, total_cost):
+    if next_link_file is None:
+        return
+    checkpoint = {
+        'next_link': next_link,
+        'row_count': row_count,
+        'total_cost': total_cost,
+        'complete': not next_link
+    }
+    # Write to a temporary file first so that a crash never leaves a truncated checkpoint
+    temp_file = next_link_file + '.tmp'
+    with open(temp_file, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(temp_file, next_link_file)
+
+# Function to read the pagination state saved by save_next_link_checkpoint
+def read_next_link_checkpoint(next_link_file):
+    if next_link_file is None or not os.path.exists(next_link_file):
+        return None
+    try:
+        with open(next_link_file, 'r') as file:
+            return json.load(file)
+    except ValueError:
+        # Checkpoints of older runs only contain the nextLink without the row count, they can't be resumed safely
+        return None
+
+# Generator of the requests of a paginated subscription query, shared by the threaded and the asyncio backends.
+# It yields the (url, body) of each request and is sent back its response; the pages are written, checkpointed and
+# cached as they arrive. Returns (StopIteration value) the number of rows retrieved and their total cost
+def cost_data_pagination_steps(year, month, subscription_id, log_file, json_file, next_link_file, output_format=cost_output.OUTPUT_FORMAT_JSON, resume=False, body=None, writer=None):
+    # Each page is handed to the writer as it arrives; only the running totals are kept here.
+    # A writer can be given to send the pages elsewhere, e.g. cost_sql.SqlCostDataWriter in pipeline mode
+    writer = writer or cost_output.CostDataWriter(json_file, output_format)
     # Define the API endpoint with subscription scope
-    cost_management_url = f'https://management.azure.com/subscriptions/{subscription_id}/providers/Microsoft.CostManagement/query?api-version=2021-10-01'
+    cost_management_url = subscription_query_url(subscription_id)
 
     # Calculate the start and end dates for the specified month
     start_date = datetime(year, month, 1).strftime('%Y-%m-%d')
     end_date = datetime(year, month, calendar.monthrange(year, month)[1]).strftime('%Y-%m-%d')
 
-    # Set up the headers
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'Content-Type': 'application/json',
-        'ClientType': 'CPS-Dashboard',
-        'X-Ms-Command-Name': 'CostAnalysis' # Added header due to error 429 https://learn.microsoft.com/en-us/answers/questions/1340993/exception-429-too-many-requests-for-azure-cost-man
-    }
+    # Define the request body to include resource and tag details (unless a partition query is given)
+    body = body or build_cost_data_query_body(start_date, end_date)
 
-    # Define the request body to include specific tag keys
-    tag_keys = ['costcenter']  # Example tag keys
+    # Records of this query carry the subscription, the month and the subscription log file
+    query_log = cost_logging.bind(log, subscription=subscription_id, month=f'{year}-{month:02d}', file=json_file, log_file=log_file)
 
-    grouping = [
-        {"type": "Dimension", "name": "SubscriptionName"},
-        {"type": "Dimension", "name": "ResourceGroup"},
-        {"type": "Dimension", "name": "ResourceId"},
-        {"type": "Dimension", "name": "ConsumedService"},    
-        {"type": "Dimension", "name": "MeterSubcategory"},  
-        {"type": "Dimension", "name": "MeterCategory"},  
-        {"type": "Dimension", "name": "ResourceLocation"},  
-        {"type": "Dimension", "name": "BillingMonth"},        
-    ]
+    # Timings and counters of the query, per subscription and month
+    metric_labels = {'subscription': subscription_id, 'month': f'{year}-{month:02d}'}
+
+    # Function to write a page to the output and count its rows
+    def write_page(data):
+        rows = data['properties']['rows']
+        with cost_metrics.metrics.timer('extract_write_seconds', **metric_labels):
+            writer.write_page(rows, [column['name'] for column in data['properties'].get('columns', [])] or None)
+        cost_metrics.metrics.increment('extract_rows_total', len(rows), **metric_labels)
+        cost_metrics.metrics.increment('extract_pages_total', **metric_labels)
+
+    # Function to log a failed request with the response of the API
+    def log_failure(response):
+        query_log.error(f"Failed to retrieve cost data. Status Code: {response.status_code}", extra={'status': response.status_code})
+        query_log.error(response.text, extra={'status': response.status_code})
+
+    # Check the nextLink checkpoint left by a previous run
+    checkpoint = read_next_link_checkpoint(next_link_file) if resume else None
+    if checkpoint and not os.path.exists(json_file):
+        checkpoint = None
+
+    if checkpoint and checkpoint['complete']:
+        # The output of this subscription is already complete
+        query_log.info(f"Cost data already retrieved to {json_file}, skipping the subscription.", extra={'rows': checkpoint['row_count']})
+        return checkpoint['row_count'], checkpoint['total_cost']
+
+    # Pages of the query are added to the response cache, which is only written once the whole chain is retrieved.
+    # A resumed query doesn't have its first pages anymore, so it isn't cached
+    cache_entry = None
+    try:
+        if checkpoint:
+            # Continue after the last page written to the output file
+            writer.resume(checkpoint['row_count'], checkpoint['total_cost'])
+            next_link = checkpoint['next_link']
+            query_log.info(f"Resuming from the nextLink checkpoint after {writer.row_count} resources...", extra={'rows': writer.row_count})
+        else:
+            # Discard any checkpoint which doesn't match the output file
+            if next_link_file is not None and os.path.exists(next_link_file):
+                os.remove(next_link_file)
+
+            # Write the pages from the response cache when the same query was already made
+            cached_pages = response_cache.get(cost_management_url, body) if response_cache else None
+            if cached_pages is not None:
+                for data in cached_pages:
+                    write_page(data)
+                writer.close()
+                save_next_link_checkpoint(next_link_file, None, writer.row_count, writer.total_cost)
+                query_log.info(f"Cost data of {writer.row_count} resources served from the response cache", extra={'rows': writer.row_count})
+                return writer.row_count, writer.total_cost
 
-    # Add tag keys to the grouping
-    for tag_key in tag_keys:
-        grouping.append({"type": "TagKey", "name": tag_key})
+            # Initial request to check if pagination is needed
+            request_start = time.perf_counter()
+            response = yield cost_management_url, body
+            if response.status_code != 200:
+                log_failure(response)
+                # A failed query isn't an empty subscription: the caller aborts it so that it's retried or reported
+                raise Exception(f"Failed to retrieve cost data. Status Code: {response.status_code}")
 
-    # Define the request body to include resource and tag details
+            data = response.json()
+            if response_cache:
+                cache_entry = response_cache.open_entry(cost_management_url, body)
+                cache_entry.add_page(data)
+            next_link = data.get('properties', {}).get('nextLink')
+
+            # Write the data to the output file incrementally
+            write_page(data)
+            query_log.info(f"Processed {writer.row_count} resources so far...", extra={'page': 1, 'rows': writer.row_count, 'elapsed': round(time.perf_counter() - request_start, 3)})
+            # Save the nextLink checkpoint once the page is in the output file
+            save_next_link_checkpoint(next_link_file, next_link, writer.row_count, writer.total_cost)
+
+        # If there's a next link, continue with pagination
+        page = 1
+        while next_link:
+            page += 1
+            request_start = time.perf_counter()
+            response = yield next_link, body
+            if response.status_code != 200:
+                log_failure(response)
+                # Keep the checkpoint so that the subscription can be resumed from this page
+                raise Exception(f"Failed to retrieve cost data. Status Code: {response.status_code}." + (f" Resume from checkpoint {next_link_file}" if next_link_file else ''))
+
+            data = response.json()
+            if cache_entry:
+                cache_entry.add_page(data)
+            # Write the data to the output file incrementally
+            write_page(data)
+            query_log.info(f"Processed {writer.row_count} resources so far...", extra={'page': page, 'rows': writer.row_count, 'elapsed': round(time.perf_counter() - request_start, 3)})
+
+            next_link = data.get('properties', {}).get('nextLink')
+
+            # Save the nextLink checkpoint once the page is in the output file
+            save_next_link_checkpoint(next_link_file, next_link, writer.row_count, writer.total_cost)
+
+        with cost_metrics.metrics.timer('extract_write_seconds', **metric_labels):
+            writer.close()
+        if cache_entry:
+            cache_entry.commit()
+
+        # The checkpoint is kept after successful completion (complete = true) so that reruns can skip the subscription
+        return writer.row_count, writer.total_cost
+    except BaseException:
+        # Also reached when the driver closes the steps after a failed request (GeneratorExit): the incomplete cache
+        # entry is dropped and the output closed, keeping the pages written so far for the checkpoint
+        if cache_entry:
+            cache_entry.abort()
+        try:
+            writer.close()
+        except Exception:
+            pass
+        raise
+
+# Function to run the pagination steps up to their next request, sending them the `response` of the previous one.
+# Returns (request, None), or (None, result) once the query is complete
+def advance_pagination(steps, response=None):
+    try:
+        return (next(steps) if response is None else steps.send(response)), None
+    except StopIteration as done:
+        return None, done.value
+
+# Function to make the request with pagination and retry logic
+# Returns the number of rows retrieved and their total cost
+def get_cost_data_with_pagination_retries(year, month, subscription_id, client, log_file, json_file, next_link_file, max_retries=10, backoff_factor=1, output_format=cost_output.OUTPUT_FORMAT_JSON, resume=False, body=None, writer=None):
+    metric_labels = {'subscription': subscription_id, 'month': f'{year}-{month:02d}'}
+    steps = cost_data_pagination_steps(year, month, subscription_id, log_file, json_file, next_link_file, output_format=output_format, resume=resume, body=body, writer=writer)
+    request, result = advance_pagination(steps)
+    while request is not None:
+        url, body = request
+        # Authorization and Content-Type headers are added by the client
+        try:
+            with cost_metrics.metrics.timer('extract_request_seconds', **metric_labels):
+                response = client.post(url, body, headers=cost_data_query_headers, max_retries=max_retries, log_file=log_file)
+        except BaseException:
+            # Let the steps release their output and cache entry
+            steps.close()
+            raise
+        request, result = advance_pagination(steps, response)
+    return result
+
+# asyncio version of get_cost_data_with_pagination_retries, with a cost_client_async.AsyncCostManagementClient.
+# Only the requests run on the event loop: parsing and writing the pages is done in a worker thread so that the
+# other subscriptions' requests keep being served meanwhile
+async def get_cost_data_with_pagination_retries_async(year, month, subscription_id, client, log_file, json_file, next_link_file, max_retries=10, output_format=cost_output.OUTPUT_FORMAT_JSON, resume=False, body=None, writer=None):
+    metric_labels = {'subscription': subscription_id, 'month': f'{year}-{month:02d}'}
+    steps = cost_data_pagination_steps(year, month, subscription_id, log_file, json_file, next_link_file, output_format=output_format, resume=resume, body=body, writer=writer)
+    request, result = await asyncio.to_thread(advance_pagination, steps)
+    while request is not None:
+        url, body = request
+        try:
+            with cost_metrics.metrics.timer('extract_request_seconds', **metric_labels):
+                response = await client.post(url, body, headers=cost_data_query_headers, max_retries=max_retries, log_file=log_file)
+        except BaseException:
+            # Let the steps release their output and cache entry (also when the task is cancelled)
+            steps.close()
+            raise
+        request, result = await asyncio.to_thread(advance_pagination, steps, response)
+    return result
+
+# Function to write rows to a new cost data file in pages of cost_output.INDEX_INTERVAL rows
+def write_cost_data_file(json_file, rows, columns=None, output_format=cost_output.OUTPUT_FORMAT_JSON):
+    with cost_output.CostDataWriter(json_file, output_format) as writer:
+        page = []
+        for row in rows:
+            page.append(row)
+            if len(page) >= cost_output.INDEX_INTERVAL:
+                writer.write_page(page, columns)
+                page = []
+        if page or writer.row_count == 0:
+            writer.write_page(page, columns)
+    return writer.row_count, writer.total_cost
+
+# Function to query all the pages of a cost query. Yields the column names and the rows of each page
+def iter_cost_query_pages(client, url, body, log_file, max_retries=10):
+    cached_pages = response_cache.get(url, body) if response_cache else None
+    if cached_pages is not None:
+        for data in cached_pages:
+            properties = data.get('properties', {})
+            yield [column['name'] for column in properties.get('columns', [])], properties.get('rows', [])
+        return
+
+    cache_entry = response_cache.open_entry(url, body) if response_cache else None
+    try:
+        while url:
+            response = client.post(url, body, headers=cost_data_query_headers, max_retries=max_retries, log_file=log_file)
+            if response.status_code != 200:
+                log.error(f"Failed to retrieve cost data. Status Code: {response.status_code}", extra={'status': response.status_code, 'log_file': log_file})
+                log.error(response.text, extra={'status': response.status_code, 'log_file': log_file})
+                raise Exception(f"Failed to retrieve cost data. Status Code: {response.status_code}")
+            data = response.json()
+            if cache_entry:
+                cache_entry.add_page(data)
+            properties = data.get('properties', {})
+            yield [column['name'] for column in properties.get('columns', [])], properties.get('rows', [])
+            url = properties.get('nextLink')
+    except BaseException:
+        # Also reached when the caller stops before the last page
+        if cache_entry:
+            cache_entry.abort()
+        raise
+    if cache_entry:
+        cache_entry.commit()
+
+# Function to refresh the cost data of a month incrementally.
+# Only the days since the last run (plus `lookback_days` already retrieved days, as Azure keeps updating the cost of
+# recent days) are queried with daily granularity. The daily rows are merged into `daily_file`, then summed per resource
+# to rewrite `json_file` with the same rows as a full month query. Returns the number of rows and their total cost
+def get_incremental_cost_data(year, month, subscription_id, client, log_file, json_file, daily_file, output_format=cost_output.OUTPUT_FORMAT_JSON, lookback_days=3, today=None):
+    state_file = daily_file + '.state'
+    state = {}
+    if os.path.exists(state_file):
+        with open(state_file, 'r') as file:
+            state = json.load(file)
+
+    month_start = date(year, month, 1)
+    month_end = date(year, month, calendar.monthrange(year, month)[1])
+    today = today or date.today()
+    columns = state.get('columns')
+    query_log = cost_logging.bind(log, subscription=subscription_id, month=f'{year}-{month:02d}', file=json_file, log_file=log_file)
+
+    # Days to query: from the first day of the lookback window to today (or the end of the month)
+    query_from = month_start
+    query_to = min(month_end, today)
+    if state.get('last_date'):
+        query_from = max(month_start, date.fromisoformat(state['last_date']) - timedelta(days=lookback_days - 1))
+        # The month is settled once it has been refreshed lookback_days after its end
+        if date.fromisoformat(state['synced_on']) - month_end >= timedelta(days=lookback_days):
+            query_from = query_to + timedelta(days=1)
+
+    # Rows of the queried days, kept in a compact store until they are merged
+    new_rows = cost_records.CostRecordStore()
+    if query_from <= query_to:
+        body = build_cost_data_query_body(query_from.strftime('%Y-%m-%d'), query_to.strftime('%Y-%m-%d'), granularity="Daily")
+        for page_columns, rows in iter_cost_query_pages(client, subscription_query_url(subscription_id), body, log_file):
+            columns = page_columns or columns
+            new_rows.extend(rows)
+        query_log.info(f"Retrieved {len(new_rows)} daily cost records from {query_from} to {query_to}", extra={'rows': len(new_rows)})
+    else:
+        query_log.info(f"Cost data of {month_start:%b} {year} is settled, no daily cost records to retrieve")
+
+    month_rows = []
+    if columns:
+        usage_date_position = columns.index('UsageDate')
+        replaced_from = int(query_from.strftime('%Y%m%d'))
+        # Month total of each resource, summed as the daily rows are merged (every column except the cost and the day)
+        month_rows = cost_records.CostAggregator(drop_positions=[usage_date_position])
+
+        # Keep the stored days before the queried window and replace the others with the new rows
+        temp_file = daily_file + '.tmp'
+        with open(temp_file, 'w') as out:
+            if os.path.exists(daily_file):
+                with open(daily_file, 'r') as stored:
+                    for line in stored:
+                        row = json.loads(line)
+                        if int(row[usage_date_position]) < replaced_from:
+                            out.write(line)
+                            month_rows.add(row)
+            for row in new_rows:
+                out.write(json.dumps(row) + '\n')
+                month_rows.add(row)
+        os.replace(temp_file, daily_file)
+        month_columns = [column for position, column in enumerate(columns) if position != usage_date_position]
+    else:
+        month_columns = None
+
+    # Rewrite the month file from the merged daily rows
+    row_count, total_cost = write_cost_data_file(json_file, month_rows, month_columns, output_format)
+
+    # Save the last day retrieved for the next run
+    state = {'last_date': query_to.isoformat(), 'synced_on': today.isoformat(), 'columns': columns}
+    with open(state_file + '.tmp', 'w') as file:
+        json.dump(state, file)
+    os.replace(state_file + '.tmp', state_file)
+
+    return row_count, total_cost
+
+# Function to read the number of rows of the last extraction of each subscription
+def read_row_count_stats():
+    if not os.path.exists(row_count_stats_file):
+        return {}
+    with open(row_count_stats_file, 'r') as file:
+        return json.load(file)
+
+# Function to build the key of the row count of a subscription: its id for the default profile, followed by the name
+# of the profile otherwise
+def row_count_key(subscription_id):
+    if extraction_profile_name == cost_profiles.DEFAULT_PROFILE:
+        return subscription_id
+    return f'{subscription_id}/{extraction_profile_name}'
+
+# Function to record the number of rows extracted for a subscription (called by concurrent subscription workers)
+def save_row_count(subscription_id, row_count):
+    with row_count_stats_lock:
+        stats = read_row_count_stats()
+        stats[row_count_key(subscription_id)] = row_count
+        os.makedirs(os.path.dirname(row_count_stats_file) or '.', exist_ok=True)
+        with open(row_count_stats_file + '.tmp', 'w') as file:
+            json.dump(stats, file)
+        os.replace(row_count_stats_file + '.tmp', row_count_stats_file)
+
+# Function to estimate the rows and pages of the query of a subscription month with the extraction profile, from a probe
+# query of the same profile over the first `days` days of the month (see cost_profiles.estimate_pages)
+def estimate_subscription_query(client, year, month, subscription_id, log_file=None, days=probe_days, max_pages=probe_max_pages):
+    month_days = calendar.monthrange(year, month)[1]
+    days = max(1, min(days, month_days))
+    start_date = date(year, month, 1)
+    body = build_cost_data_query_body(start_date.isoformat(), (start_date + timedelta(days=days - 1)).isoformat())
+    url = subscription_query_url(subscription_id)
+    probe_rows = 0
+    probe_pages = 0
+    while url and probe_pages < max_pages:
+        response = client.post(url, body, headers=cost_data_query_headers, log_file=log_file)
+        cost_metrics.metrics.increment('probe_requests_total', profile=extraction_profile_name)
+        if response.status_code != 200:
+            raise Exception(f"Failed to run the probe query of subscription {subscription_id}. Status Code: {response.status_code}")
+        properties = response.json().get('properties', {})
+        probe_rows += len(properties.get('rows', []))
+        probe_pages += 1
+        url = properties.get('nextLink')
+    estimate = cost_profiles.estimate_pages(extraction_profile(), probe_rows, probe_pages, not url, days, month_days)
+    cost_logging.bind(log, subscription=subscription_id, month=f'{year}-{month:02d}', log_file=log_file).info(
+        f"Estimated {'at least ' if estimate['lower_bound'] else ''}{estimate['pages']} pages ({estimate['rows']} rows) for the '{extraction_profile_name}' profile from a probe of {days} day(s)",
+        extra={'rows': estimate['rows'], 'page': estimate['pages']})
+    return estimate
+
+# Function to return the expected number of rows of a subscription month: the rows of its last extraction with the
+# extraction profile or, with FINOPS_PROBE, the estimate of a probe query when it was never extracted with it
+def expected_row_count(client, year, month, subscription_id, log_file=None):
+    expected_rows = read_row_count_stats().get(row_count_key(subscription_id))
+    if expected_rows is None and probe_estimates:
+        expected_rows = estimate_subscription_query(client, year, month, subscription_id, log_file)['rows']
+    return expected_rows
+
+# Function to choose the number of partitions of a subscription from the number of rows of its last extraction
+def partition_count(expected_rows):
+    if not expected_rows or expected_rows <= split_row_threshold:
+        return 1
+    return min(split_max_partitions, math.ceil(expected_rows / split_rows_per_partition))
+
+# Function to plan the partitions of a subscription month. Returns the partitions (date range and, when splitting on a
+# dimension, the values of the dimension) and the total cost of the month, used to check that no row was missed.
+# Dimension values are spread over the partitions by descending cost, each one going to the partition with the lowest cost
+def plan_partitions(client, subscription_id, start_date, end_date, count, log_file, dimension=split_dimension):
+    # Probe query returning one row per value of the dimension (a single total row when splitting by date)
     body = {
         "type": "Usage",
         "timeframe": "Custom",
-        "timePeriod": {
-            "from": start_date,
-            "to": end_date
-        },
+        "timePeriod": {"from": start_date, "to": end_date},
         "dataset": {
             "granularity": "None",
-            "aggregation": {
-                "totalCost": {
-                    "name": "PreTaxCost",
-                    "function": "Sum"
-                }
-            },
-            "grouping": grouping
+            "aggregation": {"totalCost": {"name": "PreTaxCost", "function": "Sum"}},
+            "grouping": [] if dimension == 'UsageDate' else [{"type": "Dimension", "name": dimension}]
         }
     }
+    costs = {}
+    for columns, rows in iter_cost_query_pages(client, subscription_query_url(subscription_id), body, log_file):
+        cost_position = columns.index('PreTaxCost') if 'PreTaxCost' in columns else 0
+        value_position = columns.index(dimension) if dimension in columns else None
+        for row in rows:
+            value = row[value_position] if value_position is not None else None
+            costs[value] = costs.get(value, 0.0) + float(row[cost_position])
+    expected_total = sum(costs.values())
 
-    def make_request(url, body):
-        for attempt in range(max_retries):
-            response = requests.post(url, headers=headers, json=body)
-            if response.status_code == 429:
-                # Too many requests, apply exponential backoff
-                # wait_time = backoff_factor * (1 ** attempt)
-                wait_time = 20
-                print(f"Rate limit exceeded. Retrying in {wait_time} seconds...")
-                # Print specific headers related to rate limiting
-                rate_limit_headers = [
-                    'x-ms-ratelimit-microsoft.costmanagement-qpu-retry-after',
-                    'x-ms-ratelimit-microsoft.costmanagement-entity-retry-after',
-                    'x-ms-ratelimit-microsoft.costmanagement-tenant-retry-after',
-                    'x-ms-ratelimit-microsoft.costmanagement-client-retry-after'
-                ]
-                for header in rate_limit_headers:
-                    if header in response.headers:
-                        print(f"{header}: {response.headers[header]}")
-                with open(log_file, 'a') as log:
-                    log.write(f"Rate limit exceeded. Retrying in {wait_time} seconds...\n")
-                time.sleep(wait_time)
-            elif response.status_code == 401 and "ExpiredAuthenticationToken" in response.text:
-                # Refresh the access token if expired
-                headers['Authorization'] = f'Bearer {get_access_token()}'
-                print("Access token expired. Obtained new token")
-                logger.log_note("Access token expired. Obtained new token")
-                with open(log_file, 'a') as log:
-                    log.write("Access token expired. Obtained new token.\n")
-            else:
-                return response
-        raise Exception("Max retries exceeded")
-
-    # Initial request to check if pagination is needed
-    response = make_request(cost_management_url, body)
-    if response.status_code == 200:
-        data = response.json()
-        cost_data.extend(data['properties']['rows'])
-        next_link = data.get('properties', {}).get('nextLink')
-
-        # Write the data to JSON file incrementally
-        with open(json_file, 'w') as f:
-            json.dump(cost_data, f, indent=4)
+    if dimension == 'UsageDate':
+        # Consecutive date ranges with the same number of days
+        first_day = date.fromisoformat(start_date)
+        days = (date.fromisoformat(end_date) - first_day).days + 1
+        count = min(count, days)
+        partitions = [{
+            'from': (first_day + timedelta(days=days * index // count)).isoformat(),
+            'to': (first_day + timedelta(days=days * (index + 1) // count - 1)).isoformat()
+        } for index in range(count)]
+    else:
+        groups = [[0.0, []] for _ in range(max(1, min(count, len(costs))))]
+        for value, cost in sorted(costs.items(), key=lambda item: abs(item[1]), reverse=True):
+            group = min(groups, key=lambda g: g[0])
+            group[0] += abs(cost)
+            group[1].append(value)
+        partitions = [{'from': start_date, 'to': end_date, 'values': values} for _, values in groups]
 
-        # If there's a next link, continue with pagination
-        while next_link:
-            response = make_request(next_link, body)
-            if response.status_code == 200:
-                data = response.json()
-                cost_data.extend(data['properties']['rows'])
-                print(f"Processed {len(cost_data)} resources so far...")
-                with open(log_file, 'a') as log:
-                    log.write(f"Processed {len(cost_data)} resources so far...\n")
-
-                # Write the data to JSON file incrementally
-                with open(json_file, 'w') as f:
-                    json.dump(cost_data, f, indent=4)
-
-                next_link = data.get('properties', {}).get('nextLink')
-
-                # Save the nextLink to a file
-                with open(next_link_file, 'w') as file:
-                    if next_link:
-                        file.write(next_link)
-                    else:
-                        file.write('')
-            else:
-                print(f"Failed to retrieve cost data. Status Code: {response.status_code}")
-                logger.log_note(f"Failed to retrieve cost data. Status Code: {response.status_code}")
-                with open(log_file, 'a') as log:
-                    log.write(f"Failed to retrieve cost data. Status Code: {response.status_code}\n")
-                    log.write(response.text + "\n")
+    return {'dimension': dimension, 'partitions': partitions, 'expected_total': expected_total}
+
+# Function to retrieve a large subscription month as concurrent partitions combined into json_file.
+# Each partition is paginated with its own nextLink checkpoint, so it can be resumed on its own. The combined total is
+# checked against the probe total of the plan (falling back to the single query if rows are missing, e.g. resources with
+# an empty dimension value) and against the billing account total. Returns the number of rows and their total cost
+def get_partitioned_cost_data(year, month, subscription_id, subscription_name, subscription_cost, client, log_file, json_file, next_link_file, count, output_format=cost_output.OUTPUT_FORMAT_JSON, resume=False, dimension=split_dimension, workers=split_workers):
+    month_name = datetime(year, month, 1).strftime('%b')
+    start_date = datetime(year, month, 1).strftime('%Y-%m-%d')
+    end_date = datetime(year, month, calendar.monthrange(year, month)[1]).strftime('%Y-%m-%d')
+
+    query_log = cost_logging.bind(log, subscription=subscription_id, month=f'{year}-{month:02d}', file=json_file, log_file=log_file)
+
+    # The checkpoint of the subscription is only complete once the partitions have been combined
+    checkpoint = read_next_link_checkpoint(next_link_file) if resume else None
+    if checkpoint and checkpoint['complete'] and os.path.exists(json_file):
+        query_log.info(f"Cost data already retrieved to {json_file}, skipping the subscription.", extra={'rows': checkpoint['row_count']})
+        return checkpoint['row_count'], checkpoint['total_cost']
+
+    prefix = os.path.join(os.path.dirname(json_file), f'partition_{subscription_name}_{month_name}{year}')
+    plan_file = prefix + '.plan.json'
+
+    # An incomplete checkpoint without a plan was left by the single query of a run whose partitions didn't add up
+    if checkpoint and not checkpoint['complete'] and os.path.exists(json_file) and not os.path.exists(plan_file):
+        query_log.info(f"Resuming the single query of subscription {subscription_name} from its checkpoint")
+        return get_cost_data_with_pagination_retries(year, month, subscription_id, client, log_file, json_file, next_link_file, output_format=output_format, resume=resume)
+
+    # Reuse the plan of the interrupted run so that the partition checkpoints still match their queries
+    plan = None
+    if resume and os.path.exists(plan_file):
+        with open(plan_file, 'r') as file:
+            plan = json.load(file)
+    if plan is None:
+        plan = plan_partitions(client, subscription_id, start_date, end_date, count, log_file, dimension)
+        with open(plan_file, 'w') as file:
+            json.dump(plan, file)
+    partitions = plan['partitions']
+    part_files = [(f'{prefix}_{index}.ndjson', f'{prefix}_{index}.next_link.txt') for index in range(len(partitions))]
+
+    query_log.info(f"Retrieving subscription {subscription_name} as {len(partitions)} partitions by {plan['dimension']}")
+
+    # Function to retrieve one partition to its own ndjson file
+    def retrieve_partition(index):
+        partition = partitions[index]
+        body = build_cost_data_query_body(partition['from'], partition['to'])
+        if 'values' in partition:
+            body['dataset']['filter'] = {"dimensions": {"name": plan['dimension'], "operator": "In", "values": partition['values']}}
+        part_file, part_next_link_file = part_files[index]
+        return get_cost_data_with_pagination_retries(year, month, subscription_id, client, log_file, part_file, part_next_link_file, output_format=cost_output.OUTPUT_FORMAT_NDJSON, resume=resume, body=body)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        partition_totals = list(executor.map(retrieve_partition, range(len(partitions))))
+    partitions_cost = sum(total_cost for _, total_cost in partition_totals)
+
+    # Function to remove the partition files once they are combined (or discarded)
+    def remove_partition_files():
+        for part_file, part_next_link_file in part_files:
+            for file in (part_file, part_next_link_file, cost_output.cost_data_index_file_name(part_file)):
+                if os.path.exists(file):
+                    os.remove(file)
+        os.remove(plan_file)
+
+    # The partitions must add up to the probe total, otherwise some rows matched none of the partition filters
+    if abs(partitions_cost - plan['expected_total']) > max(0.01, reconcile_tolerance * abs(plan['expected_total'])):
+        message = f"Partitions of subscription {subscription_name} add up to {partitions_cost:.2f} instead of {plan['expected_total']:.2f}, retrieving it with a single query"
+        query_log.warning(message, extra={'total_cost': partitions_cost})
+        remove_partition_files()
+        return get_cost_data_with_pagination_retries(year, month, subscription_id, client, log_file, json_file, next_link_file, output_format=output_format, resume=resume)
+
+    # Combine the partitions. Date ranges return the same resource in several partitions, so their rows are summed
+    def partition_rows():
+        for part_file, _ in part_files:
+            if os.path.exists(part_file):
+                yield from cost_output.iter_cost_records(part_file)
+
+    if plan['dimension'] == 'UsageDate':
+        resource_costs = {}
+        for row in partition_rows():
+            key = tuple(row[1:])
+            resource_costs[key] = resource_costs.get(key, 0.0) + float(row[0])
+        rows = ([cost] + list(key) for key, cost in resource_costs.items())
     else:
-        print(f"Failed to retrieve cost data. Status Code: {response.status_code}")
-        logger.log_note(f"Failed to retrieve cost data. Status Code: {response.status_code}")
-        with open(log_file, 'a') as log:
-            log.write(f"Failed to retrieve cost data. Status Code: {response.status_code}\n")
-            log.write(response.text + "\n")
+        rows = partition_rows()
+    row_count, total_cost = write_cost_data_file(json_file, rows, output_format=output_format)
+    save_next_link_checkpoint(next_link_file, None, row_count, total_cost)
+    remove_partition_files()
 
-    # Clean up the nextLink file after successful completion
-    if os.path.exists(next_link_file):
-        os.remove(next_link_file)
+    # Reconcile with the billing account total, which also includes the marketplace and reservation charges
+    if abs(total_cost - subscription_cost) > reconcile_tolerance * abs(subscription_cost):
+        query_log.warning(f"Total cost of subscription {subscription_name} ({total_cost:.2f}) differs from its billing account total ({subscription_cost:.2f}) by {total_cost - subscription_cost:.2f}", extra={'total_cost': total_cost})
+    else:
+        query_log.info(f"Total cost of subscription {subscription_name} ({total_cost:.2f}) matches its billing account total ({subscription_cost:.2f})", extra={'total_cost': total_cost})
 
-    return cost_data
+    return row_count, total_cost
 
 # # Function to write cost data to CSV
 # def write_cost_data_to_csv(json_file, csv_file):
@@ -283,140 +826,551 @@ def write_monthly_summary_billing_account_to_csv(data, csv_file):
             writer.writerow([subscription_name, subscription_id, total_cost, currency])             
 
 
-def process_monthly_costs(year, month): 
+# Function to retrieve the cost data of a single subscription and return its row for the subscription_cost_summary CSV file
+# It is run concurrently by process_monthly_costs, so it only writes to the files of its own subscription
+def process_subscription_costs(year, month, output_dir, client, subscription_id, subscription_name, subscription_cost, resume=False, incremental=False, sql_pool=None):
+    month_name = datetime(year, month, 1).strftime('%b')
+
+    # Check if the SubscriptionId is empty or null
+    if not subscription_id or subscription_cost <= 1:
+        # Don't process subscription which has cost less than 1$ but write them in the subscrption_cost_summary_ file
+        # Write the empty SubscriptionId data to CSV as it contains some negative charges as shown in the Azure portal
+        return [subscription_id, subscription_name, f"{subscription_cost:.2f}", 0]
+
+    # Sanitize the subscription name for file names
+    subscription_name = sanitize_filename(subscription_name)
+
+    # Prepare file names with month, year, and subscription name
+    json_file, log_file, next_link_file = subscription_files(output_dir, subscription_name, month_name, year)
+
+    subscription_log = cost_logging.bind(log, subscription=subscription_id, month=f'{year}-{month:02d}', file=json_file, log_file=log_file)
+    subscription_start = time.perf_counter()
+    subscription_log.info(f"Retrieving all cost data of the month {month_name}, {year} for subscription {subscription_name} to json file {json_file}.")
+    # Split the subscription if its last extraction (or the probe query of its first one) returned too many rows for a
+    # single sequential pagination
+    partitions = partition_count(expected_row_count(client, year, month, subscription_id, log_file)) if not incremental and sql_pool is None else 1
+    if incremental:
+        # Retrieve the days since the last run and merge them into the month
+        daily_file = os.path.join(output_dir, f'daily_cost_data_{subscription_name}_{month_name}{year}.ndjson')
+        record_count, total_cost = get_incremental_cost_data(year, month, subscription_id, client, log_file, json_file, daily_file, output_format=output_format, lookback_days=incremental_lookback_days)
+    elif sql_pool is not None:
+        # Load the pages into Azure SQL as they arrive, over a connection of the pool
+        check_pipeline_resume(True, resume)
+        record_count, total_cost = load_subscription_costs_to_sql(year, month, subscription_id, subscription_name, client, log_file, json_file, sql_pool)
+    elif partitions > 1:
+        # Retrieve the partitions concurrently and combine them
+        record_count, total_cost = get_partitioned_cost_data(year, month, subscription_id, subscription_name, subscription_cost, client, log_file, json_file, next_link_file, partitions, output_format=output_format, resume=resume)
+    else:
+        # Retrieve all cost data with retries
+        record_count, total_cost = get_cost_data_with_pagination_retries(year, month, subscription_id, client, log_file, json_file, next_link_file, output_format=output_format, resume=resume)
+    if not incremental and sql_pool is None:
+        save_row_count(subscription_id, record_count)
+    return complete_subscription_costs(subscription_log, subscription_id, subscription_name, json_file, record_count, total_cost, subscription_start)
+
+# Function to build the names of the cost data file, the log file and the nextLink checkpoint of a subscription month
+def subscription_files(output_dir, subscription_name, month_name, year):
+    json_file = cost_output.cost_data_file_name(output_dir, subscription_name, month_name, year, output_format)
+    # csv_file = os.path.join(output_dir, f'azure_cost_data_{subscription_name}_{month_name}{year}.csv')
+    log_file = os.path.join(output_dir, f'process_log_{subscription_name}.txt')
+    next_link_file = os.path.join(output_dir, f'next_link_{subscription_name}.txt')
+    return json_file, log_file, next_link_file
+
+# Function to log the completion of a subscription month and return its row for the subscription_cost_summary CSV file
+def complete_subscription_costs(subscription_log, subscription_id, subscription_name, json_file, record_count, total_cost, subscription_start):
+    # Output the total number of records & total cost for the subscription
+    subscription_log.info(f"Total number of cost records in subscription {subscription_name}: {record_count}", extra={'rows': record_count})
+    subscription_log.info(f"Total cost of subscription {subscription_name}: {total_cost:.2f}", extra={'total_cost': round(total_cost, 2)})
+    # Output the completion of cost data into json file
+    subscription_log.info(f"Cost data for subscription {subscription_name} has been written to {json_file}")
+    # Output the completion of the cost data for the subscription
+    subscription_log.info(f"Cost data retrieval completed successfully for subscription {subscription_name}", extra={'rows': record_count, 'total_cost': round(total_cost, 2), 'elapsed': round(time.perf_counter() - subscription_start, 3)})
+
+    return [subscription_id, subscription_name, f"{total_cost:.2f}", record_count]
+
+# asyncio version of process_subscription_costs (asyncio backend), retrieving the whole month with one paginated query.
+# The subscriptions which are skipped or split into partitions go through process_subscription_costs with the threaded
+# `sync_client`, in a worker thread
+async def process_subscription_costs_async(year, month, output_dir, client, sync_client, subscription_id, subscription_name, subscription_cost, resume=False):
+    if not subscription_id or subscription_cost <= 1:
+        return await asyncio.to_thread(process_subscription_costs, year, month, output_dir, sync_client, subscription_id, subscription_name, subscription_cost, resume=resume)
+
+    month_name = datetime(year, month, 1).strftime('%b')
+    subscription_name = sanitize_filename(subscription_name)
+    json_file, log_file, next_link_file = subscription_files(output_dir, subscription_name, month_name, year)
+    if partition_count(await asyncio.to_thread(expected_row_count, sync_client, year, month, subscription_id, log_file)) > 1:
+        return await asyncio.to_thread(process_subscription_costs, year, month, output_dir, sync_client, subscription_id, subscription_name, subscription_cost, resume=resume)
+
+    subscription_log = cost_logging.bind(log, subscription=subscription_id, month=f'{year}-{month:02d}', file=json_file, log_file=log_file)
+    subscription_start = time.perf_counter()
+    subscription_log.info(f"Retrieving all cost data of the month {month_name}, {year} for subscription {subscription_name} to json file {json_file}.")
+    record_count, total_cost = await get_cost_data_with_pagination_retries_async(year, month, subscription_id, client, log_file, json_file, next_link_file, output_format=output_format, resume=resume)
+    save_row_count(subscription_id, record_count)
+    return complete_subscription_costs(subscription_log, subscription_id, subscription_name, json_file, record_count, total_cost, subscription_start)
+
+# Function to retrieve the cost data of a subscription straight into AzureResourceCost (pipeline mode).
+# The pages are transformed and inserted by a background thread while the next pages are fetched. The rows are only
+# visible once the whole query is retrieved, replacing the ones of a previous load of the subscription month, so a failed
+# query can be run again. Pipelined queries aren't resumed, so no nextLink checkpoint is written
+def load_subscription_costs_to_sql(year, month, subscription_id, subscription_name, client, log_file, json_file, sql_pool):
+    month_name = datetime(year, month, 1).strftime('%b')
+    conn = sql_pool.get()
     try:
-        # Log the start of the process    
-        logger.log_note('*** Job initiated at ' + str(datetime.today()) + ' ***')        
-        # Check if the client secret is available
-        if client_secret is None:
-            raise ValueError("The environment variable 'AZURE_CLIENT_SECRET' is not set.")
-        
-        print("Process initiated..")
-        logger.log_note("Process initiated..")
-        access_token = get_access_token(tenant_id, client_id, client_secret)
-        print("Access token retrieved.")
-        logger.log_note("Access token retrieved.")
+        writer = cost_sql.SqlCostDataWriter(conn, f'pipeline/{year}/{month_name}/{subscription_name}', load_mode=pipeline_load_mode, batch_size=pipeline_batch_size, bulk_insert=pipeline_bulk_insert, queue_size=pipeline_queue_pages, labels={'subscription': subscription_id, 'month': f'{year}-{month:02d}'})
+        try:
+            result = get_cost_data_with_pagination_retries(year, month, subscription_id, client, log_file, json_file, None, writer=writer)
+            writer.commit()
+        except Exception:
+            writer.abort()
+            raise
+        cost_logging.bind(log, subscription=subscription_id, month=f'{year}-{month:02d}', log_file=log_file).info(
+            f"Loaded {writer.loaded_rows} cost records of subscription {subscription_name} into AzureResourceCost", extra={'rows': writer.loaded_rows})
+        return result
+    finally:
+        sql_pool.put(conn)
 
-        # Calculate the start and end dates for the specified month
-        start_date = datetime(year, month, 1).strftime('%Y-%m-%d')
-        end_date = datetime(year, month, calendar.monthrange(year, month)[1]).strftime('%Y-%m-%d')
-        month_name = datetime(year, month, 1).strftime('%b')
+# Function to return the folder of the files of a month: output/<year>/<month>, or its <profile> subfolder for the
+# extraction profiles other than 'resource' (the billing account summary stays in the month folder)
+def month_output_dir(year, month):
+    month_dir = os.path.join('output', str(year), datetime(year, month, 1).strftime('%b'))
+    if extraction_profile_name == cost_profiles.DEFAULT_PROFILE:
+        return month_dir
+    return os.path.join(month_dir, extraction_profile_name)
+
+# Function to return the billing account summary CSV of a month and whether it can be read instead of querying the
+# billing account again: with `reuse_closed`, the summary already written for a closed month is reused
+def billing_account_summary_file(year, month, reuse_closed=False):
+    month_name = datetime(year, month, 1).strftime('%b')
+    billing_account_summary_csv = os.path.join('output', str(year), month_name, f'{billing_account_cost_summary_csv_file}_{month_name}_{year}.csv')
+    month_closed = cost_cache.period_closed(date(year, month, calendar.monthrange(year, month)[1]), settle_days)
+    return billing_account_summary_csv, reuse_closed and month_closed and os.path.isfile(billing_account_summary_csv)
+
+# Function to get the billing account summary of a month and list its subscriptions.
+# Returns the output folder of the month, the path of its subscription cost summary CSV and the
+# (SubscriptionId, SubscriptionName, TotalCost) of each subscription. With `reuse_closed`, the billing account summary
+# already written for a closed month is read instead of querying the billing account again. `billing_account_summary`
+# is the response of the billing account query when it was already made (asyncio backend)
+def prepare_month(year, month, client, reuse_closed=False, billing_account_summary=None):
+    # Calculate the start and end dates for the specified month
+    start_date = datetime(year, month, 1).strftime('%Y-%m-%d')
+    end_date = datetime(year, month, calendar.monthrange(year, month)[1]).strftime('%Y-%m-%d')
+    month_name = datetime(year, month, 1).strftime('%b')
 
-        # Ensure the output directory exists  
-        output_dir = os.path.join('output', str(year), month_name)      
-        os.makedirs(output_dir, exist_ok=True)    
+    # Ensure the output directory exists  
+    output_dir = month_output_dir(year, month)
+    os.makedirs(output_dir, exist_ok=True)    
 
+    # Prepare a billing_account_summary_csv file with month & year containing the Subscription cost for the enrollement account
+    billing_account_summary_csv, reusable = billing_account_summary_file(year, month, reuse_closed)
+    os.makedirs(os.path.dirname(billing_account_summary_csv), exist_ok=True)
+    if reusable and billing_account_summary is None:
+        log.info(f"Reusing the summary of the cost for the billing account of the closed month {month_name}, {year}: {billing_account_summary_csv}")
+    else:
         # Get the summary of the cost for the billing account at the subscription level
         # This will have the cost including "Other Azure Resources" 
-        print(f"Getting the total cost of each subscription for the year: {year} month: {month_name}")
-        logger.log_note(f"Getting the total cost of each subscription for the year: {year} month: {month_name}")
-        monthly_summary_billing_account = query_cost_by_subscription_in_billing_account(billing_account, access_token, start_date, end_date)
+        if billing_account_summary is None:
+            log.info(f"Getting the total cost of each subscription for the year: {year} month: {month_name}")
+            billing_account_summary = query_cost_by_subscription_in_billing_account(billing_account, client, start_date, end_date)
 
         # Write the json data to CSV file
         monthly_summary_billing_account_data = []
-        monthly_summary_billing_account_data.extend(monthly_summary_billing_account['properties']['rows'])
+        monthly_summary_billing_account_data.extend(billing_account_summary['properties']['rows'])
 
-        # Prepare a billing_account_summary_csv file with month & year containing the Subscription cost for the enrollement account
-        billing_account_summary_csv = os.path.join(output_dir, f'{billing_account_cost_summary_csv_file}_{month_name}_{year}.csv')
-        file_exists = os.path.isfile(billing_account_summary_csv)        
         # Write the summary of the cost for the billing account at the subscription level to CSV
-        print(f"Writing the summary of the cost for the billing account at the subscription level to CSV: {billing_account_summary_csv}")
-        logger.log_note(f"Writing the summary of the cost for the billing account at the subscription level to CSV: {billing_account_summary_csv}")        
+        log.info(f"Writing the summary of the cost for the billing account at the subscription level to CSV: {billing_account_summary_csv}")
         write_monthly_summary_billing_account_to_csv(monthly_summary_billing_account_data, billing_account_summary_csv)        
-          
-        # Prepare subscription cost summary file name with month, year. This cost summary contains the subscription cost only of Azure services & excludes the "Other Azure Services" like Marketplace, Reservations, etc
-        subscription_cost_summary_csv = os.path.join(output_dir,f'{subscription_cost_summary_csv_file}_{month_name}_{year}.csv')
+
+    # Prepare subscription cost summary file name with month, year. This cost summary contains the subscription cost only of Azure services & excludes the "Other Azure Services" like Marketplace, Reservations, etc
+    subscription_cost_summary_csv = os.path.join(output_dir,f'{subscription_cost_summary_csv_file}_{month_name}_{year}.csv')
+
+    # Read the subscription list from billing_account_summary_csv CSV file
+    log.info(f"Looping through each of the subscriptions in {billing_account_summary_csv}")
+    with open(billing_account_summary_csv, 'r') as csvfile:
+        reader = csv.DictReader(csvfile)
+        subscriptions = [(row['SubscriptionId'], row['SubscriptionName'], float(row["TotalCost (Including Other Azure Resources)"])) for row in reader]
+
+    return output_dir, subscription_cost_summary_csv, subscriptions
+
+def process_monthly_costs(year, month, max_workers=max_workers, client=None, resume=resume_extraction, incremental=incremental_extraction, pipeline=pipeline_mode): 
+    check_pipeline_profile(pipeline)
+    check_pipeline_resume(pipeline, resume)
+    sql_pool = None
+    try:
+        # Log the start of the process    
+        log.info('*** Job initiated at ' + str(datetime.today()) + ' ***')
+        # Check if the client secret is available
+        if client_secret is None:
+            raise ValueError("The environment variable 'AZURE_CLIENT_SECRET' is not set.")
+        
+        log.info("Process initiated..")
+        # One pooled client (and token) is shared by the billing account query and all the subscription workers
+        if client is None:
+            client = create_cost_management_client(max_workers)
+        client.token_manager.get_token()
+        log.info("Access token retrieved.")
+
+        month_name = datetime(year, month, 1).strftime('%b')
+        # Query the billing account and list the subscriptions of the month
+        output_dir, subscription_cost_summary_csv, subscriptions = prepare_month(year, month, client)
         file_exists = os.path.isfile(subscription_cost_summary_csv)
         
-        # Loop through each of the subscriptions in billing_account_summary_csv
-        print(f"Looping through each of the subscriptions in {billing_account_summary_csv}")
-        logger.log_note(f"Looping through each of the subscriptions in {billing_account_summary_csv}")
         # Prepare a summary CSV file containing the Subscription cost for Azure services (without including the "Other Azure Services" like Marketplace, Reservations, etc)
-        print(f"Writing the summary CSV file containing the Subscription cost for Azure services (without including the 'Other Azure Services' like Marketplace, Reservations, etc) to CSV: {subscription_cost_summary_csv_file}_{month_name}_{year}.csv")
-        logger.log_note(f"Writing the summary CSV file containing the Subscription cost for Azure services (without including the 'Other Azure Services' like Marketplace, Reservations, etc) to CSV: {subscription_cost_summary_csv_file}_{month_name}_{year}.csv")            
-        with open(subscription_cost_summary_csv, 'a', newline='') as summary_file:
+        log.info(f"Writing the summary CSV file containing the Subscription cost for Azure services (without including the 'Other Azure Services' like Marketplace, Reservations, etc) to CSV: {subscription_cost_summary_csv_file}_{month_name}_{year}.csv")
+        # When resuming, every subscription gets its row again (from its checkpoint if already complete), so the file is rewritten.
+        # The same applies to incremental runs, which recompute the totals of every subscription
+        if resume or incremental:
+            file_exists = False
+        with open(subscription_cost_summary_csv, 'a' if file_exists else 'w', newline='') as summary_file:
             summary_writer = csv.writer(summary_file)
             # Write header only if the file doesn't exist
             if not file_exists:
                 summary_writer.writerow(['SubscriptionId', 'SubscriptionName', 'TotalCost', 'ResourceCount'])   
 
-            # Read the subscription list from billing_account_summary_csv CSV file
-            with open(billing_account_summary_csv, 'r') as csvfile:
-                reader = csv.DictReader(csvfile)      
-                for row in reader:
-                    subscription_name = row['SubscriptionName']
-                    subscription_id = row['SubscriptionId']
-                    subscription_cost = float(row["TotalCost (Including Other Azure Resources)"])
-
-                    # Check if the SubscriptionId is empty or null
-                    if subscription_id and subscription_cost > 1:
-                        # Sanitize the subscription name for file names
-                        subscription_name = sanitize_filename(subscription_name)
-
-                        # Prepare file names with month, year, and subscription name
-                        json_file = os.path.join(output_dir, f'azure_cost_data_{subscription_name}_{month_name}{year}.json')
-                        # csv_file = os.path.join(output_dir, f'azure_cost_data_{subscription_name}_{month_name}{year}.csv')
-                        log_file = os.path.join(output_dir, f'process_log_{subscription_name}.txt')
-                        next_link_file = os.path.join(output_dir, f'next_link_{subscription_name}.txt')
-
-                        print(f"Retrieving all cost data of the month {month_name}, {year} for subscription {subscription_name} to json file {json_file}.")
-                        logger.log_note(f"Retrieving all cost data of the month {month_name}, {year} for subscription {subscription_name} to json file {json_file}.")
-                        # Retrieve all cost data with retries
-                        all_cost_data = get_cost_data_with_pagination_retries(year, month, subscription_id, access_token, log_file, json_file, next_link_file)
-
-                        # Output the total number of records & total cost for the subscription
-                        print(f"Total number of cost records in subscription {subscription_name}: {len(all_cost_data)}") 
-                        logger.log_note(f"Total number of cost records in subscription {subscription_name}: {len(all_cost_data)}") 
-                        # Calculate total cost
-                        total_cost = sum(float(entry[0]) for entry in all_cost_data)  
-                        print(f"Total cost of subscription {subscription_name}: {total_cost:.2f}") 
-                        logger.log_note(f"Total cost of subscription {subscription_name}: {total_cost:.2f}") 
-                        # Output the completion of cost data into json file
-                        print(f"Cost data for subscription {subscription_name} has been written to {json_file}")
-                        logger.log_note(f"Cost data for subscription {subscription_name} has been written to {json_file}")
-                        # Output the completion of the cost data for the subscription
-                        print(f"Cost data retrieval completed successfully for subscription {subscription_name}")
-                        logger.log_note(f"Cost data retrieval completed successfully for subscription {subscription_name}")
-                        # Log the details into subscription log file
-                        with open(log_file, 'a') as log:
-                            log.write(f"Total number of cost records in subscription {subscription_name}: {len(all_cost_data)}\n")
-                            log.write(f"Total cost of subscription {subscription_name}: {total_cost:.2f}\n")                                          
-                            log.write(f"Cost data has been written to {json_file}\n")                              
-                            log.write(f"Cost data retrieval completed successfully for subscription {subscription_name}.\n")
-
-                        # Write summary data to CSV
-                        summary_writer.writerow([subscription_id, subscription_name, f"{total_cost:.2f}", len(all_cost_data)]) 
-                        # # Write the JSON data to CSV
-                        # print(f"Write cost data to csv file {csv_file}..")
-                        # write_cost_data_to_csv(json_file, csv_file)
-                        # # Log CSV completion
-                        # print(f"Cost data has been written to {csv_file}")
-                        # with open(log_file, 'a') as log:
-                        #     log.write(f"Cost data has been written to {csv_file}\n")                           
-
-                    else:
-                        # Don't process subscription which has cost less than 1$ but write them in the subscrption_cost_summary_ file
-                        # Write the empty SubscriptionId data to CSV as it contains some negative charges as shown in the Azure portal
-                        summary_writer.writerow([subscription_id, subscription_name, f"{total_cost:.2f}", len(all_cost_data)])                          
-
-                # Output the summary of processing of cost data for all subscriptions  
-                print(f"The summary of cost data for all subscriptions is for {month_name}, {year} is available at: {subscription_cost_summary_csv}")     
+            # Retrieve the subscriptions in parallel. executor.map returns the results in the order of the billing account
+            # summary, so the subscription_cost_summary rows are written in the same order regardless of the number of workers
+            log.info(f"Retrieving the cost data of {len(subscriptions)} subscriptions with {max_workers} worker(s)")
+            # In pipeline mode each worker loads its subscription over its own connection
+            if pipeline:
+                sql_pool = cost_sql.create_connection_pool(max_workers, pipeline_load_mode)
+            summary_rows = []
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for summary_row in executor.map(lambda subscription: process_subscription_costs(year, month, output_dir, client, *subscription, resume=resume, incremental=incremental, sql_pool=sql_pool), subscriptions):
+                    # Write summary data to CSV
+                    summary_writer.writerow(summary_row)
+                    summary_rows.append(summary_row)
+
+        # Reconcile the subscriptions with the billing account and extract the ones which don't match again.
+        # The summary file is rewritten with the rows of this run when some subscriptions were extracted again
+        reconciled_rows = reconcile_month(year, month, output_dir, client, subscriptions, summary_rows, incremental=incremental, sql_pool=sql_pool, max_workers=max_workers)
+        if reconciled_rows != summary_rows:
+            write_subscription_cost_summary(subscription_cost_summary_csv, reconciled_rows)
+
+        # Output the summary of processing of cost data for all subscriptions  
+        log.info(f"The summary of cost data for all subscriptions is for {month_name}, {year} is available at: {subscription_cost_summary_csv}")     
+
+        # Output the rate limit counters of the run for tuning FINOPS_REQUESTS_PER_SECOND / FINOPS_REQUEST_BURST
+        log.info(f"Request scheduler statistics: {request_scheduler.stats()}")
+        if response_cache:
+            log.info(f"Response cache statistics: {response_cache.stats()}")
 
     except requests.exceptions.HTTPError as http_err:
-        print(f"HTTP error occurred: {http_err}")
-        logger.log_note(f"HTTP error occurred: {http_err}")
+        log.error(f"HTTP error occurred: {http_err}")
         raise  # Re-raise the exception to stop processing
     except Exception as err:
-        print(f"An error occurred: {err}")
-        logger.log_note(f"An error occurred: {err}")
+        log.error(f"An error occurred: {err}")
         raise  # Re-raise the exception to stop processing
+    finally:
+        if sql_pool is not None:
+            cost_sql.close_connection_pool(sql_pool)
+
+# Function to discard what a previous extraction of a subscription month left to resume or reuse: its nextLink checkpoint,
+# its incremental state (so that the whole month is queried again) and the cached responses of all its queries of the
+# month (full month, daily, probe, partition plan and partitions)
+def reset_subscription_extraction(year, month, output_dir, subscription_id, subscription_name):
+    subscription_name = sanitize_filename(subscription_name)
+    month_name = datetime(year, month, 1).strftime('%b')
+    daily_file = os.path.join(output_dir, f'daily_cost_data_{subscription_name}_{month_name}{year}.ndjson')
+    for file in (os.path.join(output_dir, f'next_link_{subscription_name}.txt'), daily_file + '.state'):
+        if os.path.exists(file):
+            os.remove(file)
+    if response_cache:
+        month_end = date(year, month, calendar.monthrange(year, month)[1])
+        response_cache.invalidate_period(subscription_query_url(subscription_id), date(year, month, 1).isoformat(), month_end.isoformat())
+
+# Function to reconcile the subscription totals of a month (its subscription cost summary rows) with their billing account
+# totals, and extract again the subscriptions whose delta is above the threshold, e.g. after a truncated pagination,
+# instead of running the whole month again. A subscription is extracted again at most `retries` times; one returning the
+# same total is reported as stable. Writes reconciliation_<month>_<year>.csv and returns the updated summary rows
+def reconcile_month(year, month, output_dir, client, subscriptions, summary_rows, incremental=False, sql_pool=None, retries=reconcile_retries, max_workers=max_workers):
+    month_name = datetime(year, month, 1).strftime('%b')
+    month_label = f'{year}-{month:02d}'
+    summary_rows = list(summary_rows)
+    report_csv = os.path.join(output_dir, f'reconciliation_{month_name}_{year}.csv')
+    # Subscriptions found stable by a previous run aren't extracted again as long as their total doesn't change
+    report = cost_reconcile.read_reconciliation_report(report_csv)
+    if report is not None:
+        report = report[report['Status'] == cost_reconcile.STATUS_STABLE]
+    for attempt in range(retries + 1):
+        report = cost_reconcile.reconcile_costs(subscriptions, summary_rows, reconcile_tolerance, reconcile_min_delta, report)
+        flagged = set(report.loc[report['Status'].isin(cost_reconcile.STATUS_REEXTRACT), 'SubscriptionId'])
+        if not flagged or attempt == retries:
+            break
+        log.warning(f"{len(flagged)} subscriptions of {month_label} don't reconcile with the billing account, extracting them again", extra={'month': month_label})
+        cost_metrics.metrics.increment('reconcile_reextracted_total', len(flagged), month=month_label)
+
+        # Function to extract a flagged subscription again from its first page
+        def extract_again(subscription):
+            reset_subscription_extraction(year, month, output_dir, subscription[0], subscription[1])
+            return process_subscription_costs(year, month, output_dir, client, *subscription, resume=False, incremental=incremental, sql_pool=sql_pool)
+
+        positions = {row[0]: index for index, row in enumerate(summary_rows)}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(extract_again, subscription): subscription for subscription in subscriptions if subscription[0] in flagged}
+            for future in as_completed(futures):
+                subscription = futures[future]
+                try:
+                    summary_row = future.result()
+                except Exception as err:
+                    log.error(f"Failed to extract subscription {subscription[1]} again for {month_label}: {err}", extra={'subscription': subscription[0], 'month': month_label})
+                    continue
+                if subscription[0] in positions:
+                    summary_rows[positions[subscription[0]]] = summary_row
+                else:
+                    summary_rows.append(summary_row)
+
+    cost_reconcile.write_reconciliation_report(report, report_csv)
+    status_counts = report['Status'].value_counts().to_dict()
+    for status, count in status_counts.items():
+        cost_metrics.metrics.increment('reconcile_subscriptions_total', count, month=month_label, status=status)
+    unreconciled = report[report['Status'].isin(cost_reconcile.STATUS_REEXTRACT)]
+    for row in unreconciled.itertuples(index=False):
+        log.warning(f"Subscription {row.SubscriptionName} of {month_label} doesn't reconcile: extracted {row.ExtractedCost:.2f}, billing account {row.BillingAccountCost:.2f}", extra={'subscription': row.SubscriptionId, 'month': month_label, 'total_cost': row.ExtractedCost})
+    log.info(f"Reconciliation of {month_label} with the billing account: {status_counts}, report written to {report_csv}", extra={'month': month_label})
+    return summary_rows
+
+# Function to list the (year, month) of a period given as 'YYYY-MM' strings, both months included
+def month_range(start, end):
+    start_date = datetime.strptime(start, '%Y-%m')
+    end_date = datetime.strptime(end, '%Y-%m')
+    year, month = start_date.year, start_date.month
+    while (year, month) <= (end_date.year, end_date.month):
+        yield year, month
+        year, month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+# Function to check whether the cost data of a subscription month is already complete on disk
+def is_subscription_month_complete(year, month, output_dir, subscription_name):
+    subscription_name = sanitize_filename(subscription_name)
+    month_name = datetime(year, month, 1).strftime('%b')
+    json_file = cost_output.cost_data_file_name(output_dir, subscription_name, month_name, year, output_format)
+    checkpoint = read_next_link_checkpoint(os.path.join(output_dir, f'next_link_{subscription_name}.txt'))
+    return bool(checkpoint and checkpoint['complete'] and os.path.exists(json_file))
+
+# Function to write the subscription cost summary CSV of a month, in the order of the billing account summary
+def write_subscription_cost_summary(subscription_cost_summary_csv, summary_rows):
+    with open(subscription_cost_summary_csv, 'w', newline='') as summary_file:
+        summary_writer = csv.writer(summary_file)
+        summary_writer.writerow(['SubscriptionId', 'SubscriptionName', 'TotalCost', 'ResourceCount'])
+        summary_writer.writerows(summary_rows)
+
+# Function to backfill the cost data of a period (months given as 'YYYY-MM').
+# The billing account is queried once per month to build a (month x subscription) plan, and all the units of the plan run on
+# a single pool of max_workers workers sharing one client (token and connections) and the request scheduler, so the API quota is
+# used across months instead of waiting for the slowest subscription of each month. Units already complete on disk are skipped
+# from their checkpoints (pipelined units are loaded again from their first page). A failed unit doesn't stop the others; the summary of its month is not written and the backfill
+# raises at the end, so it can be run again to retry the failed units only
+def backfill_costs(start, end, max_workers=max_workers, client=None, incremental=incremental_extraction, pipeline=pipeline_mode):
+    check_pipeline_profile(pipeline)
+    log.info('*** Backfill initiated at ' + str(datetime.today()) + ' ***')
+    if client_secret is None:
+        raise ValueError("The environment variable 'AZURE_CLIENT_SECRET' is not set.")
+    if client is None:
+        client = create_cost_management_client(max_workers)
+    client.token_manager.get_token()
+
+    # Build the plan: one unit per month and subscription
+    months = {}
+    units = []
+    for year, month in month_range(start, end):
+        output_dir, subscription_cost_summary_csv, subscriptions = prepare_month(year, month, client, reuse_closed=True)
+        months[(year, month)] = {'summary_csv': subscription_cost_summary_csv, 'output_dir': output_dir, 'subscriptions': subscriptions, 'rows': [None] * len(subscriptions), 'pending': len(subscriptions), 'failed': False}
+        for index, subscription in enumerate(subscriptions):
+            units.append((year, month, output_dir, index, subscription))
+    complete = sum(1 for year, month, output_dir, _, subscription in units if is_subscription_month_complete(year, month, output_dir, subscription[1]))
+    log.info(f"Backfill plan: {len(units)} subscription months over {len(months)} months, {complete} already complete, {max_workers} worker(s)")
+
+    failures = []
+    # In pipeline mode each worker loads its subscription month over its own connection
+    sql_pool = cost_sql.create_connection_pool(max_workers, pipeline_load_mode) if pipeline else None
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(process_subscription_costs, year, month, output_dir, client, *subscription, resume=not pipeline, incremental=incremental, sql_pool=sql_pool): (year, month, index, subscription)
+                for year, month, output_dir, index, subscription in units
+            }
+            for future in as_completed(futures):
+                year, month, index, subscription = futures[future]
+                month_plan = months[(year, month)]
+                # Reconcile and write the summary of a month as soon as all its subscriptions are retrieved
+                if record_backfill_result(month_plan, failures, year, month, index, subscription, future):
+                    rows = reconcile_month(year, month, month_plan['output_dir'], client, month_plan['subscriptions'], month_plan['rows'], incremental=incremental, sql_pool=sql_pool, max_workers=max_workers)
+                    write_subscription_cost_summary(month_plan['summary_csv'], rows)
+                    log.info(f"The summary of cost data for all subscriptions for {year}-{month:02d} is available at: {month_plan['summary_csv']}")
+    finally:
+        if sql_pool is not None:
+            cost_sql.close_connection_pool(sql_pool)
+    complete_backfill(client.scheduler, failures)
+
+# Function to record the result of a subscription month of a backfill (a finished future or asyncio task) in the plan
+# of its month. Returns True when it was the last subscription of the month and none of them failed
+def record_backfill_result(month_plan, failures, year, month, index, subscription, future):
+    try:
+        month_plan['rows'][index] = future.result()
+    except Exception as err:
+        month_plan['failed'] = True
+        failures.append((year, month, subscription[1]))
+        log.error(f"Failed to retrieve the cost data of subscription {subscription[1]} for {year}-{month:02d}: {err}", extra={'subscription': subscription[0], 'month': f'{year}-{month:02d}'})
+    month_plan['pending'] -= 1
+    return month_plan['pending'] == 0 and not month_plan['failed']
+
+# Function to log the statistics of a backfill and fail it if some subscription months failed
+def complete_backfill(scheduler, failures):
+    log.info(f"Request scheduler statistics: {scheduler.stats()}")
+    if response_cache:
+        log.info(f"Response cache statistics: {response_cache.stats()}")
+    if failures:
+        raise Exception(f"{len(failures)} subscription months failed, run the backfill again to retry them: {failures}")
+
+# Function to get the billing account summary of a month with the asyncio client and list its subscriptions (see prepare_month)
+async def prepare_month_async(year, month, client, reuse_closed=False):
+    billing_account_summary = None
+    if not billing_account_summary_file(year, month, reuse_closed)[1]:
+        start_date = datetime(year, month, 1).strftime('%Y-%m-%d')
+        end_date = datetime(year, month, calendar.monthrange(year, month)[1]).strftime('%Y-%m-%d')
+        log.info(f"Getting the total cost of each subscription for the year: {year} month: {datetime(year, month, 1).strftime('%b')}")
+        billing_account_summary = await query_cost_by_subscription_in_billing_account_async(billing_account, client, start_date, end_date)
+    return prepare_month(year, month, None, reuse_closed=reuse_closed, billing_account_summary=billing_account_summary)
+
+# asyncio version of backfill_costs: the subscription months are retrieved `concurrency` at a time on one event loop
+# instead of `max_workers` threads. Split subscriptions and the re-extractions of the reconciliation go through the
+# threaded client in worker threads. Incremental and pipeline runs aren't supported by this backend
+async def backfill_costs_async(start, end, concurrency=async_concurrency, client=None):
+    log.info('*** Backfill initiated at ' + str(datetime.today()) + ' (async backend) ***')
+    if client_secret is None:
+        raise ValueError("The environment variable 'AZURE_CLIENT_SECRET' is not set.")
+    own_client = client is None
+    if own_client:
+        client = create_async_cost_management_client()
+    # Threaded client sharing the token and the request scheduler of the asyncio client
+    sync_client = cost_client.CostManagementClient(client.token_manager, client.scheduler, pool_size=max_workers)
+    try:
+        await asyncio.to_thread(client.token_manager.get_token)
+
+        # Build the plan: one unit per month and subscription
+        months = {}
+        units = []
+        for year, month in month_range(start, end):
+            output_dir, subscription_cost_summary_csv, subscriptions = await prepare_month_async(year, month, client, reuse_closed=True)
+            months[(year, month)] = {'summary_csv': subscription_cost_summary_csv, 'output_dir': output_dir, 'subscriptions': subscriptions, 'rows': [None] * len(subscriptions), 'pending': len(subscriptions), 'failed': False}
+            for index, subscription in enumerate(subscriptions):
+                units.append((year, month, output_dir, index, subscription))
+        complete = sum(1 for year, month, output_dir, _, subscription in units if is_subscription_month_complete(year, month, output_dir, subscription[1]))
+        log.info(f"Backfill plan: {len(units)} subscription months over {len(months)} months, {complete} already complete, {concurrency} concurrent queries")
+
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def retrieve(year, month, output_dir, subscription):
+            async with semaphore:
+                return await process_subscription_costs_async(year, month, output_dir, client, sync_client, *subscription, resume=True)
+
+        failures = []
+        tasks = {
+            asyncio.ensure_future(retrieve(year, month, output_dir, subscription)): (year, month, index, subscription)
+            for year, month, output_dir, index, subscription in units
+        }
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                year, month, index, subscription = tasks[task]
+                month_plan = months[(year, month)]
+                # Reconcile and write the summary of a month as soon as all its subscriptions are retrieved
+                if record_backfill_result(month_plan, failures, year, month, index, subscription, task):
+                    rows = await asyncio.to_thread(reconcile_month, year, month, month_plan['output_dir'], sync_client, month_plan['subscriptions'], month_plan['rows'], max_workers=max_workers)
+                    write_subscription_cost_summary(month_plan['summary_csv'], rows)
+                    log.info(f"The summary of cost data for all subscriptions for {year}-{month:02d} is available at: {month_plan['summary_csv']}")
+        complete_backfill(client.scheduler, failures)
+    finally:
+        if own_client:
+            await client.close()
+
+# Function to check that a pipeline run uses the default profile, whose rows are the ones of AzureResourceCost
+def check_pipeline_profile(pipeline):
+    if pipeline and extraction_profile_name != cost_profiles.DEFAULT_PROFILE:
+        raise ValueError(f"The pipeline mode loads AzureResourceCost, which needs the '{cost_profiles.DEFAULT_PROFILE}' extraction profile (not '{extraction_profile_name}')")
+
+# Function to check that a pipelined extraction isn't asked to resume: its pages went to SQL, not to a file that the
+# nextLink checkpoint could continue
+def check_pipeline_resume(pipeline, resume):
+    if pipeline and resume:
+        raise ValueError("The pipeline mode (FINOPS_PIPELINE) can't resume an extraction (FINOPS_RESUME), its queries are retrieved again from their first page")
+
+# Function to select the extraction profile of the run: the named one, or the coarsest one with the columns of a
+# `report` such as 'ResourceGroup,tag:costcenter' (see cost_profiles.choose_profile)
+def select_extraction_profile(name=None, report=None, granularity='None'):
+    global extraction_profile_name
+    if report:
+        dimensions, tag_keys = cost_profiles.parse_report(report)
+        name = cost_profiles.choose_profile(profiles, dimensions, tag_keys, granularity)
+        log.info(f"Extraction profile '{name}' chosen for the report {report} ({granularity} granularity)")
+    if name:
+        extraction_profile_name = name
+    profile = extraction_profile()
+    log.info(f"Extraction profile '{extraction_profile_name}': {profile}")
+    return extraction_profile_name
+
+# Function to estimate the queries of a period with the extraction profile without extracting it: one probe query per
+# subscription. Writes query_estimate_<month>_<year>.csv to the folder of each month and returns the estimated pages
+def estimate_costs(start, end, client=None):
+    if client is None:
+        client = create_cost_management_client()
+    client.token_manager.get_token()
+    total_pages = 0
+    for year, month in month_range(start, end):
+        output_dir, _, subscriptions = prepare_month(year, month, client, reuse_closed=True)
+        month_name = datetime(year, month, 1).strftime('%b')
+        estimate_csv = os.path.join(output_dir, f'query_estimate_{month_name}_{year}.csv')
+        month_pages = 0
+        with open(estimate_csv, 'w', newline='') as estimate_file:
+            estimate_writer = csv.writer(estimate_file)
+            estimate_writer.writerow(['SubscriptionId', 'SubscriptionName', 'Profile', 'EstimatedRows', 'EstimatedPages', 'LowerBound'])
+            for subscription_id, subscription_name, subscription_cost in subscriptions:
+                # The same subscriptions as process_subscription_costs are queried
+                if not subscription_id or subscription_cost <= 1:
+                    continue
+                estimate = estimate_subscription_query(client, year, month, subscription_id)
+                estimate_writer.writerow([subscription_id, subscription_name, extraction_profile_name, estimate['rows'], estimate['pages'], estimate['lower_bound']])
+                month_pages += estimate['pages']
+        log.info(f"Estimated {month_pages} pages for {year}-{month:02d} with the '{extraction_profile_name}' profile, about {month_pages / client.scheduler.max_rate:.1f} seconds of requests at the scheduler rate: {estimate_csv}", extra={'month': f'{year}-{month:02d}', 'page': month_pages})
+        total_pages += month_pages
+    return total_pages
+
+# Function to run a backfill with the selected backend from synchronous code. The async backend falls back to threads
+# for incremental and pipeline runs
+def run_backfill(start, end, backend=extraction_backend, max_workers=max_workers, concurrency=async_concurrency, incremental=incremental_extraction, pipeline=pipeline_mode):
+    if backend == 'async' and (incremental or pipeline):
+        log.warning("The async backend doesn't support incremental and pipeline runs, using the threads backend")
+        backend = 'threads'
+    if backend == 'async':
+        asyncio.run(backfill_costs_async(start, end, concurrency=concurrency))
+    else:
+        backfill_costs(start, end, max_workers=max_workers, incremental=incremental, pipeline=pipeline)
 
 # Main function
 def main():
-    # Loop through months 1 to 12 for the given year
-    year = 2025
-    for month in range(1, 4):
-        process_monthly_costs(year, month)    
+    parser = argparse.ArgumentParser(description='Retrieve the Azure cost data of a period to output/<year>/<month>/')
+    parser.add_argument('--from', dest='start', default=datetime.today().strftime('%Y-%m'), help='First month of the period (YYYY-MM), defaults to the current month')
+    parser.add_argument('--to', dest='end', help='Last month of the period (YYYY-MM), defaults to --from')
+    parser.add_argument('--workers', type=int, default=max_workers, help='Number of subscription months retrieved in parallel across the period')
+    parser.add_argument('--backend', choices=['threads', 'async'], default=extraction_backend, help='Retrieve the subscription months with worker threads or on an asyncio event loop')
+    parser.add_argument('--concurrency', type=int, default=async_concurrency, help='Number of subscription months retrieved concurrently by the async backend')
+    parser.add_argument('--profile', choices=sorted(profiles), default=extraction_profile_name, help='Extraction profile (grouping, granularity and metric of the queries)')
+    parser.add_argument('--report', help="Columns needed by the report, e.g. 'ResourceGroup,tag:costcenter': the coarsest profile with them is used instead of --profile")
+    parser.add_argument('--granularity', choices=cost_profiles.GRANULARITIES, default='None', help='Granularity needed by the --report')
+    parser.add_argument('--estimate', action='store_true', help='Only estimate the pages of the queries of the period with probe queries')
+    args = parser.parse_args()
+
+    # Structured (JSON lines) log of the run, next to the console output
+    cost_logging.setup_logging(os.path.join(output_dir, f"finops_cost_{datetime.now().strftime('%Y-%m-%d')}.log"))
+    try:
+        select_extraction_profile(args.profile, args.report, args.granularity)
+        if args.estimate:
+            estimate_costs(args.start, args.end or args.start)
+        else:
+            run_backfill(args.start, args.end or args.start, backend=args.backend, max_workers=args.workers, concurrency=args.concurrency)
+    finally:
+        # Timings and counters of the run, also written when it fails
+        summary_file = os.path.join(output_dir, f"run_summary_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json")
+        cost_metrics.write_run_report(summary_file, prometheus_file)
+        log.info(f"Run summary written to {summary_file}")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
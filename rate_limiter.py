@@ -0,0 +1,137 @@
+import time
+import asyncio
+import threading
+
+# Retry-after headers returned by the Cost Management API when a request is throttled (values are in seconds)
+# https://learn.microsoft.com/en-us/azure/cost-management-billing/automate/get-small-usage-datasets-on-demand#rate-limits
+RATE_LIMIT_HEADERS = {
+    'qpu': 'x-ms-ratelimit-microsoft.costmanagement-qpu-retry-after',
+    'entity': 'x-ms-ratelimit-microsoft.costmanagement-entity-retry-after',
+    'tenant': 'x-ms-ratelimit-microsoft.costmanagement-tenant-retry-after',
+    'client': 'x-ms-ratelimit-microsoft.costmanagement-client-retry-after',
+}
+
+# Scope used for the standard Retry-After header, for the fallback wait when no header is present and for token bucket pacing
+RETRY_AFTER_SCOPE = 'retry-after'
+DEFAULT_SCOPE = 'default'
+PACING_SCOPE = 'pacing'
+
+# Function to parse the retry-after values of a throttled response into {scope: seconds}
+def parse_retry_after(headers):
+    retry_after = {}
+    for scope, header in RATE_LIMIT_HEADERS.items():
+        value = headers.get(header)
+        if value is not None:
+            try:
+                retry_after[scope] = float(value)
+            except ValueError:
+                pass
+    value = headers.get('Retry-After')
+    if value is not None:
+        try:
+            retry_after[RETRY_AFTER_SCOPE] = float(value)
+        except ValueError:
+            pass
+    return retry_after
+
+# Scheduler shared by all the in-flight Cost Management requests.
+# Requests are paced with a token bucket; a throttled response pauses every caller for exactly the longest
+# retry-after value returned by the API, and the bucket rate is halved (then slowly restored on success).
+class RequestScheduler:
+    def __init__(self, rate=1.0, capacity=12, min_rate=0.05, default_wait=20, recovery=0.05):
+        self.max_rate = rate
+        self.rate = rate
+        self.capacity = capacity
+        self.min_rate = min_rate
+        # Wait applied when a 429 response doesn't carry any retry-after header
+        self.default_wait = default_wait
+        # Rate added back (requests per second) after each successful request
+        self.recovery = recovery
+
+        self._lock = threading.Lock()
+        self._tokens = float(capacity)
+        self._last_refill = time.monotonic()
+        # Time until which requests are paused for each throttled scope
+        self._cooldowns = {}
+
+        # Counters for tuning
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_by_scope = {}
+        self.sleep_by_scope = {}
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._last_refill) * self.rate)
+        self._last_refill = now
+
+    # Take a request token without blocking. Returns (None, 0) when the caller can send its request, otherwise the scope
+    # being waited for and the number of seconds to wait before trying again
+    def try_acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            # Honor the longest active cooldown first
+            scope, until = max(self._cooldowns.items(), key=lambda item: item[1], default=(None, 0.0))
+            if until > now:
+                return scope, until - now
+            self._refill(now)
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self.requests += 1
+                return None, 0.0
+            return PACING_SCOPE, (1 - self._tokens) / self.rate
+
+    def _record_sleep(self, scope, wait_time):
+        with self._lock:
+            self.sleep_by_scope[scope] = self.sleep_by_scope.get(scope, 0.0) + wait_time
+
+    # Block until the caller is allowed to send a request
+    def acquire(self):
+        while True:
+            scope, wait_time = self.try_acquire()
+            if scope is None:
+                return
+            time.sleep(wait_time)
+            self._record_sleep(scope, wait_time)
+
+    # Same as acquire for the coroutines of the asyncio client, which wait without blocking the event loop
+    async def acquire_async(self):
+        while True:
+            scope, wait_time = self.try_acquire()
+            if scope is None:
+                return
+            await asyncio.sleep(wait_time)
+            self._record_sleep(scope, wait_time)
+
+    # Record a successful response and slowly restore the request rate
+    def on_success(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.recovery)
+
+    # Record a throttled response and pause all callers. Returns the number of seconds to wait
+    def on_throttled(self, headers):
+        retry_after = parse_retry_after(headers)
+        if not retry_after:
+            retry_after = {DEFAULT_SCOPE: self.default_wait}
+
+        with self._lock:
+            now = time.monotonic()
+            self.throttled += 1
+            for scope, seconds in retry_after.items():
+                self.throttled_by_scope[scope] = self.throttled_by_scope.get(scope, 0) + 1
+                self._cooldowns[scope] = max(self._cooldowns.get(scope, 0.0), now + seconds)
+            # Back off the pacing as well so that we don't hit the same limit as soon as the cooldown ends
+            self.rate = max(self.min_rate, self.rate / 2)
+            self._tokens = min(self._tokens, 1.0)
+
+        return max(retry_after.values())
+
+    # Snapshot of the counters
+    def stats(self):
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'throttled': self.throttled,
+                'throttled_by_scope': dict(self.throttled_by_scope),
+                'sleep_seconds_by_scope': {scope: round(seconds, 3) for scope, seconds in self.sleep_by_scope.items()},
+                'current_rate': round(self.rate, 3),
+            }
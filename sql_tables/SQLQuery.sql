@@ -60,6 +60,44 @@ GO
 ALTER TABLE [dbo].[ProcessCheckpoint] ADD  DEFAULT (getdate()) FOR [LastProcessedTimestamp]
 GO
 
+/****** Object:  Table [dbo].[FileLoadCheckpoint]    Load progress of each cost data file (replaces ProcessCheckpoint) ******/
+SET ANSI_NULLS ON
+GO
+
+SET QUOTED_IDENTIFIER ON
+GO
+
+CREATE TABLE [dbo].[FileLoadCheckpoint](
+	[FilePath] [nvarchar](450) NOT NULL,
+	[ContentHash] [char](64) NULL,
+	[FileSize] [bigint] NULL,
+	[FileModifiedTime] [bigint] NULL,
+	[TotalRows] [int] NULL,
+	[LastProcessedRow] [int] NOT NULL,
+	[IsComplete] [bit] NOT NULL,
+	[LastProcessedTimestamp] [datetime] NOT NULL,
+PRIMARY KEY CLUSTERED 
+(
+	[FilePath] ASC
+)WITH (STATISTICS_NORECOMPUTE = OFF, IGNORE_DUP_KEY = OFF, OPTIMIZE_FOR_SEQUENTIAL_KEY = OFF) ON [PRIMARY]
+) ON [PRIMARY]
+GO
+
+ALTER TABLE [dbo].[FileLoadCheckpoint] ADD  DEFAULT ((0)) FOR [LastProcessedRow]
+GO
+
+ALTER TABLE [dbo].[FileLoadCheckpoint] ADD  DEFAULT ((0)) FOR [IsComplete]
+GO
+
+ALTER TABLE [dbo].[FileLoadCheckpoint] ADD  DEFAULT (getdate()) FOR [LastProcessedTimestamp]
+GO
+
+-- Size and modification time (nanoseconds) of the loaded file, the file is only hashed again when they change.
+-- Adds the columns to a FileLoadCheckpoint table created without them
+IF COL_LENGTH(N'[dbo].[FileLoadCheckpoint]', N'FileSize') IS NULL
+ALTER TABLE [dbo].[FileLoadCheckpoint] ADD [FileSize] [bigint] NULL, [FileModifiedTime] [bigint] NULL
+GO
+
 /****** Object:  Table [dbo].[SubscriptionCost]    Script Date: 2025-04-13 5:31:21 PM ******/
 SET ANSI_NULLS ON
 GO
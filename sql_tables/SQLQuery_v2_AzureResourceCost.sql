@@ -0,0 +1,125 @@
+/****** Schema version 2 of AzureResourceCost    Script Date: 2026-10-18 ******/
+-- Typed columns (decimal cost, date billing month), monthly partitions on BillingMonth, clustered columnstore storage
+-- and a unique key used by the MERGE load mode of export-to-sql.py. Once the SchemaVersion row below is written, the
+-- loads refuse to start unless SQL_LOAD_MODE=merge, as the insert mode doesn't compute ResourceKey.
+-- The existing nvarchar table is kept as AzureResourceCost_v1 and its rows are copied into the new table.
+SET ANSI_NULLS ON
+GO
+
+SET QUOTED_IDENTIFIER ON
+GO
+
+/****** Object:  Table [dbo].[SchemaVersion] ******/
+IF OBJECT_ID(N'[dbo].[SchemaVersion]') IS NULL
+CREATE TABLE [dbo].[SchemaVersion](
+	[TableName] [nvarchar](128) NOT NULL,
+	[Version] [int] NOT NULL,
+	[AppliedTimestamp] [datetime] NOT NULL DEFAULT (getdate()),
+PRIMARY KEY CLUSTERED 
+(
+	[TableName] ASC
+)
+) ON [PRIMARY]
+GO
+
+/****** Object:  PartitionFunction [pfBillingMonth]    One partition per billing month ******/
+-- Add the partitions of the following months before loading them, e.g.
+-- ALTER PARTITION SCHEME [psBillingMonth] NEXT USED [PRIMARY];
+-- ALTER PARTITION FUNCTION [pfBillingMonth]() SPLIT RANGE ('2027-01-01');
+CREATE PARTITION FUNCTION [pfBillingMonth](date) AS RANGE RIGHT FOR VALUES (
+	'2024-01-01', '2024-02-01', '2024-03-01', '2024-04-01', '2024-05-01', '2024-06-01',
+	'2024-07-01', '2024-08-01', '2024-09-01', '2024-10-01', '2024-11-01', '2024-12-01',
+	'2025-01-01', '2025-02-01', '2025-03-01', '2025-04-01', '2025-05-01', '2025-06-01',
+	'2025-07-01', '2025-08-01', '2025-09-01', '2025-10-01', '2025-11-01', '2025-12-01',
+	'2026-01-01', '2026-02-01', '2026-03-01', '2026-04-01', '2026-05-01', '2026-06-01',
+	'2026-07-01', '2026-08-01', '2026-09-01', '2026-10-01', '2026-11-01', '2026-12-01'
+)
+GO
+
+CREATE PARTITION SCHEME [psBillingMonth] AS PARTITION [pfBillingMonth] ALL TO ([PRIMARY])
+GO
+
+/****** Object:  Table [dbo].[AzureResourceCost]    Version 2 ******/
+EXEC sp_rename N'[dbo].[AzureResourceCost]', N'AzureResourceCost_v1'
+GO
+
+CREATE TABLE [dbo].[AzureResourceCost](
+	[SubscriptionName] [nvarchar](500) NULL,
+	[SubscriptionId] [nvarchar](100) NULL,
+	[ResourceGroup] [nvarchar](500) NULL,
+	[ResourceName] [nvarchar](500) NULL,
+	[ResourceID] [nvarchar](1000) NULL,
+	[ConsumedService] [nvarchar](200) NULL,
+	[MeterCategory] [nvarchar](200) NULL,
+	[MeterSubcategory] [nvarchar](200) NULL,
+	[Location] [nvarchar](100) NULL,
+	[BillingMonth] [date] NOT NULL,
+	[CostCenter] [nvarchar](50) NULL,
+	[Cost] [decimal](19, 6) NOT NULL,
+	-- SHA-256 of SubscriptionId|ResourceGroup|ResourceID|ConsumedService|MeterCategory|MeterSubcategory|Location|CostCenter
+	[ResourceKey] [binary](32) NOT NULL
+) ON [psBillingMonth]([BillingMonth])
+GO
+
+CREATE CLUSTERED COLUMNSTORE INDEX [CCI_AzureResourceCost] ON [dbo].[AzureResourceCost]
+ON [psBillingMonth]([BillingMonth])
+GO
+
+ALTER TABLE [dbo].[AzureResourceCost] ADD CONSTRAINT [PK_AzureResourceCost] PRIMARY KEY NONCLUSTERED 
+(
+	[BillingMonth] ASC,
+	[ResourceKey] ASC
+) ON [psBillingMonth]([BillingMonth])
+GO
+
+/****** Object:  Table [dbo].[AzureResourceCostStage]    Rows of the MERGE load mode, one LoadKey per cost data file ******/
+CREATE TABLE [dbo].[AzureResourceCostStage](
+	[LoadKey] [nvarchar](450) NOT NULL,
+	[SubscriptionName] [nvarchar](500) NULL,
+	[SubscriptionId] [nvarchar](100) NULL,
+	[ResourceGroup] [nvarchar](500) NULL,
+	[ResourceName] [nvarchar](500) NULL,
+	[ResourceID] [nvarchar](1000) NULL,
+	[ConsumedService] [nvarchar](200) NULL,
+	[MeterCategory] [nvarchar](200) NULL,
+	[MeterSubcategory] [nvarchar](200) NULL,
+	[Location] [nvarchar](100) NULL,
+	[BillingMonth] [nvarchar](50) NULL,
+	[CostCenter] [nvarchar](50) NULL,
+	[Cost] [nvarchar](50) NULL
+) ON [PRIMARY]
+GO
+
+CREATE CLUSTERED INDEX [IX_AzureResourceCostStage_LoadKey] ON [dbo].[AzureResourceCostStage]
+(
+	[LoadKey] ASC
+) ON [PRIMARY]
+GO
+
+/****** Copy the rows of version 1, summing the rows which share a key ******/
+-- Rows with the same key are distinct cost rows of the query (as in the MERGE of cost_sql.merge_staged_rows), so their
+-- costs add up. Delete the duplicates left by reloading a file in insert mode from AzureResourceCost_v1 before the copy
+INSERT INTO [dbo].[AzureResourceCost] (
+	SubscriptionName, SubscriptionId, ResourceGroup, ResourceName, ResourceID, ConsumedService, MeterCategory,
+	MeterSubcategory, Location, BillingMonth, CostCenter, Cost, ResourceKey
+)
+SELECT
+	MAX(SubscriptionName), SubscriptionId, ResourceGroup, MAX(ResourceName), ResourceID, ConsumedService, MeterCategory,
+	MeterSubcategory, Location, CONVERT(date, LEFT(BillingMonth, 10)), CostCenter,
+	CONVERT(decimal(19, 6), SUM(CONVERT(float, Cost))),
+	CONVERT(binary(32), HASHBYTES('SHA2_256', CONCAT_WS(N'|', SubscriptionId, ResourceGroup, ResourceID, ConsumedService,
+		MeterCategory, MeterSubcategory, Location, CostCenter)))
+FROM [dbo].[AzureResourceCost_v1]
+GROUP BY SubscriptionId, ResourceGroup, ResourceID, ConsumedService, MeterCategory, MeterSubcategory, Location,
+	CONVERT(date, LEFT(BillingMonth, 10)), CostCenter
+GO
+
+MERGE [dbo].[SchemaVersion] AS target
+USING (SELECT N'AzureResourceCost' AS TableName, 2 AS Version) AS source
+ON target.TableName = source.TableName
+WHEN MATCHED THEN UPDATE SET Version = source.Version, AppliedTimestamp = getdate()
+WHEN NOT MATCHED THEN INSERT (TableName, Version) VALUES (source.TableName, source.Version);
+GO
+
+/****** Month-level delete: truncate only the partition of the month ******/
+-- TRUNCATE TABLE [dbo].[AzureResourceCost] WITH (PARTITIONS ($PARTITION.pfBillingMonth('2025-01-01')));
@@ -0,0 +1,60 @@
+import os
+import sys
+
+# The modules of the repository are imported by name, as the scripts do
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import pytest
+# Import custom modules
+import cost_api_mock
+import cost_client
+import cost_sql
+import finops_cost
+import rate_limiter
+import benchmark
+
+# Mock of the Cost Management API shared by the tests: 2 subscriptions of 12 rows in pages of 5, with throttled queries
+# and expiring tokens so that the extractions go through the retry paths of the clients
+@pytest.fixture(scope='session')
+def mock_api_server():
+    api = cost_api_mock.MockCostApi(subscriptions=2, rows=12, page_size=5, throttle_every=4, retry_after=0.05, token_uses=2)
+    with cost_api_mock.MockCostApiServer(api) as server:
+        yield server
+
+# Function to point the scripts at the mock server, without the response cache
+@pytest.fixture
+def mock_scripts(mock_api_server, monkeypatch):
+    monkeypatch.setattr(cost_client, 'token_url_template', mock_api_server.url + '/{tenant_id}/oauth2/token')
+    monkeypatch.setattr(finops_cost, 'management_endpoint', mock_api_server.url)
+    monkeypatch.setattr(finops_cost, 'response_cache', None)
+    return mock_api_server
+
+def create_client():
+    token_manager = cost_client.TokenManager('test-tenant', 'test-client', 'test-secret')
+    return cost_client.CostManagementClient(token_manager, rate_limiter.RequestScheduler(rate=100, capacity=100), pool_size=2)
+
+# Response of a failed request, as returned by the client once it stops retrying
+class FailedResponse:
+    status_code = 500
+    text = '{"error": {"code": "InternalServerError"}}'
+
+# Client failing the `fail_at`-th request, like an extraction interrupted in the middle of its nextLink chain
+class FailingClient:
+    def __init__(self, client, fail_at):
+        self.client = client
+        self.fail_at = fail_at
+        self.requests = 0
+
+    def post(self, url, body, **kwargs):
+        self.requests += 1
+        if self.requests == self.fail_at:
+            return FailedResponse()
+        return self.client.post(url, body, **kwargs)
+
+# SQLite stand-in of Azure SQL (benchmark.py): cost_sql connects to a new database of the test
+@pytest.fixture
+def sql_database(tmp_path, monkeypatch):
+    monkeypatch.setattr(cost_sql, 'connect_to_sql', cost_sql.connect_to_sql)
+    benchmark.use_benchmark_database(str(tmp_path / 'benchmark.db'))
+    conn = cost_sql.connect_to_sql()
+    yield conn
+    conn.close()
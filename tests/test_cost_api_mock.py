@@ -0,0 +1,233 @@
+import os
+import json
+import argparse
+import pytest
+# Import custom modules
+import cost_api_mock
+import cost_client
+import cost_output
+import finops_cost
+import rate_limiter
+import cost_sql
+import cost_client_async
+import cost_cache
+import benchmark
+from conftest import create_client, FailingClient
+
+# Function to extract the first subscription of the mock for January 2024. Returns (row count, total cost)
+def extract(api, tmp_path, client, output_format, resume=False):
+    subscription_id, subscription_name, _ = api.subscription(0)
+    json_file = cost_output.cost_data_file_name(str(tmp_path), subscription_name, 'Jan', 2024, output_format)
+    return finops_cost.get_cost_data_with_pagination_retries(
+        2024, 1, subscription_id, client, str(tmp_path / 'process_log.txt'), json_file, str(tmp_path / 'next_link.txt'),
+        output_format=output_format, resume=resume), json_file
+
+# Pages of a subscription are chained with nextLink until its last row
+def test_pages_follow_the_next_link_chain():
+    api = cost_api_mock.MockCostApi(subscriptions=1, rows=12, page_size=5)
+    pages = [json.loads(api.page(0, page, '2024-01', 'next')) for page in range(3)]
+    assert [len(page['properties']['rows']) for page in pages] == [5, 5, 2]
+    assert [page['properties']['nextLink'] for page in pages] == ['next', 'next', None]
+    assert [column['name'] for column in pages[0]['properties']['columns']] == cost_output.COST_DATA_COLUMNS
+    total = sum(row[0] for page in pages for row in page['properties']['rows'])
+    assert total == pytest.approx(api.subscription_total(0))
+    assert pages[0]['properties']['rows'][0][8] == '2024-01-01T00:00:00'
+
+# The billing account summary holds the total cost of each subscription, largest first
+def test_billing_account_summary():
+    api = cost_api_mock.MockCostApi(subscriptions=3, rows=[10, 40, 20])
+    rows = json.loads(api.billing_account_summary())['properties']['rows']
+    assert [row[1] for row in rows] == [api.subscription(index)[0] for index in (1, 2, 0)]
+    assert rows[0][0] == pytest.approx(api.subscription_total(1))
+    assert api.subscription_index(api.subscription(2)[0]) == 2
+    assert api.subscription_index('unknown') is None
+
+def test_admit_throttles_and_expires_tokens():
+    api = cost_api_mock.MockCostApi(throttle_every=3, retry_after=0.5, token_uses=3)
+    assert api.admit('Bearer unknown')[0] == 401
+    token = 'Bearer ' + json.loads(api.issue_token())['access_token']
+    assert api.admit(token) is None
+    status, headers, _ = api.admit(token)
+    assert status == 429
+    assert headers['x-ms-ratelimit-microsoft.costmanagement-qpu-retry-after'] == '0.5'
+    assert api.admit(token) is None
+    assert api.admit(token) is None
+    # The token has served 3 queries: the next one is rejected as expired (before the throttling of the 6th request)
+    status, _, body = api.admit(token)
+    assert status == 401
+    assert b'ExpiredAuthenticationToken' in body
+    assert api.stats() == {'requests': 6, 'throttled': 1, 'expired': 1, 'tokens': 1}
+
+# Throttled queries and expired tokens are retried by the client: every row is written once, in every format.
+# The mock is started for the test so that its counters only hold the requests of this extraction
+@pytest.mark.parametrize('output_format', cost_output.OUTPUT_FORMATS)
+def test_extraction_goes_through_throttling_and_token_expiry(tmp_path, monkeypatch, output_format):
+    api = cost_api_mock.MockCostApi(subscriptions=1, rows=12, page_size=5, throttle_every=4, retry_after=0.05, token_uses=2)
+    with cost_api_mock.MockCostApiServer(api) as server:
+        monkeypatch.setattr(cost_client, 'token_url_template', server.url + '/{tenant_id}/oauth2/token')
+        monkeypatch.setattr(finops_cost, 'management_endpoint', server.url)
+        monkeypatch.setattr(finops_cost, 'response_cache', None)
+        (row_count, total_cost), json_file = extract(api, tmp_path, create_client(), output_format)
+        # Pages 1 and 2, the token expires, the 4th request is throttled, then page 3 with a new token
+        assert server.stats() == {'requests': 5, 'throttled': 1, 'expired': 1, 'tokens': 2}
+    assert row_count == 12
+    assert total_cost == pytest.approx(api.subscription_total(0))
+    records = list(cost_output.iter_cost_records(json_file))
+    assert [record[3].rsplit('/', 1)[1] for record in records] == [f'vm-{row:07d}' for row in range(12)]
+
+# An extraction failing on its last page is resumed from the nextLink checkpoint without duplicating the rows written
+@pytest.mark.parametrize('output_format', cost_output.OUTPUT_FORMATS)
+def test_resume_after_a_failed_page(mock_scripts, tmp_path, output_format):
+    api = mock_scripts.api
+    client = create_client()
+    with pytest.raises(Exception, match='Resume from checkpoint'):
+        extract(api, tmp_path, FailingClient(client, fail_at=3), output_format)
+    checkpoint = finops_cost.read_next_link_checkpoint(str(tmp_path / 'next_link.txt'))
+    assert checkpoint['row_count'] == 10
+    assert not checkpoint['complete']
+
+    (row_count, total_cost), json_file = extract(api, tmp_path, client, output_format, resume=True)
+    assert row_count == 12
+    assert total_cost == pytest.approx(api.subscription_total(0))
+    records = list(cost_output.iter_cost_records(json_file))
+    assert len(records) == 12
+    assert sum(record[0] for record in records) == pytest.approx(api.subscription_total(0))
+    assert finops_cost.read_next_link_checkpoint(str(tmp_path / 'next_link.txt'))['complete']
+
+# Checkpoints are only trusted with their output file: a complete one skips the subscription without any request, one
+# whose file is gone or written by an older run (the nextLink only) starts the extraction over
+def test_resume_checks_the_checkpoint(mock_scripts, tmp_path):
+    api = mock_scripts.api
+    next_link_file = str(tmp_path / 'next_link.txt')
+    (row_count, total_cost), json_file = extract(api, tmp_path, create_client(), cost_output.OUTPUT_FORMAT_NDJSON)
+    assert finops_cost.read_next_link_checkpoint(next_link_file) == {'next_link': None, 'row_count': 12, 'total_cost': total_cost, 'complete': True}
+
+    counting_client = FailingClient(create_client(), fail_at=None)
+    assert extract(api, tmp_path, counting_client, cost_output.OUTPUT_FORMAT_NDJSON, resume=True)[0] == (12, total_cost)
+    assert counting_client.requests == 0
+
+    os.remove(json_file)
+    assert extract(api, tmp_path, counting_client, cost_output.OUTPUT_FORMAT_NDJSON, resume=True)[0][0] == 12
+    assert counting_client.requests == 3
+
+    with open(next_link_file, 'w') as file:
+        file.write('https://management.azure.com/next')
+    assert finops_cost.read_next_link_checkpoint(next_link_file) is None
+    assert extract(api, tmp_path, counting_client, cost_output.OUTPUT_FORMAT_NDJSON, resume=True)[0][0] == 12
+    assert counting_client.requests == 6
+    assert len(list(cost_output.iter_cost_records(json_file))) == 12
+
+# Client whose second request raises, like a connection error once the retries are exhausted
+class RaisingClient:
+    def __init__(self, client):
+        self.client = client
+        self.requests = 0
+
+    def post(self, url, body, **kwargs):
+        self.requests += 1
+        if self.requests == 2:
+            raise ConnectionError('connection reset')
+        return self.client.post(url, body, **kwargs)
+
+# A request raising in the middle of the chain drops the incomplete cache entry and closes the output, which can be resumed
+def test_raising_request_releases_the_cache_entry(mock_scripts, tmp_path, monkeypatch):
+    cache = cost_cache.ResponseCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(finops_cost, 'response_cache', cache)
+    api = mock_scripts.api
+    with pytest.raises(ConnectionError):
+        extract(api, tmp_path, RaisingClient(create_client()), cost_output.OUTPUT_FORMAT_NDJSON)
+    assert [file for _, _, files in os.walk(cache.cache_dir) for file in files] == []
+    (row_count, _), json_file = extract(api, tmp_path, create_client(), cost_output.OUTPUT_FORMAT_NDJSON, resume=True)
+    assert row_count == 12
+    assert len(list(cost_output.iter_cost_records(json_file))) == 12
+
+# The MERGE statements of the scripts are replaced by their SQLite version, the other statements are kept
+def test_translate_sql():
+    assert benchmark.translate_sql('MERGE AzureResourceCost AS target\n USING #Staging AS source') == benchmark.SQLITE_MERGE_STAGED_ROWS
+    assert benchmark.translate_sql('  MERGE   FileLoadCheckpoint AS target') == benchmark.SQLITE_SAVE_CHECKPOINT
+    assert benchmark.translate_sql('SELECT 1') == 'SELECT 1'
+
+# The key of a resource skips the missing values, like CONCAT_WS
+def test_resource_key():
+    assert benchmark.resource_key('a', None, 'b') == benchmark.resource_key('a', 'b')
+    assert benchmark.resource_key('a', 'b') != benchmark.resource_key('ab')
+    assert len(benchmark.resource_key('a')) == 32
+
+# A benchmark regresses when its throughput drops or its peak memory grows beyond the tolerance, for the same rows
+def test_find_regressions():
+    baseline = {'results': [
+        {'benchmark': 'extract', 'rows': 100, 'rows_per_second': 1000, 'peak_memory_mb': 10},
+        {'benchmark': 'load', 'rows': 100, 'rows_per_second': 1000, 'peak_memory_mb': 10},
+        {'benchmark': 'monthly', 'rows': 50, 'rows_per_second': 1000, 'peak_memory_mb': 10},
+    ]}
+    results = [
+        {'benchmark': 'extract', 'rows': 100, 'rows_per_second': 950, 'peak_memory_mb': 10.5},
+        {'benchmark': 'load', 'rows': 100, 'rows_per_second': 800, 'peak_memory_mb': 12},
+        # Not comparable: another number of rows
+        {'benchmark': 'monthly', 'rows': 100, 'rows_per_second': 10, 'peak_memory_mb': 100},
+    ]
+    regressions = benchmark.find_regressions(results, baseline, tolerance=0.1)
+    assert len(regressions) == 2
+    assert all(regression.startswith('load: ') for regression in regressions)
+
+def test_counter_total():
+    summary = {'counters': [
+        {'name': 'api_retries_total', 'reason': 'throttled', 'value': 3},
+        {'name': 'api_retries_total', 'reason': 'token_expired', 'value': 1},
+        {'name': 'extract_rows_total', 'value': 12},
+    ]}
+    assert benchmark.counter_total(summary, 'api_retries_total') == 4
+    assert benchmark.counter_total(summary, 'api_retries_total', reason='throttled') == 3
+    assert benchmark.counter_total(summary, 'missing') == 0
+
+# The load benchmark extracts its file with the backend of the run, then loads it into the SQLite database
+@pytest.mark.parametrize('backend', ['threads', 'async'])
+def test_load_benchmark(mock_api_server, tmp_path, monkeypatch, backend):
+    if backend == 'async' and cost_client_async.aiohttp is None:
+        pytest.skip('the async backend requires aiohttp')
+    # Globals changed by configure_scripts and use_benchmark_database
+    monkeypatch.setattr(cost_client, 'token_url_template', cost_client.token_url_template)
+    monkeypatch.setattr(cost_sql, 'connect_to_sql', cost_sql.connect_to_sql)
+    for name in ('management_endpoint', 'billing_account', 'client_secret', 'output_format', 'response_cache', 'pipeline_load_mode'):
+        monkeypatch.setattr(finops_cost, name, getattr(finops_cost, name))
+    args = argparse.Namespace(format=cost_output.OUTPUT_FORMAT_JSON, backend=backend, workers=2, pipeline=False, load_mode='merge',
+                              requests_per_second=1000, repeat=1, odbc=None, keep=False)
+    benchmark.configure_scripts(mock_api_server, args)
+    result = benchmark.run_benchmark('load', mock_api_server.api, args, str(tmp_path), 2024, 1)
+    assert result['benchmark'] == 'load'
+    assert result['rows'] == 12
+
+# Function to extract the first subscription of the mock for January 2024 as `count` date partitions
+def extract_partitioned(api, tmp_path, client, count, resume=False):
+    subscription_id, subscription_name, _ = api.subscription(0)
+    json_file = cost_output.cost_data_file_name(str(tmp_path), subscription_name, 'Jan', 2024)
+    return finops_cost.get_partitioned_cost_data(
+        2024, 1, subscription_id, subscription_name, api.subscription_total(0), client, str(tmp_path / 'process_log.txt'),
+        json_file, str(tmp_path / 'next_link.txt'), count, resume=resume, dimension='UsageDate', workers=1), json_file
+
+# Date partitions are combined into the subscription file and removed
+def test_partitions_are_combined(mock_scripts, tmp_path):
+    api = mock_scripts.api
+    (row_count, total_cost), json_file = extract_partitioned(api, tmp_path, create_client(), 1)
+    assert row_count == 12
+    assert total_cost == pytest.approx(api.subscription_total(0))
+    assert len(list(cost_output.iter_cost_records(json_file))) == 12
+    assert [file for file in os.listdir(tmp_path) if file.startswith('partition_')] == []
+
+# The mock ignores the date range of the partitions, so two partitions add up to twice the probe total and the subscription
+# is retrieved with a single query. That query is resumed from its checkpoint, without planning the partitions again
+def test_partition_fallback_is_resumed(mock_scripts, tmp_path):
+    api = mock_scripts.api
+    client = create_client()
+    # The probe and the two partitions take 3 requests each, the single query fails on its last page
+    with pytest.raises(Exception, match='Resume from checkpoint'):
+        extract_partitioned(api, tmp_path, FailingClient(client, fail_at=12), 2)
+    assert finops_cost.read_next_link_checkpoint(str(tmp_path / 'next_link.txt'))['row_count'] == 10
+
+    counting_client = FailingClient(client, fail_at=None)
+    (row_count, total_cost), json_file = extract_partitioned(api, tmp_path, counting_client, 2, resume=True)
+    assert counting_client.requests == 1
+    assert row_count == 12
+    assert total_cost == pytest.approx(api.subscription_total(0))
+    assert len(list(cost_output.iter_cost_records(json_file))) == 12
+    assert finops_cost.read_next_link_checkpoint(str(tmp_path / 'next_link.txt'))['complete']
@@ -0,0 +1,129 @@
+import os
+import time
+from datetime import date, timedelta
+import pytest
+# Import custom modules
+import cost_cache
+
+SUBSCRIPTION_URL = 'https://management.azure.com/subscriptions/sub-1/providers/Microsoft.CostManagement/query?api-version=2023-03-01'
+OTHER_SUBSCRIPTION_URL = 'https://management.azure.com/subscriptions/sub-2/providers/Microsoft.CostManagement/query?api-version=2023-03-01'
+
+# Function to build a query body over a period
+def query_body(start_date, end_date, **dataset):
+    return {'type': 'Usage', 'timeframe': 'Custom', 'timePeriod': {'from': start_date, 'to': end_date}, 'dataset': dataset}
+
+@pytest.fixture
+def cache(tmp_path):
+    return cost_cache.ResponseCache(str(tmp_path / 'cache'), closed_ttl=1000, open_ttl=10)
+
+# A period is closed once settle_days have passed after its end, for dates and ISO strings
+def test_period_closed():
+    today = date.today()
+    assert not cost_cache.period_closed(today)
+    assert not cost_cache.period_closed(today - timedelta(days=3), settle_days=3)
+    assert cost_cache.period_closed(today - timedelta(days=4), settle_days=3)
+    assert cost_cache.period_closed((today - timedelta(days=4)).isoformat() + 'T00:00:00', settle_days=3)
+    assert not cost_cache.period_closed((today - timedelta(days=4)).isoformat(), settle_days=10)
+
+# Closed periods get the closed TTL, the current month the open one
+def test_ttl_depends_on_the_end_of_the_period(cache):
+    today = date.today()
+    assert cache.ttl(query_body('2020-01-01', '2020-01-31')) == 1000
+    assert cache.ttl(query_body(today.replace(day=1).isoformat(), today.isoformat())) == 10
+    assert cache.ttl({}) == 10
+
+def test_put_and_get_all_the_pages(cache):
+    body = query_body('2020-01-01', '2020-01-31')
+    with cache.open_entry(SUBSCRIPTION_URL, body) as entry:
+        entry.add_page({'page': 1})
+        entry.add_page({'page': 2})
+    assert list(cache.get(SUBSCRIPTION_URL, body)) == [{'page': 1}, {'page': 2}]
+    # Another body or scope is another query
+    assert cache.get(SUBSCRIPTION_URL, query_body('2020-01-01', '2020-01-31', granularity='Daily')) is None
+    assert cache.get(OTHER_SUBSCRIPTION_URL, body) is None
+    assert cache.stats()['hits'] == 1
+    assert cache.stats()['misses'] == 2
+
+# An entry is only visible once committed, a failed chain leaves nothing behind
+def test_aborted_entry_is_not_cached(cache):
+    body = query_body('2020-01-01', '2020-01-31')
+    with pytest.raises(RuntimeError):
+        with cache.open_entry(SUBSCRIPTION_URL, body) as entry:
+            entry.add_page({'page': 1})
+            raise RuntimeError('page 2 failed')
+    assert cache.get(SUBSCRIPTION_URL, body) is None
+    assert not [file for _, _, files in os.walk(cache.cache_dir) for file in files]
+
+def test_expired_entry_is_a_miss_and_removed(cache, monkeypatch):
+    body = query_body('2020-01-01', '2020-01-31')
+    cache.put(SUBSCRIPTION_URL, body, {'page': 1})
+    now = time.time()
+    monkeypatch.setattr(cost_cache.time, 'time', lambda: now + 1001)
+    assert cache.get(SUBSCRIPTION_URL, body) is None
+    assert not [file for _, _, files in os.walk(cache.cache_dir) for file in files if file.endswith('.ndjson')]
+
+# The bypass mode doesn't read the cache but still refreshes it
+def test_bypass_refreshes_without_reading(tmp_path):
+    body = query_body('2020-01-01', '2020-01-31')
+    bypass_cache = cost_cache.ResponseCache(str(tmp_path / 'cache'), bypass=True)
+    bypass_cache.put(SUBSCRIPTION_URL, body, {'page': 1})
+    assert bypass_cache.get(SUBSCRIPTION_URL, body) is None
+    assert list(cost_cache.ResponseCache(str(tmp_path / 'cache')).get(SUBSCRIPTION_URL, body)) == [{'page': 1}]
+
+# The least recently used entries are evicted once the cache is above max_bytes
+def test_eviction_of_the_least_recently_used_entries(tmp_path):
+    cache = cost_cache.ResponseCache(str(tmp_path / 'cache'))
+    bodies = [query_body('2020-01-01', '2020-01-31', index=index) for index in range(3)]
+    for index, body in enumerate(bodies):
+        cache.put(SUBSCRIPTION_URL, body, {'rows': ['x' * 100]})
+        # Distinct last use times, the first entry being the oldest
+        os.utime(cache._path(SUBSCRIPTION_URL, body), (1000 + index, 1000 + index))
+    sizes = [os.path.getsize(cache._path(SUBSCRIPTION_URL, body)) for body in bodies]
+    # Reading the first entry makes it the most recently used
+    list(cache.get(SUBSCRIPTION_URL, bodies[0]))
+
+    # Room for the three entries and half of another one (the entries differ by a few bytes)
+    cache.max_bytes = sum(sizes) + max(sizes) // 2
+    cache.put(SUBSCRIPTION_URL, query_body('2020-01-01', '2020-01-31', index=3), {'rows': ['x' * 100]})
+    assert cache.get(SUBSCRIPTION_URL, bodies[1]) is None
+    assert cache.get(SUBSCRIPTION_URL, bodies[0]) is not None
+    assert cache.get(SUBSCRIPTION_URL, bodies[2]) is not None
+    assert cache.stats()['bytes'] <= cache.max_bytes
+
+# An entry evicted by another thread between the lookup and its use is a miss, not an error
+def test_entry_evicted_during_get_is_a_miss(cache, monkeypatch):
+    body = query_body('2020-01-01', '2020-01-31')
+    cache.put(SUBSCRIPTION_URL, body, {'page': 1})
+
+    def evicted(path, *args):
+        raise FileNotFoundError(path)
+    monkeypatch.setattr(cost_cache.os, 'utime', evicted)
+    assert cache.get(SUBSCRIPTION_URL, body) is None
+    assert cache.stats()['misses'] == 1
+
+# Pages already found are still read when the entry is evicted while they are being read
+def test_pages_of_an_entry_evicted_after_get(cache):
+    body = query_body('2020-01-01', '2020-01-31')
+    cache.put(SUBSCRIPTION_URL, body, {'page': 1})
+    pages = cache.get(SUBSCRIPTION_URL, body)
+    cache.invalidate(SUBSCRIPTION_URL, body)
+    assert list(pages) == [{'page': 1}]
+    assert cache.get(SUBSCRIPTION_URL, body) is None
+
+# invalidate_period drops all the queries of the scope overlapping the period, whatever their body
+def test_invalidate_period(cache):
+    month_bodies = [
+        query_body('2025-01-01', '2025-01-31'),
+        query_body('2025-01-01', '2025-01-31', filter={'dimensions': {'name': 'ResourceGroup', 'operator': 'In', 'values': ['rg-1']}}),
+        query_body('2025-01-01', '2025-01-01'),
+        query_body('2025-01-01', '2025-01-31', granularity='Daily')
+    ]
+    other_month = query_body('2025-02-01', '2025-02-28')
+    for body in month_bodies + [other_month]:
+        cache.put(SUBSCRIPTION_URL, body, {'page': 1})
+    cache.put(OTHER_SUBSCRIPTION_URL, month_bodies[0], {'page': 1})
+
+    cache.invalidate_period(SUBSCRIPTION_URL, '2025-01-01', '2025-01-31')
+    assert all(cache.get(SUBSCRIPTION_URL, body) is None for body in month_bodies)
+    assert cache.get(SUBSCRIPTION_URL, other_month) is not None
+    assert cache.get(OTHER_SUBSCRIPTION_URL, month_bodies[0]) is not None
@@ -0,0 +1,133 @@
+import os
+import time
+import asyncio
+import pytest
+# Import custom modules
+import cost_api_mock
+import cost_client
+import cost_client_async
+import cost_cache
+import cost_output
+import finops_cost
+import rate_limiter
+
+pytestmark = pytest.mark.skipif(cost_client_async.aiohttp is None, reason='the async backend requires aiohttp')
+
+def create_client(pool_size=4):
+    token_manager = cost_client.TokenManager('test-tenant', 'test-client', 'test-secret')
+    return cost_client_async.AsyncCostManagementClient(token_manager, rate_limiter.RequestScheduler(rate=100, capacity=100), pool_size=pool_size)
+
+# Function to run a coroutine function with a client, closing its connections at the end
+def run_with_client(client, coroutine_function):
+    async def run():
+        async with client:
+            return await coroutine_function()
+    return asyncio.run(run())
+
+# A request is sent at once while the bucket has tokens, then paced at the rate of the scheduler
+def test_try_acquire_paces_the_requests():
+    scheduler = rate_limiter.RequestScheduler(rate=10, capacity=2)
+    assert scheduler.try_acquire() == (None, 0.0)
+    assert scheduler.try_acquire() == (None, 0.0)
+    scope, wait_time = scheduler.try_acquire()
+    assert scope == rate_limiter.PACING_SCOPE
+    assert 0 < wait_time <= 0.1
+    assert scheduler.stats()['requests'] == 2
+
+# A throttled response pauses every caller for the longest retry-after, and halves the rate
+def test_try_acquire_waits_for_the_cooldown():
+    scheduler = rate_limiter.RequestScheduler(rate=10, capacity=5)
+    wait_time = scheduler.on_throttled({'x-ms-ratelimit-microsoft.costmanagement-qpu-retry-after': '0.2', 'Retry-After': '0.1'})
+    assert wait_time == 0.2
+    assert scheduler.rate == 5
+    scope, wait_time = scheduler.try_acquire()
+    assert scope == 'qpu'
+    assert 0.1 < wait_time <= 0.2
+
+# The coroutines wait for the cooldown without blocking the event loop
+def test_acquire_async_does_not_block_the_event_loop():
+    scheduler = rate_limiter.RequestScheduler(rate=100, capacity=5)
+    scheduler.on_throttled({'Retry-After': '0.2'})
+    ticks = []
+
+    async def tick():
+        for _ in range(3):
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.02)
+
+    async def run():
+        start = time.monotonic()
+        await asyncio.gather(scheduler.acquire_async(), tick())
+        return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.19
+    assert len(ticks) == 3
+    assert ticks[-1] - ticks[0] < 0.2
+    assert scheduler.stats()['sleep_seconds_by_scope'][rate_limiter.RETRY_AFTER_SCOPE] >= 0.19
+
+def test_cost_response():
+    response = cost_client_async.CostResponse(200, {'Content-Type': 'application/json'}, b'{"properties": {"rows": []}}')
+    assert response.json() == {'properties': {'rows': []}}
+    assert response.text == '{"properties": {"rows": []}}'
+    assert cost_client_async.CostResponse(500, {}, b'\xff').text == '�'
+
+# Throttled queries and expired tokens are retried by the async client: every row is written once, in every format
+@pytest.mark.parametrize('output_format', cost_output.OUTPUT_FORMATS)
+def test_async_extraction_goes_through_throttling_and_token_expiry(tmp_path, monkeypatch, output_format):
+    api = cost_api_mock.MockCostApi(subscriptions=1, rows=12, page_size=5, throttle_every=4, retry_after=0.05, token_uses=2)
+    subscription_id, subscription_name, _ = api.subscription(0)
+    json_file = cost_output.cost_data_file_name(str(tmp_path), subscription_name, 'Jan', 2024, output_format)
+    with cost_api_mock.MockCostApiServer(api) as server:
+        monkeypatch.setattr(cost_client, 'token_url_template', server.url + '/{tenant_id}/oauth2/token')
+        monkeypatch.setattr(finops_cost, 'management_endpoint', server.url)
+        monkeypatch.setattr(finops_cost, 'response_cache', None)
+        client = create_client()
+        row_count, total_cost = run_with_client(client, lambda: finops_cost.get_cost_data_with_pagination_retries_async(
+            2024, 1, subscription_id, client, str(tmp_path / 'process_log.txt'), json_file, str(tmp_path / 'next_link.txt'), output_format=output_format))
+        # Pages 1 and 2, the token expires, the 4th request is throttled, then page 3 with a new token
+        assert server.stats() == {'requests': 5, 'throttled': 1, 'expired': 1, 'tokens': 2}
+    assert client.session is None
+    assert row_count == 12
+    assert total_cost == pytest.approx(api.subscription_total(0))
+    records = list(cost_output.iter_cost_records(json_file))
+    assert [record[3].rsplit('/', 1)[1] for record in records] == [f'vm-{row:07d}' for row in range(12)]
+
+# The queries of several subscriptions share the connections of the client, their gzip pages are decoded
+def test_async_client_multiplexes_the_queries(mock_api_server, monkeypatch):
+    api = mock_api_server.api
+    monkeypatch.setattr(cost_client, 'token_url_template', mock_api_server.url + '/{tenant_id}/oauth2/token')
+    client = create_client(pool_size=2)
+    body = finops_cost.build_cost_data_query_body('2024-01-01', '2024-01-31')
+
+    async def query_all():
+        urls = [f'{mock_api_server.url}/subscriptions/{api.subscription(index)[0]}/providers/Microsoft.CostManagement/query?api-version=2021-10-01' for index in range(api.subscriptions)]
+        return await asyncio.gather(*(client.post(url, body) for url in urls * 2))
+
+    responses = run_with_client(client, query_all)
+    assert [response.status_code for response in responses] == [200] * 4
+    first_rows = [response.json()['properties']['rows'][0] for response in responses]
+    assert [row[3].split('/')[2] for row in first_rows] == [api.subscription(index)[0] for index in range(api.subscriptions)] * 2
+
+# A cancelled query drops its incomplete cache entry and closes its output
+def test_cancelled_async_extraction_releases_the_cache_entry(mock_scripts, tmp_path, monkeypatch):
+    cache = cost_cache.ResponseCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(finops_cost, 'response_cache', cache)
+    api = mock_scripts.api
+    subscription_id, subscription_name, _ = api.subscription(1)
+    json_file = cost_output.cost_data_file_name(str(tmp_path), subscription_name, 'Jan', 2024, cost_output.OUTPUT_FORMAT_NDJSON)
+    client = create_client()
+    post = client.post
+    requests = []
+
+    async def cancelled_post(url, body, **kwargs):
+        requests.append(url)
+        if len(requests) == 2:
+            raise asyncio.CancelledError()
+        return await post(url, body, **kwargs)
+
+    monkeypatch.setattr(client, 'post', cancelled_post)
+    with pytest.raises(asyncio.CancelledError):
+        run_with_client(client, lambda: finops_cost.get_cost_data_with_pagination_retries_async(
+            2024, 1, subscription_id, client, str(tmp_path / 'process_log.txt'), json_file, str(tmp_path / 'next_link.txt'), output_format=cost_output.OUTPUT_FORMAT_NDJSON))
+    assert [file for _, _, files in os.walk(cache.cache_dir) for file in files] == []
+    assert finops_cost.read_next_link_checkpoint(str(tmp_path / 'next_link.txt'))['row_count'] == 5
@@ -0,0 +1,82 @@
+import json
+import logging
+import pytest
+# Import custom modules
+import cost_logging
+
+# Function to build a log record with structured fields
+def make_record(message, level=logging.INFO, **fields):
+    record = logging.LogRecord('finops_cost', level, __file__, 1, message, None, None)
+    for field, value in fields.items():
+        setattr(record, field, value)
+    return record
+
+# The root logger is restored after the tests which set up the logging of a script
+@pytest.fixture
+def script_logging():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield
+    cost_logging.shutdown_logging()
+    root.handlers = handlers
+    root.setLevel(level)
+
+def test_json_lines_formatter_keeps_the_structured_fields():
+    entry = json.loads(cost_logging.JsonLinesFormatter().format(make_record('Page retrieved', subscription='sub-1', page=3, rows=5000, log_file='ignored.txt')))
+    assert entry['message'] == 'Page retrieved'
+    assert entry['level'] == 'INFO'
+    assert entry['logger'] == 'finops_cost'
+    assert (entry['subscription'], entry['page'], entry['rows']) == ('sub-1', 3, 5000)
+    # Only the known fields are written
+    assert 'log_file' not in entry
+    assert 'month' not in entry
+
+# Bound fields are merged with the `extra` of the call, which wins, and bind can be chained
+def test_bind_merges_the_fields():
+    records = []
+    logger = logging.getLogger('test_cost_logging.bind')
+    handler = logging.Handler()
+    handler.emit = records.append
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    try:
+        subscription_log = cost_logging.bind(cost_logging.bind(logger, subscription='sub-1'), month='2025-01')
+        subscription_log.info('Retrieving', extra={'page': 2, 'month': '2025-02'})
+    finally:
+        logger.removeHandler(handler)
+    assert (records[0].subscription, records[0].month, records[0].page) == ('sub-1', '2025-02', 2)
+
+# Records are written to the file of their `log_file`, which stays open; the least recently used files are closed
+# beyond max_open and appended to when they are used again
+def test_log_file_handler_routes_records_and_limits_open_files(tmp_path):
+    handler = cost_logging.LogFileHandler(max_open=1)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    first, second = str(tmp_path / 'process_log_a.txt'), str(tmp_path / 'process_log_b.txt')
+    handler.emit(make_record('a1', log_file=first))
+    handler.emit(make_record('b1', log_file=second))
+    handler.emit(make_record('a2', log_file=first))
+    handler.emit(make_record('no file'))
+    assert len(handler._files) == 1
+    handler.close()
+    with open(first) as file:
+        assert file.read().splitlines() == ['a1', 'a2']
+    with open(second) as file:
+        assert file.read().splitlines() == ['b1']
+
+# The records of all the threads go through the listener to the JSON lines log and the per-subscription files
+def test_setup_logging_writes_json_lines_and_subscription_files(tmp_path, script_logging):
+    log_file = str(tmp_path / 'logs' / 'run.log')
+    subscription_file = str(tmp_path / 'process_log_sub.txt')
+    cost_logging.setup_logging(log_file, console=False)
+    subscription_log = cost_logging.bind('finops_cost', subscription='sub-1', log_file=subscription_file)
+    subscription_log.info('Retrieved page 1', extra={'page': 1})
+    subscription_log.warning('Rate limit exceeded', extra={'status': 429})
+    cost_logging.shutdown_logging()
+
+    with open(log_file) as file:
+        entries = [json.loads(line) for line in file]
+    assert [entry['message'] for entry in entries] == ['Retrieved page 1', 'Rate limit exceeded']
+    assert entries[0]['subscription'] == 'sub-1' and entries[0]['page'] == 1
+    assert entries[1]['status'] == 429
+    with open(subscription_file) as file:
+        assert file.read().splitlines() == ['Retrieved page 1', 'Rate limit exceeded']
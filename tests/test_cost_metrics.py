@@ -0,0 +1,91 @@
+import json
+import math
+# Import custom modules
+import cost_metrics
+
+def test_histogram_buckets_and_quantiles():
+    histogram = cost_metrics.Histogram()
+    for value in [0.003] * 50 + [0.2] * 45 + [40] * 5:
+        histogram.observe(value)
+    summary = histogram.summary()
+    assert summary['count'] == 100
+    assert summary['min'] == 0.003
+    assert summary['max'] == 40
+    # Quantiles are the upper bound of the bucket holding them, capped by the maximum
+    assert summary['p50'] == 0.005
+    assert summary['p95'] == 0.25
+    assert summary['p99'] == 40
+    assert cost_metrics.Histogram().quantile(0.5) is None
+
+# Counters and histograms are kept per label set, None labels being dropped
+def test_counters_and_histograms_by_labels():
+    metrics = cost_metrics.Metrics()
+    metrics.increment('api_retries_total', reason='throttled')
+    metrics.increment('api_retries_total', 2, reason='throttled', subscription=None)
+    metrics.increment('api_retries_total', reason='token_expired')
+    metrics.observe('api_request_seconds', 0.5, status=200)
+    metrics.observe('api_request_seconds', 1.5, status=200)
+    summary = metrics.summary()
+    counters = {(counter['name'], counter['reason']): counter['value'] for counter in summary['counters']}
+    assert counters == {('api_retries_total', 'throttled'): 3, ('api_retries_total', 'token_expired'): 1}
+    histogram, = summary['histograms']
+    assert (histogram['name'], histogram['status'], histogram['count'], histogram['sum']) == ('api_request_seconds', '200', 2, 2.0)
+
+# The rows of a stage are reported with the time of its *_seconds histograms of the same labels
+def test_throughput_per_stage_and_labels():
+    metrics = cost_metrics.Metrics()
+    metrics.increment('extract_rows_total', 1000, subscription='sub-1')
+    metrics.observe('extract_request_seconds', 1.5, subscription='sub-1')
+    metrics.observe('extract_write_seconds', 0.5, subscription='sub-1')
+    metrics.observe('extract_request_seconds', 9, subscription='sub-2')
+    metrics.increment('sql_rows_total', 10, table='SubscriptionCost')
+    throughput = metrics.summary()['throughput']
+    extract = next(entry for entry in throughput if entry['stage'] == 'extract')
+    assert (extract['subscription'], extract['rows'], extract['seconds'], extract['rows_per_second']) == ('sub-1', 1000, 2.0, 500.0)
+    sql = next(entry for entry in throughput if entry['stage'] == 'sql')
+    assert sql['rows_per_second'] is None
+
+def test_timer_observes_the_block_even_when_it_raises():
+    metrics = cost_metrics.Metrics()
+    try:
+        with metrics.timer('load_file_seconds', file='a.json'):
+            raise ValueError('failed')
+    except ValueError:
+        pass
+    histogram, = metrics.summary()['histograms']
+    assert histogram['count'] == 1
+
+def test_reset():
+    metrics = cost_metrics.Metrics()
+    metrics.increment('extract_rows_total', 5)
+    metrics.reset()
+    assert metrics.summary()['counters'] == []
+
+def test_write_summary(tmp_path):
+    metrics = cost_metrics.Metrics()
+    metrics.increment('extract_rows_total', 5, month='2025-01')
+    summary_file = str(tmp_path / 'output' / 'run_summary.json')
+    metrics.write_summary(summary_file)
+    with open(summary_file) as file:
+        summary = json.load(file)
+    assert summary['counters'] == [{'name': 'extract_rows_total', 'month': '2025-01', 'value': 5}]
+
+# Prometheus text format: one TYPE line per metric, cumulative buckets and escaped label values
+def test_write_prometheus(tmp_path):
+    metrics = cost_metrics.Metrics()
+    metrics.increment('api_retries_total', 2, reason='throttled')
+    metrics.observe('api_request_seconds', 0.02, subscription='sub "1"')
+    metrics.observe('api_request_seconds', 3, subscription='sub "1"')
+    prometheus_file = str(tmp_path / 'finops.prom')
+    metrics.write_prometheus(prometheus_file)
+    with open(prometheus_file) as file:
+        lines = file.read().splitlines()
+    assert '# TYPE finops_api_retries_total counter' in lines
+    assert 'finops_api_retries_total{reason="throttled"} 2' in lines
+    assert lines.count('# TYPE finops_api_request_seconds histogram') == 1
+    assert 'finops_api_request_seconds_bucket{subscription="sub \\"1\\"",le="0.025"} 1' in lines
+    assert 'finops_api_request_seconds_bucket{subscription="sub \\"1\\"",le="5.0"} 2' in lines
+    assert 'finops_api_request_seconds_bucket{subscription="sub \\"1\\"",le="+Inf"} 2' in lines
+    assert 'finops_api_request_seconds_count{subscription="sub \\"1\\""} 2' in lines
+    assert len([line for line in lines if line.startswith('finops_api_request_seconds_bucket')]) == len(cost_metrics.LATENCY_BUCKETS)
+    assert math.isinf(cost_metrics.LATENCY_BUCKETS[-1])
@@ -0,0 +1,87 @@
+import os
+import json
+import pytest
+# Import custom modules
+import cost_output
+
+# Rows with values that the incremental parser must not split on: brackets and commas in strings, escapes, non-ascii
+ROWS = [[float(row), f'sub-{row}', f'rg-[{row}], "quoted"', f'/vm-{row}', 'Région €', None] for row in range(23)]
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    # Rows are split across chunks and indexed every 5 rows
+    monkeypatch.setattr(cost_output, 'READ_CHUNK_SIZE', 7)
+    monkeypatch.setattr(cost_output, 'INDEX_INTERVAL', 5)
+
+# Function to write rows with CostDataWriter, in pages of 10
+def write_rows(file_path, rows, output_format):
+    with cost_output.CostDataWriter(file_path, output_format) as writer:
+        for start in range(0, len(rows), 10):
+            writer.write_page(rows[start:start + 10])
+    return file_path
+
+# The json array is parsed a chunk at a time, like json.load of the whole file
+@pytest.mark.parametrize('output_format', [cost_output.OUTPUT_FORMAT_JSON, cost_output.OUTPUT_FORMAT_NDJSON])
+def test_iter_cost_records(tmp_path, small_chunks, output_format):
+    file_path = write_rows(str(tmp_path / f'costs.{output_format}'), ROWS, output_format)
+    if output_format == cost_output.OUTPUT_FORMAT_JSON:
+        with open(file_path, 'r') as f:
+            assert json.load(f) == ROWS
+    assert list(cost_output.iter_cost_records(file_path)) == ROWS
+    assert list(cost_output.iter_cost_records(file_path, start_row=12)) == ROWS[12:]
+    assert list(cost_output.iter_cost_records(file_path, start_row=30)) == []
+
+def test_empty_json_array(tmp_path, small_chunks):
+    file_path = str(tmp_path / 'costs.json')
+    with cost_output.CostDataWriter(file_path) as writer:
+        writer.write_page([])
+    assert list(cost_output.iter_cost_records(file_path)) == []
+
+def test_unclosed_json_array(tmp_path, small_chunks):
+    file_path = tmp_path / 'costs.json'
+    file_path.write_text('[\n    [1.0, "a"],\n    [2.0, "b"]')
+    with pytest.raises(ValueError):
+        list(cost_output.iter_cost_records(str(file_path)))
+
+# The byte-offset index is saved as the rows are read, then used to seek to the indexed row before start_row
+@pytest.mark.parametrize('output_format', [cost_output.OUTPUT_FORMAT_JSON, cost_output.OUTPUT_FORMAT_NDJSON])
+def test_index_seeks_to_the_start_row(tmp_path, small_chunks, monkeypatch, output_format):
+    file_path = write_rows(str(tmp_path / f'costs.{output_format}'), ROWS, output_format)
+    assert cost_output.load_cost_data_index(file_path) is None
+    list(cost_output.iter_cost_records(file_path))
+    offsets = cost_output.load_cost_data_index(file_path)['offsets']
+    assert len(offsets) == 5
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    # The first entry is the start of the file
+    assert offsets[0] == 0
+    for position, offset in enumerate(offsets[1:], 1):
+        assert json.JSONDecoder().raw_decode(content[offset:].decode('utf-8'))[0] == ROWS[position * 5]
+
+    # Resuming at row 17 starts parsing at row 15
+    seeks = []
+    for name in ('_iter_json_array_rows', '_iter_ndjson_rows'):
+        rows_of = getattr(cost_output, name)
+        monkeypatch.setattr(cost_output, name, lambda f, offset, rows_of=rows_of: seeks.append(offset) or rows_of(f, offset))
+    assert list(cost_output.iter_cost_records(file_path, start_row=17)) == ROWS[17:]
+    assert seeks == [offsets[3]]
+
+# An index built before the file changed is ignored
+def test_stale_index_is_ignored(tmp_path, small_chunks):
+    file_path = write_rows(str(tmp_path / 'costs.json'), ROWS, cost_output.OUTPUT_FORMAT_JSON)
+    list(cost_output.iter_cost_records(file_path))
+    write_rows(file_path, ROWS[3:], cost_output.OUTPUT_FORMAT_JSON)
+    assert cost_output.load_cost_data_index(file_path) is None
+    assert list(cost_output.iter_cost_records(file_path, start_row=5)) == ROWS[8:]
+
+# End of the first rows of a json array, where a resumed writer cuts the file
+def test_json_array_rows_end(tmp_path, small_chunks):
+    file_path = write_rows(str(tmp_path / 'costs.json'), ROWS, cost_output.OUTPUT_FORMAT_JSON)
+    list(cost_output.iter_cost_records(file_path))
+    with open(file_path, 'rb') as f:
+        content = f.read()
+    for row_count in (0, 5, 7, 23):
+        end = cost_output.json_array_rows_end(file_path, row_count)
+        assert json.loads(content[:end].decode('utf-8') + '\n]') == ROWS[:row_count]
+    with pytest.raises(ValueError):
+        cost_output.json_array_rows_end(file_path, 24)
@@ -0,0 +1,127 @@
+import os
+import json
+import pytest
+# Import custom modules
+import cost_profiles
+import cost_client
+import finops_cost
+import rate_limiter
+
+# Grouping of the subscription cost query before the extraction profiles
+RESOURCE_GROUPING = [
+    {"type": "Dimension", "name": "SubscriptionName"},
+    {"type": "Dimension", "name": "ResourceGroup"},
+    {"type": "Dimension", "name": "ResourceId"},
+    {"type": "Dimension", "name": "ConsumedService"},
+    {"type": "Dimension", "name": "MeterSubcategory"},
+    {"type": "Dimension", "name": "MeterCategory"},
+    {"type": "Dimension", "name": "ResourceLocation"},
+    {"type": "Dimension", "name": "BillingMonth"},
+    {"type": "TagKey", "name": "costcenter"},
+]
+
+@pytest.fixture
+def profiles():
+    return cost_profiles.load_profiles()
+
+# The default profile queries the same body as the extraction did before the profiles
+def test_resource_profile_keeps_the_query_body(profiles):
+    assert cost_profiles.query_body(profiles['resource'], '2024-01-01', '2024-01-31') == {
+        "type": "Usage",
+        "timeframe": "Custom",
+        "timePeriod": {"from": "2024-01-01", "to": "2024-01-31"},
+        "dataset": {
+            "granularity": "None",
+            "aggregation": {"totalCost": {"name": "PreTaxCost", "function": "Sum"}},
+            "grouping": RESOURCE_GROUPING
+        }
+    }
+    daily_body = cost_profiles.query_body(profiles['resource'], '2024-01-01', '2024-01-31', granularity='Daily')
+    assert daily_body['dataset']['granularity'] == 'Daily'
+
+def test_load_profiles_from_a_file(tmp_path):
+    profiles_file = tmp_path / 'profiles.json'
+    profiles_file.write_text(json.dumps({'meter': {'dimensions': ['MeterCategory'], 'metric': 'Cost'}, 'subscription': {'dimensions': ['SubscriptionId']}}))
+    profiles = cost_profiles.load_profiles(str(profiles_file))
+    assert profiles['meter'] == {'dimensions': ['MeterCategory'], 'tag_keys': [], 'granularity': 'None', 'metric': 'Cost'}
+    assert profiles['subscription']['dimensions'] == ['SubscriptionId']
+    assert profiles['resource_group_daily']['granularity'] == 'Daily'
+
+# The rows of the 'resource' profile are loaded into AzureResourceCost, so it can't be redefined
+@pytest.mark.parametrize('custom_profiles, message', [
+    ({'resource': {'dimensions': ['ResourceId']}}, "can't be redefined"),
+    ({'weekly': {'dimensions': ['ResourceId'], 'granularity': 'Weekly'}}, 'Unsupported granularity'),
+    ({'nested': {'dimensions': [['ResourceId']]}}, 'must be names'),
+])
+def test_load_profiles_rejects_invalid_profiles(tmp_path, custom_profiles, message):
+    profiles_file = tmp_path / 'profiles.json'
+    profiles_file.write_text(json.dumps(custom_profiles))
+    with pytest.raises(ValueError, match=message):
+        cost_profiles.load_profiles(str(profiles_file))
+
+def test_parse_report():
+    assert cost_profiles.parse_report('ResourceGroup, MeterCategory,tag:costcenter, TAG: owner,') == (['ResourceGroup', 'MeterCategory'], ['costcenter', 'owner'])
+    assert cost_profiles.parse_report(None) == ([], [])
+
+# Daily rows can produce a report over the whole period, not the other way
+def test_satisfies(profiles):
+    assert cost_profiles.satisfies(profiles['cost_center'], ['resourcegroup'], ['CostCenter'])
+    assert not cost_profiles.satisfies(profiles['resource_group'], ['ResourceGroup'], ['costcenter'])
+    assert cost_profiles.satisfies(profiles['resource_group_daily'], ['ResourceGroup'])
+    assert not cost_profiles.satisfies(profiles['resource_group'], ['ResourceGroup'], granularity='Daily')
+    assert not cost_profiles.satisfies(profiles['resource_group'], ['ResourceGroup'], metric='Cost')
+
+# The coarsest profile with the columns of the report is chosen
+def test_choose_profile(profiles):
+    assert cost_profiles.choose_profile(profiles) == 'subscription'
+    assert cost_profiles.choose_profile(profiles, ['ResourceGroup']) == 'resource_group'
+    assert cost_profiles.choose_profile(profiles, ['ResourceGroup'], granularity='Daily') == 'resource_group_daily'
+    assert cost_profiles.choose_profile(profiles, ['ResourceGroup'], ['costcenter']) == 'cost_center'
+    assert cost_profiles.choose_profile(profiles, ['ResourceId']) == 'resource'
+    with pytest.raises(ValueError, match='No extraction profile'):
+        cost_profiles.choose_profile(profiles, ['ResourceId'], ['owner'])
+
+def test_estimate_pages_of_a_complete_probe(profiles):
+    # Rows of a probe over 7 days scale with the days of the month for daily profiles only
+    assert cost_profiles.estimate_pages(profiles['resource_group_daily'], 700, 1, True, 7, 31) == {'rows': 3100, 'pages': 1, 'lower_bound': False}
+    assert cost_profiles.estimate_pages(profiles['resource'], 12000, 3, True, 7, 31) == {'rows': 12000, 'pages': 3, 'lower_bound': False}
+    assert cost_profiles.estimate_pages(profiles['subscription'], 0, 1, True, 7, 31) == {'rows': 0, 'pages': 1, 'lower_bound': False}
+    assert cost_profiles.estimate_pages(profiles['resource'], 12000, 3, True, 7, 31, page_rows=1000)['pages'] == 12
+
+# A probe stopped with a nextLink left is a lower bound of at least one more page, its pages give the page size
+def test_estimate_pages_of_an_incomplete_probe(profiles):
+    assert cost_profiles.estimate_pages(profiles['resource'], 2000, 2, False, 7, 31) == {'rows': 2000, 'pages': 3, 'lower_bound': True}
+    assert cost_profiles.estimate_pages(profiles['resource_group_daily'], 2000, 2, False, 7, 28) == {'rows': 8000, 'pages': 8, 'lower_bound': True}
+    assert cost_profiles.estimate_pages(profiles['resource'], 0, 1, False, 7, 31) == {'rows': 0, 'pages': 2, 'lower_bound': True}
+
+# The files of a profile other than the default one are kept apart from the default extraction
+def test_profile_output_and_row_count_key(monkeypatch):
+    monkeypatch.setattr(finops_cost, 'extraction_profile_name', 'resource')
+    assert finops_cost.month_output_dir(2024, 3) == os.path.join('output', '2024', 'Mar')
+    assert finops_cost.row_count_key('sub-1') == 'sub-1'
+    monkeypatch.setattr(finops_cost, 'extraction_profile_name', 'resource_group')
+    assert finops_cost.month_output_dir(2024, 3) == os.path.join('output', '2024', 'Mar', 'resource_group')
+    assert finops_cost.row_count_key('sub-1') == 'sub-1/resource_group'
+    with pytest.raises(ValueError, match='pipeline mode'):
+        finops_cost.check_pipeline_profile(True)
+    finops_cost.check_pipeline_profile(False)
+
+def test_select_extraction_profile(monkeypatch):
+    monkeypatch.setattr(finops_cost, 'extraction_profile_name', 'resource')
+    assert finops_cost.select_extraction_profile(report='ResourceGroup,tag:costcenter') == 'cost_center'
+    assert finops_cost.build_cost_data_query_body('2024-01-01', '2024-01-31')['dataset']['grouping'][-1] == {'type': 'TagKey', 'name': 'costcenter'}
+    monkeypatch.setattr(finops_cost, 'extraction_profile_name', 'unknown')
+    with pytest.raises(ValueError, match='Unknown extraction profile'):
+        finops_cost.extraction_profile()
+
+# The probe query of a subscription stops after `max_pages`, its estimate is then a lower bound
+def test_estimate_subscription_query(mock_api_server, monkeypatch):
+    monkeypatch.setattr(cost_client, 'token_url_template', mock_api_server.url + '/{tenant_id}/oauth2/token')
+    monkeypatch.setattr(finops_cost, 'management_endpoint', mock_api_server.url)
+    monkeypatch.setattr(finops_cost, 'extraction_profile_name', 'resource')
+    token_manager = cost_client.TokenManager('test-tenant', 'test-client', 'test-secret')
+    client = cost_client.CostManagementClient(token_manager, rate_limiter.RequestScheduler(rate=100, capacity=100), pool_size=1)
+    subscription_id = mock_api_server.api.subscription(0)[0]
+    # The mock returns its 12 rows in pages of 5 whatever the period
+    assert finops_cost.estimate_subscription_query(client, 2024, 2, subscription_id, days=7, max_pages=5) == {'rows': 12, 'pages': 1, 'lower_bound': False}
+    assert finops_cost.estimate_subscription_query(client, 2024, 2, subscription_id, days=7, max_pages=2) == {'rows': 10, 'pages': 3, 'lower_bound': True}
@@ -0,0 +1,56 @@
+import os
+import pytest
+# Import custom modules
+import cost_output
+import cost_query
+import finops_cost
+
+# Function to build a row of the cost query
+def cost_row(cost, subscription, resource, meter_category, month='2024-01-01T00:00:00'):
+    return [cost, subscription, 'rg-01', f'/{resource}', 'Microsoft.Compute', 'D2s v3', meter_category, 'eastus', month, 'costcenter', 'cc-1', 'USD']
+
+# Function to write the cost data file of a subscription month under output/<year>/<month>/
+def write_file(subscription, year, month_name, rows, output_format=cost_output.OUTPUT_FORMAT_JSON):
+    month_path = os.path.join(cost_query.base_folder, str(year), month_name)
+    os.makedirs(month_path, exist_ok=True)
+    file_path = cost_output.cost_data_file_name(month_path, subscription, month_name, year, output_format)
+    finops_cost.write_cost_data_file(file_path, rows, output_format=output_format)
+    return file_path
+
+@pytest.fixture
+def output(tmp_path, monkeypatch):
+    monkeypatch.setattr(cost_query, 'base_folder', str(tmp_path / 'output'))
+    return tmp_path
+
+# Only the months of the period and the requested subscriptions are listed, in their preferred format
+def test_find_cost_data_files(output):
+    write_file('sub-a', 2023, 'Dec', [cost_row(1.0, 'sub-a', 'vm-1', 'Compute')])
+    json_file = write_file('sub-a', 2024, 'Jan', [cost_row(1.0, 'sub-a', 'vm-1', 'Compute')])
+    parquet_file = write_file('sub-a', 2024, 'Jan', [cost_row(1.0, 'sub-a', 'vm-1', 'Compute')], cost_output.OUTPUT_FORMAT_PARQUET)
+    feb_file = write_file('sub-b', 2024, 'Feb', [cost_row(1.0, 'sub-b', 'vm-2', 'Compute')])
+    write_file('sub-a', 2024, 'Mar', [cost_row(1.0, 'sub-a', 'vm-1', 'Compute')])
+    assert cost_query.find_cost_data_files('2024-01', '2024-02') == [parquet_file, feb_file]
+    assert cost_query.find_cost_data_files('2024-01', '2024-02', ['SUB-A']) == [parquet_file]
+    assert json_file not in cost_query.find_cost_data_files('2023-12', '2024-03')
+
+# Files of different formats are filtered, grouped and combined, largest groups first
+def test_query_costs(output):
+    files = [
+        write_file('sub-a', 2024, 'Jan', [cost_row(1.0, 'sub-a', 'vm-1', 'Compute'), cost_row(2.0, 'sub-a', 'st-1', 'Storage')]),
+        write_file('sub-b', 2024, 'Jan', [cost_row(4.0, 'sub-b', 'vm-2', 'Compute')], cost_output.OUTPUT_FORMAT_NDJSON),
+        write_file('sub-a', 2024, 'Feb', [cost_row(0.5, 'sub-a', 'vm-1', 'Compute', '2024-02-01T00:00:00')], cost_output.OUTPUT_FORMAT_PARQUET),
+    ]
+    result = cost_query.query_costs(files, ['SubscriptionName'])
+    assert result.to_dict('records') == [
+        {'SubscriptionName': 'sub-b', 'PreTaxCost': 4.0, 'count': 1},
+        {'SubscriptionName': 'sub-a', 'PreTaxCost': 3.5, 'count': 3},
+    ]
+    result = cost_query.query_costs(files, ['SubscriptionName'], top=1, filters=['MeterCategory=Storage,Network'])
+    assert result.to_dict('records') == [{'SubscriptionName': 'sub-a', 'PreTaxCost': 2.0, 'count': 1}]
+    result = cost_query.query_costs(files, [], filters=['costcenter=cc-1'])
+    assert result.to_dict('records') == [{'PreTaxCost': 7.5, 'count': 4}]
+    assert list(cost_query.query_costs([], ['Location']).columns) == ['ResourceLocation', 'PreTaxCost', 'count']
+
+def test_unknown_dimension():
+    with pytest.raises(ValueError, match='Unknown dimension'):
+        cost_query.query_costs([], ['Region'])
@@ -0,0 +1,118 @@
+import os
+import csv
+import math
+import pytest
+# Import custom modules
+import cost_cache
+import cost_reconcile
+import finops_cost
+
+BILLING_ROWS = [
+    ('sub-ok', 'Ok', 100.0),
+    ('sub-small', 'Small', 5.0),
+    ('sub-mismatch', 'Mismatch', 200.0),
+    ('sub-missing', 'Missing', 50.0),
+]
+EXTRACT_ROWS = [
+    ('sub-ok', 'Ok', 99.5, 10),
+    ('sub-small', 'Small', 4.2, 3),
+    ('sub-mismatch', 'Mismatch', 150.0, 20),
+]
+
+# Function to return the status of each subscription of a report
+def statuses(report):
+    return dict(zip(report['SubscriptionId'], report['Status']))
+
+# A delta is flagged above both the relative tolerance and the minimum delta, a subscription without total is missing
+def test_reconcile_costs_statuses():
+    report = cost_reconcile.reconcile_costs(BILLING_ROWS, EXTRACT_ROWS, tolerance=0.01, min_delta=1.0)
+    assert list(report.columns) == cost_reconcile.REPORT_COLUMNS
+    assert statuses(report) == {'sub-ok': 'ok', 'sub-small': 'ok', 'sub-mismatch': 'mismatch', 'sub-missing': 'missing'}
+    mismatch = report.set_index('SubscriptionId').loc['sub-mismatch']
+    assert mismatch['Delta'] == pytest.approx(50.0)
+    assert mismatch['RelativeDelta'] == pytest.approx(0.25)
+    assert mismatch['ResourceCount'] == 20
+    missing = report.set_index('SubscriptionId').loc['sub-missing']
+    assert math.isnan(missing['ExtractedCost'])
+    assert missing['ResourceCount'] == 0
+
+# The billing rows of a subscription are summed and the last extracted total of a subscription is kept
+def test_reconcile_costs_duplicated_rows():
+    billing_rows = [('sub-a', 'A', 60.0), ('sub-a', 'A', 40.0)]
+    extract_rows = [('sub-a', 'A', 10.0, 1), ('sub-a', 'A', 100.0, 5)]
+    report = cost_reconcile.reconcile_costs(billing_rows, extract_rows)
+    assert len(report) == 1
+    assert report['BillingAccountCost'][0] == pytest.approx(100.0)
+    assert report['ExtractedCost'][0] == pytest.approx(100.0)
+    assert report['Status'][0] == 'ok'
+
+# A mismatch with the same extracted total as the previous pass is stable, it isn't extracted again
+def test_reconcile_costs_stable_after_the_same_total():
+    first = cost_reconcile.reconcile_costs(BILLING_ROWS, EXTRACT_ROWS)
+    second = cost_reconcile.reconcile_costs(BILLING_ROWS, EXTRACT_ROWS, previous=first)
+    assert statuses(second)['sub-mismatch'] == 'stable'
+    assert statuses(second)['sub-missing'] == 'missing'
+    # A different total is still a mismatch
+    changed_rows = [row if row[0] != 'sub-mismatch' else ('sub-mismatch', 'Mismatch', 160.0, 21) for row in EXTRACT_ROWS]
+    third = cost_reconcile.reconcile_costs(BILLING_ROWS, changed_rows, previous=first)
+    assert statuses(third)['sub-mismatch'] == 'mismatch'
+
+def test_report_round_trip(tmp_path):
+    report_csv = str(tmp_path / 'reconciliation.csv')
+    assert cost_reconcile.read_reconciliation_report(report_csv) is None
+    cost_reconcile.write_reconciliation_report(cost_reconcile.reconcile_costs(BILLING_ROWS, EXTRACT_ROWS), report_csv)
+    report = cost_reconcile.read_reconciliation_report(report_csv)
+    # The largest deltas first, the missing subscriptions before them
+    assert list(report['SubscriptionId']) == ['sub-missing', 'sub-mismatch', 'sub-small', 'sub-ok']
+    assert statuses(report)['sub-missing'] == 'missing'
+    assert math.isnan(report['ExtractedCost'][0])
+    assert report['ExtractedCost'][1] == pytest.approx(150.0)
+
+# The files of a profile are in its folder of the month, except the billing account summary
+def test_month_files():
+    billing_csv, subscription_csv, report_csv = cost_reconcile.month_files(2024, 2, 'output')
+    assert billing_csv == os.path.join('output', '2024', 'Feb', 'billing_account_cost_summary_Feb_2024.csv')
+    assert subscription_csv == os.path.join('output', '2024', 'Feb', 'subscription_cost_summary_Feb_2024.csv')
+    assert cost_reconcile.month_files(2024, 2, 'output', profile='resource') == (billing_csv, subscription_csv, report_csv)
+    profile_files = cost_reconcile.month_files(2024, 2, 'output', profile='resource_group')
+    assert profile_files[0] == billing_csv
+    assert profile_files[2] == os.path.join('output', '2024', 'Feb', 'resource_group', 'reconciliation_Feb_2024.csv')
+
+# The stable subscriptions of the previous report of a month stay stable when reconciling its summary files again
+def test_reconcile_month_files(tmp_path):
+    billing_csv, subscription_csv, report_csv = cost_reconcile.month_files(2024, 2, str(tmp_path))
+    os.makedirs(os.path.dirname(billing_csv))
+    with open(billing_csv, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['SubscriptionName', 'SubscriptionId', 'TotalCost (Including Other Azure Resources)', 'Curency'])
+        writer.writerows([name, subscription_id, cost, 'USD'] for subscription_id, name, cost in BILLING_ROWS)
+    with open(subscription_csv, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(['SubscriptionId', 'SubscriptionName', 'TotalCost', 'ResourceCount'])
+        writer.writerows(EXTRACT_ROWS)
+    report = cost_reconcile.reconcile_month_files(2024, 2, base_folder=str(tmp_path))
+    assert statuses(report)['sub-mismatch'] == 'mismatch'
+    cost_reconcile.write_reconciliation_report(report.assign(Status=report['Status'].replace('mismatch', 'stable')), report_csv)
+    report = cost_reconcile.reconcile_month_files(2024, 2, base_folder=str(tmp_path))
+    assert statuses(report) == {'sub-ok': 'ok', 'sub-small': 'ok', 'sub-mismatch': 'stable', 'sub-missing': 'missing'}
+
+# Extracting a subscription again discards its checkpoint and every cached query of its month, whatever their body
+def test_reset_subscription_extraction(tmp_path, monkeypatch):
+    cache = cost_cache.ResponseCache(str(tmp_path / 'cache'))
+    monkeypatch.setattr(finops_cost, 'response_cache', cache)
+    url = finops_cost.subscription_query_url('sub-1')
+    month_body = finops_cost.build_cost_data_query_body('2024-02-01', '2024-02-29')
+    daily_body = finops_cost.build_cost_data_query_body('2024-02-10', '2024-02-29', granularity='Daily')
+    march_body = finops_cost.build_cost_data_query_body('2024-03-01', '2024-03-31')
+    for body in (month_body, daily_body, march_body):
+        cache.put(url, body, {'properties': {'rows': []}})
+    cache.put(finops_cost.subscription_query_url('sub-2'), month_body, {'properties': {'rows': []}})
+    next_link_file = tmp_path / 'next_link_sub-1_a.txt'
+    next_link_file.write_text('{}')
+
+    finops_cost.reset_subscription_extraction(2024, 2, str(tmp_path), 'sub-1', 'sub-1:a')
+    assert not next_link_file.exists()
+    assert cache.get(url, month_body) is None
+    assert cache.get(url, daily_body) is None
+    assert cache.get(url, march_body) is not None
+    assert cache.get(finops_cost.subscription_query_url('sub-2'), month_body) is not None
@@ -0,0 +1,49 @@
+import pytest
+# Import custom modules
+import cost_records
+
+ROWS = [
+    [1.5, 'sub-a', 'rg-01', '/vm-1', 'eastus', 'USD'],
+    [2.25, 'sub-a', 'rg-01', '/vm-2', 'eastus', 'USD'],
+    [0.125, 'sub-a', 'rg-02', '/vm-3', 'westeurope', 'USD'],
+    [4.0, 'sub-a', 'rg-01', '/vm-4', 'eastus', None],
+]
+
+def test_dictionary_column_stores_each_value_once():
+    column = cost_records.DictionaryColumn()
+    for value in ['eastus', 'westeurope', 'eastus', 'eastus']:
+        column.append(value)
+    assert len(column) == 4
+    assert column.values == ['eastus', 'westeurope']
+    assert list(column.codes) == [0, 1, 0, 0]
+
+def test_store_returns_the_rows_in_order():
+    store = cost_records.CostRecordStore()
+    assert list(store) == []
+    store.extend(ROWS)
+    assert len(store) == 4
+    assert list(store) == ROWS
+    assert store.total_cost == pytest.approx(7.875)
+
+# The cost column can be at any position
+def test_store_with_the_cost_in_another_column():
+    rows = [row[1:3] + [row[0]] + row[3:] for row in ROWS]
+    store = cost_records.CostRecordStore(cost_position=2)
+    store.extend(rows)
+    assert list(store) == rows
+    assert store.total_cost == pytest.approx(7.875)
+
+# Daily rows are summed per resource once their UsageDate is dropped, in the order the resources first appeared
+def test_aggregator_sums_the_groups():
+    aggregator = cost_records.CostAggregator(drop_positions=[2])
+    daily_rows = [
+        [1.0, '/vm-1', 20240101, 'USD'],
+        [2.0, '/vm-2', 20240101, 'USD'],
+        [0.5, '/vm-1', 20240102, 'USD'],
+        [0.25, '/vm-2', 20240102, 'EUR'],
+    ]
+    for row in daily_rows:
+        aggregator.add(row)
+    assert len(aggregator) == 3
+    assert list(aggregator) == [[1.5, '/vm-1', 'USD'], [2.0, '/vm-2', 'USD'], [0.25, '/vm-2', 'EUR']]
+    assert aggregator.total_cost == pytest.approx(3.75)
@@ -0,0 +1,65 @@
+import os
+import queue
+import pytest
+# Import custom modules
+import cost_sql
+import finops_cost
+from conftest import create_client, FailingClient
+
+# Function to load the first subscription of the mock for January 2024 in pipeline mode, over a pool of one connection
+def load_subscription(api, tmp_path, client):
+    subscription_id, subscription_name, _ = api.subscription(0)
+    pool = queue.Queue()
+    pool.put(cost_sql.connect_to_sql())
+    try:
+        return finops_cost.load_subscription_costs_to_sql(2024, 1, subscription_id, subscription_name, client, str(tmp_path / 'process_log.txt'), str(tmp_path / 'cost_data.json'), pool)
+    finally:
+        cost_sql.close_connection_pool(pool)
+
+# Function to read the number of rows of AzureResourceCost and their total cost
+def loaded_total(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT COUNT(*), SUM(CAST(Cost AS REAL)) FROM AzureResourceCost")
+    count, total = cursor.fetchall()[0]
+    return count, total or 0.0
+
+# A query failing in the middle of its chain leaves nothing in the table, and loading the subscription month again
+# (or once more) replaces its rows instead of adding them
+@pytest.mark.parametrize('load_mode', ['insert', 'merge'])
+def test_pipeline_abort_and_rerun(mock_scripts, sql_database, tmp_path, monkeypatch, load_mode):
+    monkeypatch.setattr(finops_cost, 'pipeline_load_mode', load_mode)
+    api = mock_scripts.api
+    client = create_client()
+    with pytest.raises(Exception, match='Status Code: 500'):
+        load_subscription(api, tmp_path, FailingClient(client, fail_at=3))
+    assert loaded_total(sql_database) == (0, 0.0)
+
+    for _ in range(2):
+        row_count, total_cost = load_subscription(api, tmp_path, client)
+        assert row_count == 12
+        count, total = loaded_total(sql_database)
+        assert count == 12
+        assert total == pytest.approx(api.subscription_total(0))
+    # Pipelined queries can't be resumed, they leave no nextLink checkpoint
+    assert not [file for file in os.listdir(tmp_path) if file.startswith('next_link')]
+
+# A failed first request is an error, not an empty subscription
+def test_pipeline_first_request_failure(mock_scripts, sql_database, tmp_path, monkeypatch):
+    monkeypatch.setattr(finops_cost, 'pipeline_load_mode', 'insert')
+    with pytest.raises(Exception, match='Status Code: 500'):
+        load_subscription(mock_scripts.api, tmp_path, FailingClient(create_client(), fail_at=1))
+    assert loaded_total(sql_database) == (0, 0.0)
+
+# The pages of the other subscription months are kept when a subscription month is loaded again in insert mode
+def test_insert_writer_replaces_its_subscription_months_only(sql_database):
+    def row(cost, subscription, billing_month):
+        return [cost, subscription, 'rg-01', f'/subscriptions/{subscription}/vm-1', 'microsoft.compute', 'D2s v3', 'Virtual Machines', 'eastus', billing_month, 'costcenter', 'cc-001', 'USD']
+    for rows in ([row(1.0, 'sub-1', '2024-01-01T00:00:00'), row(2.0, 'sub-2', '2024-01-01T00:00:00')], [row(5.0, 'sub-1', '2024-01-01T00:00:00')]):
+        conn = cost_sql.connect_to_sql()
+        writer = cost_sql.SqlCostDataWriter(conn, 'test', load_mode='insert')
+        writer.write_page(rows)
+        writer.commit()
+        conn.close()
+    cursor = sql_database.cursor()
+    cursor.execute("SELECT SubscriptionId, Cost FROM AzureResourceCost ORDER BY SubscriptionId")
+    assert [(subscription, float(cost)) for subscription, cost in cursor.fetchall()] == [('sub-1', 5.0), ('sub-2', 2.0)]
@@ -0,0 +1,143 @@
+import os
+import queue
+import pytest
+# Import custom modules
+import cost_output
+import cost_sql
+import benchmark
+
+# export-to-sql.py can't be imported by name, the benchmark loads it
+export_to_sql = benchmark.export_to_sql
+
+# Function to build a cost data row of the benchmark subscription for a resource
+def cost_row(cost, resource, billing_month='2024-01-01T00:00:00', subscription='sub-1'):
+    return [cost, subscription, 'rg-01', f'/subscriptions/{subscription}/resourcegroups/rg-01/providers/microsoft.compute/virtualmachines/{resource}',
+            'microsoft.compute', 'D2s v3', 'Virtual Machines', 'eastus', billing_month, 'costcenter', 'cc-001', 'USD']
+
+# Function to write a cost data file of output/2024/Jan in the working directory
+def write_cost_data_file(rows, output_format=cost_output.OUTPUT_FORMAT_JSON):
+    output_dir = os.path.join(export_to_sql.base_folder, '2024', 'Jan')
+    os.makedirs(output_dir, exist_ok=True)
+    json_file = cost_output.cost_data_file_name(output_dir, 'sub-1', 'Jan', 2024, output_format)
+    with cost_output.CostDataWriter(json_file, output_format) as writer:
+        writer.write_page(rows)
+    return json_file
+
+# Cost data files are loaded from the output folder of the test, with commits of 4 rows (in batches of 2, see load) so
+# that a small file spans several commits
+@pytest.fixture
+def database(sql_database, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(export_to_sql, 'commit_size', 4)
+    return sql_database
+
+# Function to read the (ResourceID name, cost) rows of AzureResourceCost
+def loaded_costs(conn):
+    cursor = conn.cursor()
+    cursor.execute("SELECT ResourceID, Cost FROM AzureResourceCost ORDER BY ResourceID, Cost")
+    return [(resource_id.rsplit('/', 1)[1], round(float(cost), 6)) for resource_id, cost in cursor.fetchall()]
+
+def load(conn, json_file, load_mode, start_row=0):
+    return export_to_sql.push_azure_resource_cost_json_to_sql(json_file, conn, start_row, batch_size=2, version=export_to_sql.file_version(json_file), load_mode=load_mode)
+
+# The rows sharing a key in different commits add up, and reloading a changed file removes the resources which are gone
+def test_merge_sums_the_rows_of_a_key_across_commits(database):
+    rows = [cost_row(1.0 + index, f'vm-{index}') for index in range(8)] + [cost_row(10.0, 'vm-1'), cost_row(0.5, 'vm-7')]
+    json_file = write_cost_data_file(rows)
+    assert load(database, json_file, 'merge') == 10
+    assert loaded_costs(database) == [('vm-0', 1.0), ('vm-1', 12.0), ('vm-2', 3.0), ('vm-3', 4.0), ('vm-4', 5.0), ('vm-5', 6.0), ('vm-6', 7.0), ('vm-7', 8.5)]
+    # Reloading the same file is idempotent
+    load(database, json_file, 'merge')
+    assert sum(cost for _, cost in loaded_costs(database)) == pytest.approx(sum(row[0] for row in rows))
+
+    json_file = write_cost_data_file([cost_row(2.0, 'vm-0'), cost_row(3.0, 'vm-1')])
+    load(database, json_file, 'merge')
+    assert loaded_costs(database) == [('vm-0', 2.0), ('vm-1', 3.0)]
+    cursor = database.cursor()
+    cursor.execute("SELECT COUNT(*) FROM AzureResourceCostStage")
+    assert cursor.fetchall()[0][0] == 0
+
+# The other subscriptions and months are kept when a file is merged
+def test_merge_keeps_the_other_subscription_months(database):
+    load(database, write_cost_data_file([cost_row(1.0, 'vm-0', subscription='sub-2'), cost_row(1.0, 'vm-0', billing_month='2023-12-01T00:00:00')]), 'merge')
+    load(database, write_cost_data_file([cost_row(5.0, 'vm-0')]), 'merge')
+    cursor = database.cursor()
+    cursor.execute("SELECT SubscriptionId, BillingMonth, Cost FROM AzureResourceCost ORDER BY SubscriptionId, BillingMonth")
+    assert [tuple(row) for row in cursor.fetchall()] == [('sub-1', '2023-12-01', 1.0), ('sub-1', '2024-01-01', 5.0), ('sub-2', '2024-01-01', 1.0)]
+
+# The merge mode only checkpoints complete files: an interrupted file is staged again from its first row
+def test_merge_checkpoints_the_complete_file_only(database, monkeypatch):
+    rows = [cost_row(1.0, f'vm-{index}') for index in range(6)] + [cost_row(1.0, 'vm-0')]
+    json_file = write_cost_data_file(rows)
+    merge_staged_rows = cost_sql.merge_staged_rows
+    def fail(cursor, load_key):
+        raise RuntimeError('merge failed')
+    monkeypatch.setattr(cost_sql, 'merge_staged_rows', fail)
+    with pytest.raises(RuntimeError):
+        load(database, json_file, 'merge')
+    database.rollback()
+    assert export_to_sql.load_file_checkpoints(database) == {}
+    assert loaded_costs(database) == []
+
+    monkeypatch.setattr(cost_sql, 'merge_staged_rows', merge_staged_rows)
+    # A checkpoint of an interrupted run isn't resumed from
+    assert load(database, json_file, 'merge', start_row=4) == 7
+    assert loaded_costs(database)[0] == ('vm-0', 2.0)
+    assert sum(cost for _, cost in loaded_costs(database)) == pytest.approx(7.0)
+    checkpoint = export_to_sql.load_file_checkpoints(database)[export_to_sql.checkpoint_file_key(json_file)]
+    assert checkpoint['complete']
+    assert checkpoint['total_rows'] == 7
+
+# Function to load a file as the workers of main do, with the checkpoints read from the database
+def load_file(conn, json_file):
+    pool = queue.Queue()
+    pool.put(conn)
+    return export_to_sql.load_cost_data_file(json_file, pool, export_to_sql.load_file_checkpoints(conn))
+
+# A complete file is skipped without being hashed again while its size and modification time are unchanged
+def test_complete_file_is_skipped(sql_database, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(export_to_sql, 'load_mode', 'insert')
+    json_file = write_cost_data_file([cost_row(1.0, 'vm-0'), cost_row(2.0, 'vm-1')])
+    assert load_file(sql_database, json_file) == 2
+    checkpoint = export_to_sql.load_file_checkpoints(sql_database)[export_to_sql.checkpoint_file_key(json_file)]
+    assert checkpoint['complete'] and checkpoint['last_row'] == 2
+    assert checkpoint['content_hash'] == export_to_sql.file_content_hash(json_file)
+
+    file_content_hash = export_to_sql.file_content_hash
+    hashed = []
+    monkeypatch.setattr(export_to_sql, 'file_content_hash', lambda file_path: hashed.append(file_path) or file_content_hash(file_path))
+    assert load_file(sql_database, json_file) == 2
+    assert hashed == []
+
+    # Same content with a new modification time: hashed once, then its checkpoint holds the new time
+    os.utime(json_file, ns=(checkpoint['file_mtime'] + 10**9, checkpoint['file_mtime'] + 10**9))
+    assert load_file(sql_database, json_file) == 2
+    assert load_file(sql_database, json_file) == 2
+    assert hashed == [json_file]
+    assert loaded_costs(sql_database) == [('vm-0', 1.0), ('vm-1', 2.0)]
+
+# An interrupted file is resumed after the last row of its checkpoint
+def test_interrupted_file_is_resumed(sql_database, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(export_to_sql, 'load_mode', 'insert')
+    json_file = write_cost_data_file([cost_row(1.0 + index, f'vm-{index}') for index in range(4)])
+    export_to_sql.save_checkpoint(sql_database, json_file, 3, export_to_sql.file_version(json_file))
+    assert load_file(sql_database, json_file) == 4
+    assert loaded_costs(sql_database) == [('vm-3', 4.0)]
+
+# In insert mode, the rows loaded from the previous version of a changed file are deleted before it's loaded again
+def test_changed_file_replaces_its_rows_in_insert_mode(sql_database, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(export_to_sql, 'load_mode', 'insert')
+    json_file = write_cost_data_file([cost_row(1.0, 'vm-0'), cost_row(2.0, 'vm-1')])
+    load_file(sql_database, json_file)
+    cursor = sql_database.cursor()
+    cursor.execute("INSERT INTO AzureResourceCost (SubscriptionId, BillingMonth, ResourceID, Cost) VALUES ('sub-1', '2023-12-01', '/vm-dec', 5.0)")
+    sql_database.commit()
+
+    json_file = write_cost_data_file([cost_row(3.0, 'vm-0')])
+    assert load_file(sql_database, json_file) == 1
+    assert loaded_costs(sql_database) == [('vm-0', 3.0), ('vm-dec', 5.0)]
+    checkpoint = export_to_sql.load_file_checkpoints(sql_database)[export_to_sql.checkpoint_file_key(json_file)]
+    assert checkpoint['complete'] and checkpoint['total_rows'] == 1